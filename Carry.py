@@ -1,20 +1,30 @@
 
-import pandas as pd
+import os
 
 try:
     from . import get_carry_sql_functions as sql
     from .fx_functions import create_fx_series_given_adjusted_prices_dict
     from .risk_functions import calculate_variable_standard_deviation_for_risk_targeting_from_dict
     from .risk_functions import calculate_position_series_given_variable_risk_for_dict
-    from .carry_functions import calculate_position_dict_with_multiple_carry_forecast_applied, apply_buffering_to_position_dict, calculate_capped_forecast
+    from .carry_functions import calculate_position_dict_given_capped_forecast, apply_buffering_to_position_dict, calculate_capped_forecast
     from .getMultiplierDict import getMultiplierDict
+    from .instrument_registry_functions import get_instrument_registry
+    from .profile_functions import get_profiler
+    from .idm_functions import calculate_idm_series, update_idm_estimator, save_idm_estimator, load_or_create_idm_estimator
+    from .idm_functions import IDM_ESTIMATOR_FILENAME
+    from .series_store_functions import write_carry_forecast_results
 except ImportError:
     import get_carry_sql_functions as sql
     from fx_functions import create_fx_series_given_adjusted_prices_dict
     from risk_functions import calculate_variable_standard_deviation_for_risk_targeting_from_dict
     from risk_functions import calculate_position_series_given_variable_risk_for_dict
-    from carry_functions import calculate_position_dict_with_multiple_carry_forecast_applied, apply_buffering_to_position_dict, calculate_capped_forecast
+    from carry_functions import calculate_position_dict_given_capped_forecast, apply_buffering_to_position_dict, calculate_capped_forecast
     from getMultiplierDict import getMultiplierDict
+    from instrument_registry_functions import get_instrument_registry
+    from profile_functions import get_profiler
+    from idm_functions import calculate_idm_series, update_idm_estimator, save_idm_estimator, load_or_create_idm_estimator
+    from idm_functions import IDM_ESTIMATOR_FILENAME
+    from series_store_functions import write_carry_forecast_results
 
 def calc_idm(instrument_list: list) -> float:
 
@@ -49,7 +59,24 @@ def calc_idm(instrument_list: list) -> float:
     # if we reached here, something went wrong
     raise ValueError("Instrument Diversity Multiplier not found")
 
-def carry_forecast(instr_list: list, weights: dict, capital: int, risk_target_tau: float, multipliers: dict, carry_spans: list, adjusted_prices_dict, current_prices_dict, carry_prices_dict) :
+def estimate_idm_series(instrument_list: list, adjusted_prices_dict: dict, current_prices_dict: dict, weights: dict = None, estimator=None):
+
+    ## the IDM at each week end from the correlation of instrument returns, which the
+    ## position sizing applies date by date. Given an estimator (eg from
+    ## load_or_create_idm_estimator) only the weeks after its last one are folded in,
+    ## and the estimator is moved on in place
+    if estimator is not None:
+        return update_idm_estimator(estimator, adjusted_prices_dict, current_prices_dict)
+
+    if weights is None:
+        weights = dict([(instrument_code, 1 / len(instrument_list)) for instrument_code in instrument_list])
+
+    return calculate_idm_series(adjusted_prices_dict, current_prices_dict, weights)
+
+def _run_stage(stage_name: str, function, **kwargs):
+    return function(**kwargs)
+
+def carry_forecast(instr_list: list, weights: dict, capital: int, risk_target_tau: float, multipliers: dict, carry_spans: list, adjusted_prices_dict, current_prices_dict, carry_prices_dict, stage_cache=None, profiler=None, idm_estimator_filename: str = None, return_std_dev: bool = False) :
     #print(instr_list)
     #print(weights) 
     #print(capital)
@@ -62,9 +89,44 @@ def carry_forecast(instr_list: list, weights: dict, capital: int, risk_target_ta
     #quit()
 
 
-    fx_series_dict = create_fx_series_given_adjusted_prices_dict(adjusted_prices_dict)
+    ## with a stageCache each stage is looked up by a fingerprint of its inputs first
+    run_stage = _run_stage if stage_cache is None else stage_cache.call
+    ## timing and memory per stage, off unless CARRY_PROFILE is set or a profiler is passed
+    if profiler is None:
+        profiler = get_profiler()
+    run_stage = profiler.wrap(run_stage)
+    run_uncached_stage = profiler.wrap(_run_stage)
 
-    idm = calc_idm(instr_list)
+    fx_series_dict = run_stage(
+        "fx_series",
+        create_fx_series_given_adjusted_prices_dict,
+        adjusted_prices_dict=adjusted_prices_dict,
+    )
+
+    if idm_estimator_filename is None:
+        idm = run_stage(
+            "idm",
+            estimate_idm_series,
+            instrument_list=instr_list,
+            adjusted_prices_dict=adjusted_prices_dict,
+            current_prices_dict=current_prices_dict,
+            weights=weights,
+        )
+    else:
+        ## the saved estimator moves on with every run, so a cached IDM would skip the save
+        idm_estimator = load_or_create_idm_estimator(
+            idm_estimator_filename, list(adjusted_prices_dict.keys()), weights
+        )
+        idm = run_uncached_stage(
+            "idm",
+            estimate_idm_series,
+            instrument_list=instr_list,
+            adjusted_prices_dict=adjusted_prices_dict,
+            current_prices_dict=current_prices_dict,
+            weights=weights,
+            estimator=idm_estimator,
+        )
+        save_idm_estimator(idm_estimator, idm_estimator_filename)
 
     instrument_weights = weights
 
@@ -72,12 +134,17 @@ def carry_forecast(instr_list: list, weights: dict, capital: int, risk_target_ta
     # Initialize cost_per_contract_dict with the value 3 for all instruments
     cost_per_contract_dict = {instrument: 6 for instrument in instr_list}
 
-    std_dev_dict = calculate_variable_standard_deviation_for_risk_targeting_from_dict(
-        adjusted_prices=adjusted_prices_dict, current_prices=current_prices_dict
+    std_dev_dict = run_stage(
+        "std_dev",
+        calculate_variable_standard_deviation_for_risk_targeting_from_dict,
+        adjusted_prices=adjusted_prices_dict,
+        current_prices=current_prices_dict,
     )
 
     average_position_contracts_dict = (
-        calculate_position_series_given_variable_risk_for_dict(
+        run_stage(
+            "average_position",
+            calculate_position_series_given_variable_risk_for_dict,
             capital=capital,
             risk_target_tau=risk_target_tau,
             idm=idm,
@@ -88,17 +155,26 @@ def carry_forecast(instr_list: list, weights: dict, capital: int, risk_target_ta
         )
     )
 
-    position_contracts_dict = (
-        calculate_position_dict_with_multiple_carry_forecast_applied(
-            adjusted_prices_dict=adjusted_prices_dict,
-            carry_prices_dict=carry_prices_dict,
-            std_dev_dict=std_dev_dict,
-            average_position_contracts_dict=average_position_contracts_dict,
-            carry_spans=carry_spans,
-        )
+    ## the forecast is the expensive stage, so build it once and size positions from it
+    capped_forecast_dict = run_stage(
+        "forecast",
+        calculate_capped_forecast,
+        adjusted_prices_dict=adjusted_prices_dict,
+        std_dev_dict=std_dev_dict,
+        carry_prices_dict=carry_prices_dict,
+        carry_spans=carry_spans,
+    )
+
+    position_contracts_dict = run_stage(
+        "position",
+        calculate_position_dict_given_capped_forecast,
+        capped_forecast_dict=capped_forecast_dict,
+        average_position_contracts_dict=average_position_contracts_dict,
     )
 
-    buffered_position_dict = apply_buffering_to_position_dict(
+    buffered_position_dict = run_stage(
+        "buffering",
+        apply_buffering_to_position_dict,
         position_contracts_dict=position_contracts_dict,
         average_position_contracts_dict=average_position_contracts_dict,
     )
@@ -113,14 +189,11 @@ def carry_forecast(instr_list: list, weights: dict, capital: int, risk_target_ta
         #std_dev_dict=std_dev_dict,
     #)
 
-    capped_forecast_dict = calculate_capped_forecast(
-        adjusted_prices_dict, 
-        std_dev_dict, 
-        carry_prices_dict, 
-        carry_spans,
-        )
-    
-    return [buffered_position_dict, position_contracts_dict]
+    ## return_std_dev=True adds the vol the positions were sized on, eg for the series store
+    if return_std_dev:
+        return [buffered_position_dict, position_contracts_dict, capped_forecast_dict, std_dev_dict]
+
+    return [buffered_position_dict, position_contracts_dict, capped_forecast_dict]
 
 # List of all instruments in the portfolio
 def main():
@@ -129,12 +202,17 @@ def main():
                    'LE', 'RTY', '6A', 'WBS', 'ES', 'GC', 'HG', 'NQ', 'RB', '6M', 'YM', '6N',
                    'PL', 'SB', 'SI', 'FSMI', 'UB', 'VX', 'LSU', 'SCN', 'ZS', 'ZW', 'ZC', 'ZL', 
                    'ZM', 'ZN', 'ZR']
-    symbols = pd.read_csv('Symbols.csv')
-    all_instruments = symbols['Data Symbol'].to_list()
+    all_instruments = get_instrument_registry().data_symbols()
+
+    profiler = get_profiler()
 
-    adjusted_prices_dict, current_prices_dict = sql.get_data(instruments)
+    with profiler.stage("sql_load_prices", "get_data") as record:
+        adjusted_prices_dict, current_prices_dict = sql.get_data(instruments)
+        profiler.record_output(record, adjusted_prices_dict)
 
-    carry_prices_dict = sql.get_carry_data(instruments)
+    with profiler.stage("sql_load_carry", "get_carry_data") as record:
+        carry_prices_dict = sql.get_carry_data(instruments)
+        profiler.record_output(record, carry_prices_dict)
 
     even_weights = 1 / len(all_instruments)
 
@@ -151,8 +229,19 @@ def main():
 
     capital = 500000
 
-    buffered_pos, pos = carry_forecast(all_instruments, weights, capital, risk_target_tau, multipliers, carry_spans, adjusted_prices_dict=adjusted_prices_dict,
-                                       current_prices_dict=current_prices_dict, carry_prices_dict=carry_prices_dict)
+    ## the IDM estimator is kept between runs, so each run only folds in the new weeks
+    idm_estimator_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_cache", IDM_ESTIMATOR_FILENAME)
+
+    buffered_pos, pos, capped_forecast, std_dev_dict = carry_forecast(all_instruments, weights, capital, risk_target_tau, multipliers, carry_spans, adjusted_prices_dict=adjusted_prices_dict,
+                                       current_prices_dict=current_prices_dict, carry_prices_dict=carry_prices_dict, profiler=profiler,
+                                       idm_estimator_filename=idm_estimator_filename, return_std_dev=True)
+
+    if profiler.enabled:
+        print("profile written to %s" % profiler.write_report())
+
+    ## keep the results on disk, so reporting can read them without rerunning
+    store = write_carry_forecast_results(buffered_pos, pos, capped_forecast, std_dev_dict)
+    print("results written to %s" % store.directory)
 
     for code in sorted(pos.keys()):
         print(code)
@@ -0,0 +1,818 @@
+import itertools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    from . import Carry
+    from . import carry_functions
+    from . import fx_functions
+    from . import idm_functions
+    from . import risk_functions
+    from . import sweep_functions
+    from . import get_carry_sql_functions as sql
+    from .panel_functions import panel_from_dict
+except ImportError:
+    import Carry
+    import carry_functions
+    import fx_functions
+    import idm_functions
+    import risk_functions
+    import sweep_functions
+    import get_carry_sql_functions as sql
+    from panel_functions import panel_from_dict
+
+BENCHMARK_CARRY_SPANS = [5, 20, 60, 120]
+BENCHMARK_RESULTS_FILENAME = "benchmark_results.jsonl"
+
+
+## Synthetic data, shaped like the output of get_data / get_carry_data
+## Each instrument holds a quarterly contract, rolling three weeks before expiry into the
+## next one, and the carry contract is the one after. Contract prices sit on a random
+## spot path discounted by a per instrument carry rate, so the current price jumps at each
+## roll while the back adjusted price doesn't. Optionally each instrument starts on its
+## own date, misses some dates altogether and has NaNs in its carry table
+
+ROLL_DAYS = 63
+DAYS_BEFORE_EXPIRY_AT_ROLL = 15
+
+
+def make_synthetic_data(
+    instrument_count: int = 40,
+    days: int = 2560,
+    seed: int = 0,
+    ragged_starts: bool = False,
+    gap_fraction: float = 0.0,
+    nan_fraction: float = 0.0,
+):
+
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range("1990-01-01", periods=days, name="Date")
+    instrument_list = ["SYN%d" % idx for idx in range(instrument_count)]
+
+    day = np.arange(days)
+    contract_count = day // ROLL_DAYS
+    year = 1990 + contract_count // 4
+    month = (contract_count % 4) * 3 + 3
+    carry_month = month + 3
+    carry_year = year + (carry_month > 12)
+    carry_month = np.where(carry_month > 12, carry_month - 12, carry_month)
+
+    ## trading days to expiry of the held contract, and of the next one along
+    days_to_expiry = (contract_count + 1) * ROLL_DAYS + DAYS_BEFORE_EXPIRY_AT_ROLL - day
+    carry_days_to_expiry = days_to_expiry + ROLL_DAYS
+
+    adjusted_prices = {}
+    current_prices = {}
+    carry_prices = {}
+    for instrument_code in instrument_list:
+        daily_vol = rng.uniform(0.005, 0.02)
+        carry_rate = rng.normal(0, 0.05)
+        spot_price = 100 * np.exp(np.cumsum(rng.normal(0, daily_vol, days)))
+
+        def contract_price(days_left):
+            return spot_price * np.exp(-carry_rate * days_left / 256)
+
+        current_price = contract_price(days_to_expiry)
+        carry_price = contract_price(carry_days_to_expiry)
+
+        ## back adjust: each day's change is the change in the contract held that day,
+        ## so the roll jumps drop out, then line up with the current price at the end
+        held_contract_yesterday = np.empty(days)
+        held_contract_yesterday[0] = current_price[0]
+        held_contract_yesterday[1:] = spot_price[:-1] * np.exp(
+            -carry_rate * (days_to_expiry[1:] + 1) / 256
+        )
+        adjusted_price = np.cumsum(current_price - held_contract_yesterday)
+        adjusted_price = adjusted_price - adjusted_price[-1] + current_price[-1]
+
+        keep = np.ones(days, dtype=bool)
+        if ragged_starts:
+            keep[: rng.integers(0, days // 2)] = False
+        if gap_fraction > 0:
+            keep &= rng.random(days) >= gap_fraction
+        keep[-1] = True
+
+        carry_price_with_nans = current_price.copy()
+        carry_with_nans = carry_price.copy()
+        if nan_fraction > 0:
+            carry_price_with_nans[rng.random(days) < nan_fraction] = np.nan
+            carry_with_nans[rng.random(days) < nan_fraction] = np.nan
+
+        instrument_index = index[keep]
+        adjusted_prices[instrument_code] = pd.Series(adjusted_price[keep], index=instrument_index)
+        current_prices[instrument_code] = pd.Series(current_price[keep], index=instrument_index)
+        carry_prices[instrument_code] = pd.DataFrame(
+            dict(
+                PRICE=carry_price_with_nans[keep],
+                CARRY=carry_with_nans[keep],
+                PRICE_CONTRACT=(year * 10000 + month * 100)[keep],
+                CARRY_CONTRACT=(carry_year * 10000 + carry_month * 100)[keep],
+            ),
+            index=instrument_index,
+        )
+
+    return adjusted_prices, current_prices, carry_prices
+
+
+## Regression benchmark: the capped forecast is built once per instrument per run
+## Counted where the work is done, in the carry_functions kernels every forecast goes
+## through, so a second forecast anywhere in carry_forecast shows up however it's reached
+
+def benchmark_carry_forecast_evaluations(
+    instrument_count: int = 40, days: int = 2560
+) -> dict:
+
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=instrument_count, days=days
+    )
+    instrument_list = list(adjusted_prices.keys())
+    weights = dict([(code, 1 / len(instrument_list)) for code in instrument_list])
+    multipliers = dict([(code, 1.0) for code in instrument_list])
+
+    evaluations = Counter()
+    ## the per instrument kernel only sees the carry table, so tell instruments apart by it
+    instrument_by_carry_table = dict(
+        [(id(carry_price), code) for code, carry_price in carry_prices.items()]
+    )
+    vol_adjusted_carry_panel = carry_functions.calculate_vol_adjusted_carry_panel
+    vol_adjusted_carry = carry_functions.calculate_vol_adjusted_carry
+
+    def counting_vol_adjusted_carry_panel(price, *args, **kwargs):
+        evaluations.update(list(price.columns))
+        return vol_adjusted_carry_panel(price, *args, **kwargs)
+
+    def counting_vol_adjusted_carry(stdev_ann_perc, carry_price):
+        evaluations.update([instrument_by_carry_table.get(id(carry_price), "unknown")])
+        return vol_adjusted_carry(stdev_ann_perc=stdev_ann_perc, carry_price=carry_price)
+
+    carry_functions.calculate_vol_adjusted_carry_panel = counting_vol_adjusted_carry_panel
+    carry_functions.calculate_vol_adjusted_carry = counting_vol_adjusted_carry
+    try:
+        start = time.perf_counter()
+        Carry.carry_forecast(
+            instrument_list,
+            weights,
+            500000,
+            0.2,
+            multipliers,
+            BENCHMARK_CARRY_SPANS,
+            adjusted_prices_dict=adjusted_prices,
+            current_prices_dict=current_prices,
+            carry_prices_dict=carry_prices,
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        carry_functions.calculate_vol_adjusted_carry_panel = vol_adjusted_carry_panel
+        carry_functions.calculate_vol_adjusted_carry = vol_adjusted_carry
+
+    repeated = dict(
+        [(code, count) for code, count in evaluations.items() if count != 1]
+    )
+    if repeated or len(evaluations) != len(instrument_list):
+        raise AssertionError(
+            "Forecast evaluated more than once per instrument: %s" % repeated
+        )
+
+    return dict(
+        instrument_count=instrument_count,
+        days=days,
+        seconds=elapsed,
+        forecast_evaluations=sum(evaluations.values()),
+    )
+
+
+## Buffering: the array kernel against the original per-date iloc loop
+
+def _apply_buffer_reference(
+    optimal_position: pd.Series, upper_buffer: pd.Series, lower_buffer: pd.Series
+) -> pd.Series:
+
+    upper_buffer = upper_buffer.ffill().round()
+    lower_buffer = lower_buffer.ffill().round()
+    use_optimal_position = optimal_position.ffill()
+
+    current_position = use_optimal_position.iloc[0]
+    if np.isnan(current_position):
+        current_position = 0.0
+
+    buffered_position_list = [current_position]
+
+    for idx in range(len(optimal_position.index))[1:]:
+        current_position = carry_functions.apply_buffer_single_period(
+            last_position=current_position,
+            top_pos=upper_buffer.iloc[idx],
+            bot_pos=lower_buffer.iloc[idx],
+        )
+
+        buffered_position_list.append(current_position)
+
+    return pd.Series(buffered_position_list, index=optimal_position.index)
+
+
+def benchmark_apply_buffer(instrument_count: int = 40, days: int = 7680, seed: int = 0) -> dict:
+
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range("1990-01-01", periods=days, name="Date")
+    columns = ["SYN%d" % idx for idx in range(instrument_count)]
+    average_position = pd.DataFrame(
+        rng.uniform(5, 50, (days, instrument_count)), index=index, columns=columns
+    )
+    forecast = pd.DataFrame(
+        np.cumsum(rng.normal(0, 1, (days, instrument_count)), axis=0).clip(-20, 20),
+        index=index,
+        columns=columns,
+    )
+    position = forecast * average_position / 10
+    position.iloc[:10] = np.nan
+
+    buffer = average_position.abs() * 0.10
+    upper_buffer = position + buffer
+    lower_buffer = position - buffer
+
+    ## run once untimed so a JIT compile isn't charged to the kernel
+    carry_functions.apply_buffer(position.iloc[:5], upper_buffer.iloc[:5], lower_buffer.iloc[:5])
+
+    start = time.perf_counter()
+    reference = dict(
+        [
+            (
+                code,
+                _apply_buffer_reference(position[code], upper_buffer[code], lower_buffer[code]),
+            )
+            for code in columns
+        ]
+    )
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buffered_position = carry_functions.apply_buffer(position, upper_buffer, lower_buffer)
+    kernel_seconds = time.perf_counter() - start
+
+    for code in columns:
+        if not np.array_equal(
+            reference[code].to_numpy(), buffered_position[code].to_numpy(), equal_nan=True
+        ):
+            raise AssertionError("Buffered position differs from reference for %s" % code)
+
+    return dict(
+        instrument_count=instrument_count,
+        days=days,
+        kernel=carry_functions.apply_buffer_kernel.__name__,
+        reference_seconds=reference_seconds,
+        kernel_seconds=kernel_seconds,
+        speedup=reference_seconds / kernel_seconds,
+    )
+
+
+## Ten year vol: the batched rolling mean kernel against one pandas rolling call per instrument
+
+def benchmark_rolling_mean(instrument_count: int = 40, years: int = 40, seed: int = 0) -> dict:
+
+    rng = np.random.default_rng(seed)
+    days = years * risk_functions.BUSINESS_DAYS_IN_YEAR
+    window = risk_functions.BUSINESS_DAYS_IN_YEAR * 10
+    annualised_std_dev = np.abs(rng.normal(0.2, 0.05, (days, instrument_count)))
+    ## ragged start dates, as in the real universe
+    for instrument_idx in range(instrument_count):
+        annualised_std_dev[: rng.integers(0, days // 2), instrument_idx] = np.nan
+
+    ## run once untimed so a JIT compile isn't charged to the kernel
+    risk_functions.calculate_rolling_mean(annualised_std_dev[:10], window)
+
+    start = time.perf_counter()
+    reference = [
+        pd.Series(annualised_std_dev[:, instrument_idx]).rolling(window, min_periods=1).mean()
+        for instrument_idx in range(instrument_count)
+    ]
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rolling_mean = risk_functions.calculate_rolling_mean(annualised_std_dev, window)
+    kernel_seconds = time.perf_counter() - start
+
+    if not np.allclose(
+        np.column_stack(reference), rolling_mean, rtol=1e-12, atol=0, equal_nan=True
+    ):
+        raise AssertionError("Rolling mean differs from pandas")
+
+    return dict(
+        instrument_count=instrument_count,
+        days=days,
+        kernel=risk_functions.rolling_mean_kernel.__name__,
+        reference_seconds=reference_seconds,
+        kernel_seconds=kernel_seconds,
+        speedup=reference_seconds / kernel_seconds,
+    )
+
+
+## Vol: the batched panel estimate against one standardDeviation per instrument
+
+def benchmark_standard_deviation(instrument_count: int = 40, days: int = 10240, seed: int = 0) -> dict:
+
+    adjusted_prices, current_prices, _ = make_synthetic_data(
+        instrument_count=instrument_count, days=days, seed=seed
+    )
+    ## ragged start dates, as in the real universe
+    rng = np.random.default_rng(seed)
+    for instrument_code in adjusted_prices.keys():
+        start = rng.integers(0, days // 2)
+        adjusted_prices[instrument_code] = adjusted_prices[instrument_code].iloc[start:]
+        current_prices[instrument_code] = current_prices[instrument_code].iloc[start:]
+
+    ## run once untimed so a JIT compile isn't charged to the kernel
+    risk_functions.calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices, current_prices
+    )
+
+    start = time.perf_counter()
+    reference = dict(
+        [
+            (
+                instrument_code,
+                risk_functions.calculate_variable_standard_deviation_for_risk_targeting(
+                    adjusted_price=adjusted_prices[instrument_code],
+                    current_price=current_prices[instrument_code],
+                ),
+            )
+            for instrument_code in adjusted_prices.keys()
+        ]
+    )
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    std_dev_dict = risk_functions.calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices, current_prices
+    )
+    kernel_seconds = time.perf_counter() - start
+
+    for instrument_code, std_dev in std_dev_dict.items():
+        if not std_dev.index.equals(reference[instrument_code].index) or not np.allclose(
+            reference[instrument_code].to_numpy(),
+            std_dev.values,
+            rtol=1e-12,
+            atol=0,
+            equal_nan=True,
+        ):
+            raise AssertionError("Standard deviation differs from reference for %s" % instrument_code)
+
+    return dict(
+        instrument_count=instrument_count,
+        days=days,
+        kernel=risk_functions.variable_standard_deviation_kernel.__name__,
+        reference_seconds=reference_seconds,
+        kernel_seconds=kernel_seconds,
+        speedup=reference_seconds / kernel_seconds,
+    )
+
+
+## Parameter sweep: the shared memory runner against one carry_forecast call per grid point
+
+def benchmark_carry_forecast_sweep(
+    instrument_count: int = 40, days: int = 2560, max_workers: int = None
+) -> dict:
+
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=instrument_count, days=days
+    )
+    instrument_list = list(adjusted_prices.keys())
+    weights = dict([(code, 1 / len(instrument_list)) for code in instrument_list])
+    multipliers = dict([(code, 1.0) for code in instrument_list])
+    capital_list = [250000, 500000]
+    risk_target_tau_list = [0.1, 0.2, 0.3]
+    carry_spans_list = [[5], [5, 20], [5, 20, 60], BENCHMARK_CARRY_SPANS]
+
+    start = time.perf_counter()
+    for capital, risk_target_tau, carry_spans in itertools.product(
+        capital_list, risk_target_tau_list, carry_spans_list
+    ):
+        Carry.carry_forecast(
+            instrument_list,
+            weights,
+            capital,
+            risk_target_tau,
+            multipliers,
+            carry_spans,
+            adjusted_prices_dict=adjusted_prices,
+            current_prices_dict=current_prices,
+            carry_prices_dict=carry_prices,
+        )
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sweep_results = sweep_functions.run_carry_forecast_sweep(
+        instrument_list,
+        weights,
+        multipliers,
+        capital_list=capital_list,
+        risk_target_tau_list=risk_target_tau_list,
+        carry_spans_list=carry_spans_list,
+        adjusted_prices_dict=adjusted_prices,
+        current_prices_dict=current_prices,
+        carry_prices_dict=carry_prices,
+        max_workers=max_workers,
+    )
+    sweep_seconds = time.perf_counter() - start
+
+    return dict(
+        instrument_count=instrument_count,
+        days=days,
+        grid_points=len(capital_list) * len(risk_target_tau_list) * len(carry_spans_list),
+        rows=len(sweep_results),
+        reference_seconds=reference_seconds,
+        sweep_seconds=sweep_seconds,
+        speedup=reference_seconds / sweep_seconds,
+    )
+
+
+## SQL load memory: SELECT * into full frames against the streamed, compacted loader
+## run against a SQLite stand-in built from the synthetic data
+
+def make_synthetic_sql_database(
+    directory: str, instrument_count: int = 40, days: int = 2560, seed: int = 0
+) -> dict:
+
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=instrument_count, days=days, seed=seed
+    )
+    database_urls = dict(
+        [
+            (sql.PRICE_DATABASE, "sqlite:///%s" % os.path.join(directory, "prices.db")),
+            (sql.CARRY_DATABASE, "sqlite:///%s" % os.path.join(directory, "carry.db")),
+        ]
+    )
+    data_access = sql.configure_data_access(database_urls=database_urls)
+
+    for instrument_code in adjusted_prices.keys():
+        adjusted_price = adjusted_prices[instrument_code]
+        price_table = pd.DataFrame(
+            dict(
+                Open=adjusted_price,
+                High=adjusted_price,
+                Low=adjusted_price,
+                Close=adjusted_price,
+                Unadj_Close=current_prices[instrument_code],
+                Volume=1000,
+            )
+        ).reset_index()
+        price_table.to_sql(
+            instrument_code + sql.PRICE_TABLE_SUFFIX,
+            data_access.engine(sql.PRICE_DATABASE),
+            index=False,
+        )
+
+        carry_table = carry_prices[instrument_code].reset_index()
+        carry_table.columns = ["Date", "Price", "Carry", "Price_Contract", "Carry_Contract"]
+        carry_table.to_sql(
+            instrument_code + sql.CARRY_TABLE_SUFFIX,
+            data_access.engine(sql.CARRY_DATABASE),
+            index=False,
+        )
+
+    return database_urls
+
+
+def benchmark_sql_load_memory(instrument_count: int = 40, days: int = 10240) -> dict:
+
+    def peak_memory_mb(load_function) -> float:
+        tracemalloc.start()
+        try:
+            load_function()
+            return tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+
+    def load_select_star():
+        dataframes = sql.get_tables(instruments, sql.PRICE_DATABASE, sql.PRICE_TABLE_SUFFIX)
+        carry_data = sql.get_tables(instruments, sql.CARRY_DATABASE, sql.CARRY_TABLE_SUFFIX)
+        return sql.prices_from_tables(dataframes), sql.carry_from_tables(carry_data)
+
+    def load_compact(float_dtype: str):
+        return (
+            sql.get_data(instruments, float_dtype=float_dtype),
+            sql.get_carry_data(instruments, float_dtype=float_dtype),
+        )
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_urls = make_synthetic_sql_database(
+            directory, instrument_count=instrument_count, days=days
+        )
+        instruments = ["SYN%d" % idx for idx in range(instrument_count)]
+        try:
+            results = dict(
+                instrument_count=instrument_count,
+                days=days,
+                select_star_peak_mb=peak_memory_mb(load_select_star),
+                compact_float64_peak_mb=peak_memory_mb(lambda: load_compact("float64")),
+                compact_float32_peak_mb=peak_memory_mb(lambda: load_compact("float32")),
+            )
+        finally:
+            sql.get_data_access().dispose()
+            sql.configure_data_access()
+
+    return results
+
+
+## Function suite: every stage of the pipeline timed on the same synthetic universe,
+## with ragged starts, missing dates and NaNs, plus the end to end carry_forecast.
+## Each run is appended to a JSON lines file so runs can be compared over time
+
+def benchmark_pipeline_functions(
+    instrument_count: int = 40, days: int = 2560, repeats: int = 3, seed: int = 0
+) -> pd.DataFrame:
+
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=instrument_count,
+        days=days,
+        seed=seed,
+        ragged_starts=True,
+        gap_fraction=0.03,
+        nan_fraction=0.02,
+    )
+    instrument_list = list(adjusted_prices.keys())
+    weights = dict([(code, 1 / len(instrument_list)) for code in instrument_list])
+    multipliers = dict([(code, 1.0) for code in instrument_list])
+
+    ## the inputs each stage takes, built once by the stage before it
+    fx_series_dict = fx_functions.create_fx_series_given_adjusted_prices_dict(adjusted_prices)
+    idm = Carry.estimate_idm_series(instrument_list, adjusted_prices, current_prices, weights)
+    std_dev_dict = risk_functions.calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices, current_prices
+    )
+    average_position_dict = risk_functions.calculate_position_series_given_variable_risk_for_dict(
+        capital=500000,
+        risk_target_tau=0.2,
+        idm=idm,
+        weights=weights,
+        std_dev_dict=std_dev_dict,
+        fx_series_dict=fx_series_dict,
+        multipliers=multipliers,
+    )
+    capped_forecast_dict, fdm_series = carry_functions.calculate_capped_forecast(
+        adjusted_prices_dict=adjusted_prices,
+        std_dev_dict=std_dev_dict,
+        carry_prices_dict=carry_prices,
+        carry_spans=BENCHMARK_CARRY_SPANS,
+        return_fdm=True,
+    )
+    position_dict = carry_functions.calculate_position_dict_given_capped_forecast(
+        capped_forecast_dict=capped_forecast_dict,
+        average_position_contracts_dict=average_position_dict,
+    )
+    returns = panel_from_dict(
+        dict(
+            [
+                (code, risk_functions.calculate_percentage_returns(adjusted_prices[code], current_prices[code]))
+                for code in instrument_list
+            ]
+        ),
+        instrument_list,
+    ).to_numpy()
+    annualised_std_dev = risk_functions.calculate_ewm_std(returns, risk_functions.VOL_EWM_SPAN) * (
+        risk_functions.BUSINESS_DAYS_IN_YEAR ** 0.5
+    )
+
+    ## per instrument functions are timed across the whole universe, one call each
+    function_list = [
+        (
+            fx_functions,
+            "create_fx_series_given_adjusted_prices_dict",
+            lambda: fx_functions.create_fx_series_given_adjusted_prices_dict(adjusted_prices),
+        ),
+        (
+            fx_functions,
+            "create_fx_series_given_adjusted_prices",
+            lambda: [
+                fx_functions.create_fx_series_given_adjusted_prices(code, adjusted_prices[code])
+                for code in instrument_list
+            ],
+        ),
+        (
+            risk_functions,
+            "calculate_variable_standard_deviation_for_risk_targeting_from_dict",
+            lambda: risk_functions.calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+                adjusted_prices, current_prices
+            ),
+        ),
+        (
+            risk_functions,
+            "calculate_variable_standard_deviation_for_risk_targeting",
+            lambda: [
+                risk_functions.calculate_variable_standard_deviation_for_risk_targeting(
+                    adjusted_price=adjusted_prices[code], current_price=current_prices[code]
+                )
+                for code in instrument_list
+            ],
+        ),
+        (
+            risk_functions,
+            "calculate_ewm_std",
+            lambda: risk_functions.calculate_ewm_std(returns, risk_functions.VOL_EWM_SPAN),
+        ),
+        (
+            risk_functions,
+            "calculate_rolling_mean",
+            lambda: risk_functions.calculate_rolling_mean(
+                annualised_std_dev, risk_functions.TEN_YEAR_VOL_WINDOW
+            ),
+        ),
+        (
+            risk_functions,
+            "calculate_position_series_given_variable_risk_for_dict",
+            lambda: risk_functions.calculate_position_series_given_variable_risk_for_dict(
+                capital=500000,
+                risk_target_tau=0.2,
+                idm=idm,
+                weights=weights,
+                std_dev_dict=std_dev_dict,
+                fx_series_dict=fx_series_dict,
+                multipliers=multipliers,
+            ),
+        ),
+        (
+            idm_functions,
+            "calculate_idm_series",
+            lambda: idm_functions.calculate_idm_series(adjusted_prices, current_prices, weights),
+        ),
+        (
+            carry_functions,
+            "calculate_annualised_carry",
+            lambda: [
+                carry_functions.calculate_annualised_carry(carry_prices[code])
+                for code in instrument_list
+            ],
+        ),
+        (
+            carry_functions,
+            "calculate_combined_carry_forecast",
+            lambda: [
+                carry_functions.calculate_combined_carry_forecast(
+                    stdev_ann_perc=std_dev_dict[code],
+                    carry_price=carry_prices[code],
+                    carry_spans=BENCHMARK_CARRY_SPANS,
+                    fdm=fdm_series,
+                )
+                for code in instrument_list
+            ],
+        ),
+        (
+            carry_functions,
+            "calculate_capped_forecast",
+            lambda: carry_functions.calculate_capped_forecast(
+                adjusted_prices_dict=adjusted_prices,
+                std_dev_dict=std_dev_dict,
+                carry_prices_dict=carry_prices,
+                carry_spans=BENCHMARK_CARRY_SPANS,
+            ),
+        ),
+        (
+            carry_functions,
+            "calculate_position_dict_given_capped_forecast",
+            lambda: carry_functions.calculate_position_dict_given_capped_forecast(
+                capped_forecast_dict=capped_forecast_dict,
+                average_position_contracts_dict=average_position_dict,
+            ),
+        ),
+        (
+            carry_functions,
+            "apply_buffering_to_position_dict",
+            lambda: carry_functions.apply_buffering_to_position_dict(
+                position_contracts_dict=position_dict,
+                average_position_contracts_dict=average_position_dict,
+            ),
+        ),
+        (
+            Carry,
+            "carry_forecast",
+            lambda: Carry.carry_forecast(
+                instrument_list,
+                weights,
+                500000,
+                0.2,
+                multipliers,
+                BENCHMARK_CARRY_SPANS,
+                adjusted_prices_dict=adjusted_prices,
+                current_prices_dict=current_prices,
+                carry_prices_dict=carry_prices,
+            ),
+        ),
+    ]
+
+    results = [
+        dict(
+            module=module.__name__.split(".")[-1],
+            function=function_name,
+            instrument_count=instrument_count,
+            days=days,
+            seconds=_best_of(function, repeats),
+        )
+        for module, function_name, function in function_list
+    ]
+
+    return pd.DataFrame(results)
+
+
+def run_benchmark_suite(
+    instrument_count_list: list = (10, 40),
+    days_list: list = (2560, 10240),
+    repeats: int = 3,
+    results_filename: str = BENCHMARK_RESULTS_FILENAME,
+) -> pd.DataFrame:
+
+    run_results = pd.concat(
+        [
+            benchmark_pipeline_functions(
+                instrument_count=instrument_count, days=days, repeats=repeats
+            )
+            for instrument_count, days in itertools.product(instrument_count_list, days_list)
+        ],
+        ignore_index=True,
+    )
+    run_results.insert(0, "run", datetime.now().isoformat(timespec="milliseconds"))
+    run_results.insert(1, "commit", _git_commit())
+    run_results.insert(2, "python", platform.python_version())
+
+    if results_filename is not None:
+        with open(results_filename, "a") as results_file:
+            for record in run_results.to_dict(orient="records"):
+                results_file.write(json.dumps(record) + "\n")
+
+    return run_results
+
+
+def compare_benchmark_runs(
+    results_filename: str = BENCHMARK_RESULTS_FILENAME, baseline_run: str = None
+) -> pd.DataFrame:
+
+    ## the latest run against baseline_run, by default the run before it;
+    ## ratio above 1 means the latest run is slower
+    all_results = pd.read_json(results_filename, lines=True, dtype=dict(run=str))
+    run_list = list(dict.fromkeys(all_results.run))
+    if len(run_list) < 2:
+        raise ValueError("Need at least two runs in %s to compare" % results_filename)
+
+    latest_run = run_list[-1]
+    if baseline_run is None:
+        baseline_run = run_list[-2]
+
+    keys = ["module", "function", "instrument_count", "days"]
+    latest = all_results[all_results.run == latest_run].set_index(keys).seconds
+    baseline = all_results[all_results.run == baseline_run].set_index(keys).seconds
+
+    comparison = pd.DataFrame(dict(baseline_seconds=baseline, latest_seconds=latest))
+    comparison["ratio"] = comparison.latest_seconds / comparison.baseline_seconds
+
+    return comparison
+
+
+def _best_of(function, repeats: int) -> float:
+
+    ## run once untimed so a JIT compile or a cold cache isn't charged, then keep the best
+    function()
+    seconds_list = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds_list.append(time.perf_counter() - start)
+
+    return min(seconds_list)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    print(benchmark_carry_forecast_evaluations())
+    print(benchmark_apply_buffer())
+    print(benchmark_rolling_mean())
+    print(benchmark_standard_deviation())
+    print(benchmark_carry_forecast_sweep())
+    print(benchmark_sql_load_memory())
+
+    run_benchmark_suite()
+    try:
+        print(compare_benchmark_runs())
+    except ValueError as error:
+        print(error)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import importlib.util
+import json
+import os
+
+import pandas as pd
+
+try:
+    from . import get_carry_sql_functions as sql
+except ImportError:
+    import get_carry_sql_functions as sql
+
+## next to this module, so it doesn't matter which directory it's run from
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_cache")
+MANIFEST_FILENAME = "manifest.json"
+
+PRICE_TABLES = "price"
+CARRY_TABLES = "carry"
+TABLE_SOURCES = {
+    PRICE_TABLES: (sql.PRICE_DATABASE, sql.PRICE_TABLE_SUFFIX, sql.PRICE_COLUMNS),
+    CARRY_TABLES: (sql.CARRY_DATABASE, sql.CARRY_TABLE_SUFFIX, sql.CARRY_COLUMNS),
+}
+
+## Parquet needs pyarrow, fall back to pickle so the cache still works without it.
+## Only looked up here; pandas imports pyarrow itself when a parquet file is read
+CACHE_FORMAT = "parquet" if importlib.util.find_spec("pyarrow") is not None else "pickle"
+
+## Local cache of the SQL tables
+## One file per instrument and table type, plus a manifest recording the last date
+## stored, so a refresh only pulls rows after it. offline=True never touches the database
+
+def get_data(
+    instrument_list: list,
+    cache_directory: str = DEFAULT_CACHE_DIRECTORY,
+    offline: bool = False,
+):
+    dataframes = get_cached_tables(
+        instrument_list, PRICE_TABLES, cache_directory=cache_directory, offline=offline
+    )
+
+    return sql.prices_from_tables(dataframes)
+
+def get_carry_data(
+    instrument_list: list,
+    cache_directory: str = DEFAULT_CACHE_DIRECTORY,
+    offline: bool = False,
+) -> dict:
+    carry_data = get_cached_tables(
+        instrument_list, CARRY_TABLES, cache_directory=cache_directory, offline=offline
+    )
+
+    return sql.carry_from_tables(carry_data)
+
+def get_cached_tables(
+    instrument_list: list,
+    table_type: str,
+    cache_directory: str = DEFAULT_CACHE_DIRECTORY,
+    offline: bool = False,
+) -> dict:
+
+    manifest = load_manifest(cache_directory)
+    entries = manifest.setdefault(table_type, {})
+
+    dataframes = dict(
+        [
+            (name, _read_cache_file(cache_directory, entries[name]["file"]))
+            for name in instrument_list
+            if name in entries
+        ]
+    )
+
+    if offline:
+        missing = [name for name in instrument_list if name not in dataframes]
+        if len(missing) > 0:
+            print("Not in cache, skipping: %s" % sorted(missing))
+        return dataframes
+
+    database, table_suffix, columns = TABLE_SOURCES[table_type]
+    after_dates = dict(
+        [
+            (name, entries[name]["last_date"])
+            for name in dataframes.keys()
+            if entries[name]["last_date"] is not None
+        ]
+    )
+    new_dataframes = sql.get_tables_batched(
+        instrument_list, database, table_suffix, columns, after_dates=after_dates
+    )
+    if new_dataframes is None:
+        ## database unreachable, serve whatever we have
+        return dataframes
+
+    for name, new_data in new_dataframes.items():
+        if name in dataframes:
+            ## the database decides what "after" means for its own date type, so drop
+            ## anything we already hold rather than append the last cached day again
+            cached = dataframes[name]
+            if len(cached) > 0:
+                new_data = new_data[new_data.index > cached.index.max()]
+            if len(new_data) == 0:
+                continue
+            new_data = pd.concat([cached, new_data])
+
+        dataframes[name] = new_data
+        entries[name] = _write_cache_file(cache_directory, table_type, name, new_data)
+
+    save_manifest(manifest, cache_directory)
+
+    return dataframes
+
+def load_manifest(cache_directory: str = DEFAULT_CACHE_DIRECTORY) -> dict:
+    filename = os.path.join(cache_directory, MANIFEST_FILENAME)
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename) as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(manifest: dict, cache_directory: str = DEFAULT_CACHE_DIRECTORY):
+    os.makedirs(cache_directory, exist_ok=True)
+    filename = os.path.join(cache_directory, MANIFEST_FILENAME)
+
+    ## write then rename, so a crash never leaves a half written manifest
+    with open(filename + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+def _write_cache_file(
+    cache_directory: str, table_type: str, name: str, data: pd.DataFrame
+) -> dict:
+
+    os.makedirs(cache_directory, exist_ok=True)
+    filename = "%s_%s.%s" % (table_type, name, CACHE_FORMAT)
+    if CACHE_FORMAT == "parquet":
+        data.to_parquet(os.path.join(cache_directory, filename))
+    else:
+        data.to_pickle(os.path.join(cache_directory, filename))
+
+    last_date = data.index.max()
+    return dict(
+        file=filename,
+        rows=len(data),
+        last_date=None if pd.isnull(last_date) else last_date.strftime(sql.DEFAULT_DATE_FORMAT),
+    )
+
+def _read_cache_file(cache_directory: str, filename: str) -> pd.DataFrame:
+    if filename.endswith(".parquet"):
+        return pd.read_parquet(os.path.join(cache_directory, filename))
+
+    return pd.read_pickle(os.path.join(cache_directory, filename))
@@ -0,0 +1,227 @@
+import time
+
+_process_start = time.perf_counter()
+
+import argparse
+import importlib
+import importlib.util
+import os
+
+DEFAULT_CAPITAL = 500000
+DEFAULT_RISK_TARGET_TAU = 0.2
+DEFAULT_CARRY_SPANS = [5, 20, 60, 120]
+
+SOURCE_CACHE = "cache"
+SOURCE_OFFLINE = "offline"
+SOURCE_SQL = "sql"
+
+## Command line entry point for the carry pipeline, eg from cron:
+##   python carry_cli.py --source offline --import-report
+## Nothing heavy is imported until the arguments are parsed. Then each module group is
+## imported on its own and timed, so --import-report can show where startup goes.
+## The database stack is only imported when rows come from SQL:
+##   cache    top the local cache up from SQL, then run from it (the default)
+##   offline  run from the local cache alone, sqlalchemy is never imported
+##   sql      read straight from SQL, as Carry.main does
+
+_import_times = []
+
+
+def main(argv: list = None):
+    arguments = _parse_arguments(argv)
+
+    timed_import("numpy")
+    timed_import("pandas")
+    if importlib.util.find_spec("numba") is not None:
+        timed_import("numba")
+    carry = timed_import("Carry")
+    registry = timed_import("instrument_registry_functions").get_instrument_registry()
+    if arguments.source != SOURCE_OFFLINE and importlib.util.find_spec("sqlalchemy") is not None:
+        timed_import("sqlalchemy")
+    if arguments.source == SOURCE_SQL:
+        data_source = timed_import("get_carry_sql_functions")
+    else:
+        data_source = timed_import("cache_functions")
+
+    if arguments.cache_directory is None:
+        ## filled in here rather than in the parser, which runs before anything is imported
+        arguments.cache_directory = _import_module("cache_functions").DEFAULT_CACHE_DIRECTORY
+
+    instrument_list = (
+        registry.data_symbols() if arguments.instruments is None else arguments.instruments
+    )
+    load_start = time.perf_counter()
+    adjusted_prices_dict, current_prices_dict, carry_prices_dict = load_data(
+        data_source, instrument_list, arguments.source, arguments.cache_directory
+    )
+    load_seconds = time.perf_counter() - load_start
+
+    ## only what we have data for, weighted evenly
+    instrument_list = [
+        instrument_code
+        for instrument_code in instrument_list
+        if instrument_code in adjusted_prices_dict and instrument_code in carry_prices_dict
+    ]
+    if len(instrument_list) == 0:
+        print("No data for any instrument, nothing to do")
+        return
+    weights = dict(
+        [(instrument_code, 1 / len(instrument_list)) for instrument_code in instrument_list]
+    )
+
+    ## the IDM estimator lives with the cache, so each run only folds in the new weeks
+    idm_estimator_filename = os.path.join(
+        arguments.cache_directory, _import_module("idm_functions").IDM_ESTIMATOR_FILENAME
+    )
+
+    forecast_start = time.perf_counter()
+    buffered_position_dict, position_dict, capped_forecast_dict, std_dev_dict = carry.carry_forecast(
+        instrument_list,
+        weights,
+        arguments.capital,
+        arguments.risk_target_tau,
+        registry.multiplier_dict(),
+        arguments.carry_spans,
+        adjusted_prices_dict=dict([(code, adjusted_prices_dict[code]) for code in instrument_list]),
+        current_prices_dict=dict([(code, current_prices_dict[code]) for code in instrument_list]),
+        carry_prices_dict=dict([(code, carry_prices_dict[code]) for code in instrument_list]),
+        idm_estimator_filename=idm_estimator_filename,
+        return_std_dev=True,
+    )
+    first_forecast_seconds = time.perf_counter() - _process_start
+    forecast_seconds = time.perf_counter() - forecast_start
+
+    print(
+        latest_values_frame(
+            buffered_position_dict, position_dict, capped_forecast_dict
+        ).to_string()
+    )
+
+    if arguments.import_report:
+        print(import_report())
+        print("data load %.3fs, forecast %.3fs" % (load_seconds, forecast_seconds))
+        print("process start to first forecast %.3fs" % first_forecast_seconds)
+
+    profiler = _import_module("profile_functions").get_profiler()
+    if profiler.enabled:
+        print("profile written to %s" % profiler.write_report())
+
+    if arguments.store:
+        series_store_functions = _import_module("series_store_functions")
+        store = series_store_functions.write_carry_forecast_results(
+            buffered_position_dict,
+            position_dict,
+            capped_forecast_dict,
+            std_dev_dict,
+            directory=(
+                series_store_functions.DEFAULT_SERIES_STORE_DIRECTORY
+                if arguments.store_directory is None
+                else arguments.store_directory
+            ),
+        )
+        print("results written to %s" % store.directory)
+
+
+def load_data(data_source, instrument_list: list, source: str, cache_directory: str) -> tuple:
+
+    ## data_source is get_carry_sql_functions or cache_functions, which share get_data
+    ## and get_carry_data
+    if source == SOURCE_SQL:
+        adjusted_prices_dict, current_prices_dict = data_source.get_data(instrument_list)
+        carry_prices_dict = data_source.get_carry_data(instrument_list)
+    else:
+        offline = source == SOURCE_OFFLINE
+        adjusted_prices_dict, current_prices_dict = data_source.get_data(
+            instrument_list, cache_directory=cache_directory, offline=offline
+        )
+        carry_prices_dict = data_source.get_carry_data(
+            instrument_list, cache_directory=cache_directory, offline=offline
+        )
+
+    return adjusted_prices_dict, current_prices_dict, carry_prices_dict
+
+
+def latest_values_frame(
+    buffered_position_dict: dict, position_dict: dict, capped_forecast_dict: dict
+):
+    import pandas as pd
+
+    def _last(series_dict: dict) -> dict:
+        return dict(
+            [
+                (instrument_code, series.iloc[-1] if len(series) > 0 else float("nan"))
+                for instrument_code, series in series_dict.items()
+            ]
+        )
+
+    return pd.DataFrame(
+        dict(
+            capped_forecast=_last(capped_forecast_dict),
+            position=_last(position_dict),
+            buffered_position=_last(buffered_position_dict),
+        )
+    ).sort_index()
+
+
+def timed_import(module_name: str):
+
+    ## the time is whatever the import pulls in that isn't loaded already, so import
+    ## the big dependencies first to keep them out of the pipeline's figure
+    start = time.perf_counter()
+    module = _import_module(module_name)
+    _import_times.append((module_name, time.perf_counter() - start))
+
+    return module
+
+
+def import_report() -> str:
+    lines = ["import %-32s %.3fs" % (module_name, seconds) for module_name, seconds in _import_times]
+    lines.append("import %-32s %.3fs" % ("total", sum([seconds for _, seconds in _import_times])))
+
+    return "\n".join(lines)
+
+
+def _parse_arguments(argv: list = None):
+    parser = argparse.ArgumentParser(description="Carry forecasts and positions")
+    parser.add_argument(
+        "--source",
+        choices=[SOURCE_CACHE, SOURCE_OFFLINE, SOURCE_SQL],
+        default=SOURCE_CACHE,
+        help="where the prices come from",
+    )
+    parser.add_argument(
+        "--cache-directory",
+        default=None,
+        help="default cache_functions.DEFAULT_CACHE_DIRECTORY, next to the code",
+    )
+    parser.add_argument(
+        "--instruments", nargs="+", default=None, help="data symbols, default all in Symbols.csv"
+    )
+    parser.add_argument("--capital", type=float, default=DEFAULT_CAPITAL)
+    parser.add_argument("--risk-target-tau", type=float, default=DEFAULT_RISK_TARGET_TAU)
+    parser.add_argument("--carry-spans", type=int, nargs="+", default=DEFAULT_CARRY_SPANS)
+    parser.add_argument(
+        "--store-directory",
+        default=None,
+        help="where to keep the results, default series_store_functions.DEFAULT_SERIES_STORE_DIRECTORY",
+    )
+    parser.add_argument("--no-store", dest="store", action="store_false")
+    parser.add_argument(
+        "--import-report", action="store_true", help="print the time spent importing each module"
+    )
+
+    return parser.parse_args(argv)
+
+
+def _import_module(module_name: str):
+
+    ## our own modules relative to the package when there is one, as the rest of the
+    ## code imports them
+    if __package__ and importlib.util.find_spec(module_name) is None:
+        return importlib.import_module("." + module_name, __package__)
+
+    return importlib.import_module(module_name)
+
+
+if __name__ == "__main__":
+    main()
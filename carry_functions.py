@@ -3,8 +3,16 @@ import numpy as np
 
 try:
     from .risk_functions import standardDeviation
+    from .panel_functions import panel_from_dict, presence_from_index_dict, dict_from_panel
+    from .panel_functions import union_of_indices, apply_to_own_rows
+    from .fdm_functions import estimate_fdm_series, normalised_forecast_weights
+    from .roll_calendar_functions import contract_year_frac_difference
 except ImportError:
     from risk_functions import standardDeviation
+    from panel_functions import panel_from_dict, presence_from_index_dict, dict_from_panel
+    from panel_functions import union_of_indices, apply_to_own_rows
+    from fdm_functions import estimate_fdm_series, normalised_forecast_weights
+    from roll_calendar_functions import contract_year_frac_difference
 
 
 def calculate_capped_forecast(
@@ -12,24 +20,65 @@ def calculate_capped_forecast(
     std_dev_dict: dict,
     carry_prices_dict: dict,
     carry_spans: list,
-) -> dict:
+    forecast_weights: list = None,
+    fdm=None,
+    return_fdm: bool = False,
+):
 
+    ## fdm: None to estimate it from the forecasts, a float, or a series by date.
+    ## return_fdm=True also returns the FDM used on each date
     list_of_instruments = list(adjusted_prices_dict.keys())
-    capped_forecast_dict = dict(
+
+    ann_price_vol_dict = dict(
         [
-            (
-                instrument_code,
-                calculate_combined_carry_forecast(
-                    stdev_ann_perc=std_dev_dict[instrument_code],
-                    carry_price=carry_prices_dict[instrument_code],
-                    carry_spans=carry_spans,
-                ),
-            )
+            (instrument_code, std_dev_dict[instrument_code].annual_risk_price_terms())
             for instrument_code in list_of_instruments
         ]
     )
 
-    return capped_forecast_dict 
+    ## rows each instrument actually has, so the panel doesn't smooth over other calendars;
+    ## carry and vol keep their own calendars too, as they would on the instrument's own
+    carry_index_dict = dict(
+        [
+            (instrument_code, carry_prices_dict[instrument_code].index)
+            for instrument_code in list_of_instruments
+        ]
+    )
+    vol_index_dict = dict(
+        [
+            (instrument_code, ann_price_vol_dict[instrument_code].index)
+            for instrument_code in list_of_instruments
+        ]
+    )
+    index = union_of_indices(list(carry_index_dict.values()) + list(vol_index_dict.values()))
+    carry_present = presence_from_index_dict(carry_index_dict, list_of_instruments, index)
+    vol_present = presence_from_index_dict(vol_index_dict, list_of_instruments, index)
+    present = carry_present | vol_present
+
+    carry_panel = panel_from_dict(carry_prices_dict, list_of_instruments).reindex(index)
+    capped_forecast = calculate_capped_forecast_panel(
+        price=carry_panel.xs("PRICE", axis=1, level=1),
+        carry=carry_panel.xs("CARRY", axis=1, level=1),
+        price_contract=carry_panel.xs("PRICE_CONTRACT", axis=1, level=1),
+        carry_contract=carry_panel.xs("CARRY_CONTRACT", axis=1, level=1),
+        ann_price_vol=panel_from_dict(ann_price_vol_dict, list_of_instruments, index),
+        carry_spans=carry_spans,
+        present=present,
+        forecast_weights=forecast_weights,
+        carry_present=carry_present,
+        vol_present=vol_present,
+        fdm=fdm,
+        return_fdm=return_fdm,
+    )
+    if return_fdm:
+        capped_forecast, fdm_series = capped_forecast
+
+    capped_forecast_dict = dict_from_panel(capped_forecast, present)
+    if return_fdm:
+        return capped_forecast_dict, fdm_series
+
+    return capped_forecast_dict
+
 
 def calculate_position_dict_with_multiple_carry_forecast_applied(
     adjusted_prices_dict: dict,
@@ -39,36 +88,234 @@ def calculate_position_dict_with_multiple_carry_forecast_applied(
     carry_spans: list,
 ) -> dict:
 
-    list_of_instruments = list(adjusted_prices_dict.keys())
+    capped_forecast_dict = calculate_capped_forecast(
+        adjusted_prices_dict=adjusted_prices_dict,
+        std_dev_dict=std_dev_dict,
+        carry_prices_dict=carry_prices_dict,
+        carry_spans=carry_spans,
+    )
+
+    position_dict_with_carry = calculate_position_dict_given_capped_forecast(
+        capped_forecast_dict=capped_forecast_dict,
+        average_position_contracts_dict=average_position_contracts_dict,
+    )
+
+    return position_dict_with_carry
+
+
+def calculate_position_dict_given_capped_forecast(
+    capped_forecast_dict: dict,
+    average_position_contracts_dict: dict,
+) -> dict:
+
     position_dict_with_carry = dict(
         [
             (
                 instrument_code,
-                calculate_position_with_multiple_carry_forecast_applied(
-                    average_position=average_position_contracts_dict[instrument_code],
-                    stdev_ann_perc=std_dev_dict[instrument_code],
-                    carry_price=carry_prices_dict[instrument_code],
-                    carry_spans=carry_spans,
-                ),
+                capped_forecast_dict[instrument_code]
+                * average_position_contracts_dict[instrument_code]
+                / 10,
             )
-            for instrument_code in list_of_instruments
+            for instrument_code in capped_forecast_dict.keys()
         ]
     )
 
     return position_dict_with_carry
 
 
+# Panel mode
+## Every argument is a wide date x instrument frame (or 2-D array) so each stage
+## runs once across the whole universe rather than once per instrument
+
+def calculate_capped_forecast_panel(
+    price,
+    carry,
+    price_contract,
+    carry_contract,
+    ann_price_vol,
+    carry_spans: list,
+    present=None,
+    forecast_weights: list = None,
+    contract_diff=None,
+    carry_present=None,
+    vol_present=None,
+    fdm=None,
+    return_fdm: bool = False,
+):
+
+    ## present: the rows each instrument has, its carry dates and vol dates together.
+    ## carry_present / vol_present: its carry and vol dates on their own, default present.
+    ## contract_diff, from contract_year_frac_difference, saves working it out again
+    ## when the same panel is run for several span sets; the contracts are then unused.
+    ## fdm: None to estimate it from these forecasts, a float, or one value per row
+    as_array = isinstance(price, np.ndarray)
+    if as_array:
+        price, carry, ann_price_vol = [
+            pd.DataFrame(panel) for panel in [price, carry, ann_price_vol]
+        ]
+        if contract_diff is not None:
+            contract_diff = pd.DataFrame(contract_diff)
+        present, carry_present, vol_present = [
+            None if mask is None else pd.DataFrame(mask)
+            for mask in [present, carry_present, vol_present]
+        ]
+
+    risk_adj_carry = calculate_vol_adjusted_carry_panel(
+        price=price,
+        carry=carry,
+        price_contract=price_contract,
+        carry_contract=carry_contract,
+        ann_price_vol=ann_price_vol,
+        present=present,
+        contract_diff=contract_diff,
+        carry_present=carry_present,
+        vol_present=vol_present,
+    )
+
+    all_forecasts_as_list = [
+        calculate_forecast_for_carry_panel(risk_adj_carry=risk_adj_carry, span=span, present=present)
+        for span in carry_spans
+    ]
+
+    if forecast_weights is None:
+        average_forecast = sum(all_forecasts_as_list) / len(all_forecasts_as_list)
+    else:
+        weights = normalised_forecast_weights(len(carry_spans), forecast_weights)
+        average_forecast = sum(
+            [weight * forecast for weight, forecast in zip(weights, all_forecasts_as_list)]
+        )
+
+    ## the FDM comes from how correlated the spans' forecasts have been up to each date,
+    ## on rows we actually have
+    if fdm is None:
+        fdm = estimate_fdm_series(
+            carry_spans,
+            [
+                forecast if present is None else forecast.where(present)
+                for forecast in all_forecasts_as_list
+            ],
+            forecast_weights,
+        )
+    fdm = _fdm_for_rows(fdm, average_forecast.index)
+    capped_forecast = average_forecast.mul(fdm, axis=0).clip(-20, 20)
+
+    if as_array:
+        capped_forecast = capped_forecast.to_numpy()
+        fdm = fdm.to_numpy()
+    if return_fdm:
+        return capped_forecast, fdm
+
+    return capped_forecast
+
+
+def calculate_forecast_for_carry_panel(
+    risk_adj_carry: pd.DataFrame, span: int, present: pd.DataFrame = None
+) -> pd.DataFrame:
+
+    ## each instrument is smoothed over its own rows only. A row it has but with no
+    ## risk adjusted carry still decays the average, as ewm does on the instrument's own
+    if present is None:
+        smooth_carry = risk_adj_carry.ewm(span).mean()
+    else:
+        smooth_carry = pd.DataFrame(
+            apply_to_own_rows(
+                lambda frame: frame.ewm(span).mean().to_numpy(),
+                risk_adj_carry.to_numpy(dtype=np.float64),
+                present.to_numpy(),
+            ),
+            index=risk_adj_carry.index,
+            columns=risk_adj_carry.columns,
+        )
+    scaled_carry = smooth_carry * 30
+    capped_carry = scaled_carry.clip(-20, 20)
+
+    return capped_carry
+
+
+def calculate_vol_adjusted_carry_panel(
+    price: pd.DataFrame,
+    carry: pd.DataFrame,
+    price_contract: pd.DataFrame,
+    carry_contract: pd.DataFrame,
+    ann_price_vol: pd.DataFrame,
+    present: pd.DataFrame = None,
+    contract_diff: pd.DataFrame = None,
+    carry_present: pd.DataFrame = None,
+    vol_present: pd.DataFrame = None,
+) -> pd.DataFrame:
+
+    if carry_present is None:
+        carry_present = present
+    if vol_present is None:
+        vol_present = present
+
+    ann_carry = calculate_annualised_carry_panel(
+        price=price,
+        carry=carry,
+        price_contract=price_contract,
+        carry_contract=carry_contract,
+        contract_diff=contract_diff,
+    )
+
+    ## filled forward over each series' own dates only, so a date the carry table
+    ## doesn't have stays missing, as it does when the series are divided per instrument
+    ann_carry = _ffill_own_rows(ann_carry, carry_present)
+    ann_price_vol = _ffill_own_rows(ann_price_vol, vol_present)
+
+    risk_adj_carry = ann_carry / ann_price_vol
+
+    return risk_adj_carry
+
+
+def calculate_annualised_carry_panel(
+    price: pd.DataFrame,
+    carry: pd.DataFrame,
+    price_contract: pd.DataFrame,
+    carry_contract: pd.DataFrame,
+    contract_diff: pd.DataFrame = None,
+) -> pd.DataFrame:
+
+    ## will be reversed if price_contract > carry_contract
+    raw_carry = price - carry
+    if contract_diff is None:
+        contract_diff = contract_year_frac_difference(price_contract, carry_contract)
+
+    ann_carry = raw_carry / contract_diff
+
+    return ann_carry
+
+
+def _fdm_for_rows(fdm, index: pd.Index) -> pd.Series:
+
+    ## a float, one value per row, or a series by date, as a series on index
+    if isinstance(fdm, pd.Series):
+        return fdm.reindex(index)
+
+    return pd.Series(np.broadcast_to(np.asarray(fdm, dtype=np.float64).reshape(-1), len(index)), index=index)
+
+
+def _ffill_own_rows(panel: pd.DataFrame, present: pd.DataFrame = None) -> pd.DataFrame:
+
+    ## rows that aren't an instrument's own neither fill nor get filled
+    if present is None:
+        return panel.ffill()
+
+    return panel.where(present).ffill().where(present)
+
+
 def calculate_position_with_multiple_carry_forecast_applied(
     average_position: pd.Series,
     stdev_ann_perc: standardDeviation,
     carry_price: pd.DataFrame,
     carry_spans: list,
+    fdm,
 ) -> pd.Series:
 
     forecast = calculate_combined_carry_forecast(
         stdev_ann_perc=stdev_ann_perc,
         carry_price=carry_price,
         carry_spans=carry_spans,
+        fdm=fdm,
     )
 
     return forecast * average_position / 10
@@ -78,33 +325,52 @@ def calculate_combined_carry_forecast(
     stdev_ann_perc: standardDeviation,
     carry_price: pd.DataFrame,
     carry_spans: list,
+    fdm,
+    forecast_weights: list = None,
 ) -> pd.Series:
 
-    all_forecasts_as_list = [
-        calculate_forecast_for_carry(
-            stdev_ann_perc=stdev_ann_perc,
-            carry_price=carry_price,
-            span=span,
-        )
-        for span in carry_spans
-    ]
-
-    ### NOTE: This assumes we are equally weighted across spans
-    ### eg all forecast weights the same, equally weighted
-    all_forecasts_as_df = pd.concat(all_forecasts_as_list, axis=1)
-    average_forecast = all_forecasts_as_df.mean(axis=1)
+    ## fdm: a float, or a series by date. The FDM is pooled across the instruments, which
+    ## one instrument on its own can't do, so there's no default: to match
+    ## calculate_capped_forecast pass the series calculate_capped_forecast(...,
+    ## return_fdm=True) gives, estimated from every instrument's forecasts up to each date
+    all_forecasts_as_df = calculate_forecasts_for_carry_spans(
+        stdev_ann_perc=stdev_ann_perc,
+        carry_price=carry_price,
+        carry_spans=carry_spans,
+    )
 
-    ## apply an FDM
-    rule_count = len(carry_spans)
-    FDM_DICT = {1: 1.0, 2: 1.02, 3: 1.03, 4: 1.04}
-    fdm = FDM_DICT[rule_count]
+    if forecast_weights is None:
+        average_forecast = all_forecasts_as_df.mean(axis=1)
+    else:
+        weights = normalised_forecast_weights(len(carry_spans), forecast_weights)
+        average_forecast = (all_forecasts_as_df * weights).sum(axis=1, min_count=1)
 
-    scaled_forecast = average_forecast * fdm
+    scaled_forecast = average_forecast * _fdm_for_rows(fdm, average_forecast.index)
     capped_forecast = scaled_forecast.clip(-20, 20)
 
     return capped_forecast
 
 
+def calculate_forecasts_for_carry_spans(
+    stdev_ann_perc: standardDeviation,
+    carry_price: pd.DataFrame,
+    carry_spans: list,
+) -> pd.DataFrame:
+
+    ## the vol adjusted carry doesn't depend on the span, so build it once
+    ## and fan out into a dates x spans matrix
+    risk_adj_carry = calculate_vol_adjusted_carry(
+        stdev_ann_perc=stdev_ann_perc, carry_price=carry_price
+    )
+
+    smooth_carry = np.column_stack(
+        [risk_adj_carry.ewm(span).mean().to_numpy() for span in carry_spans]
+    )
+    capped_carry = np.clip(smooth_carry * 30, -20, 20)
+
+    return pd.DataFrame(capped_carry, index=risk_adj_carry.index, columns=carry_spans)
+
+
 def calculate_forecast_for_carry(
     stdev_ann_perc: standardDeviation, carry_price: pd.DataFrame, span: int
 ):
@@ -149,58 +415,15 @@ def calculate_annualised_carry(
 
     ## will be reversed if price_contract > carry_contract
     raw_carry = carry_price['PRICE'] - carry_price['CARRY']
-    contract_diff = _total_year_frac_from_contract_series(
-        carry_price['CARRY_CONTRACT'].astype(float)
-    ) - _total_year_frac_from_contract_series(carry_price['PRICE_CONTRACT'].astype(float))
+    ## worked out once per roll calendar segment, not on every row
+    contract_diff = contract_year_frac_difference(
+        carry_price['PRICE_CONTRACT'], carry_price['CARRY_CONTRACT']
+    )
 
     ann_carry = raw_carry / contract_diff
 
     return ann_carry
 
-
-def _total_year_frac_from_contract_series(x):
-    years = _year_from_contract_series(x)
-    month_frac = _month_as_year_frac_from_contract_series(x)
-
-    return years + month_frac
-
-
-def _year_from_contract_series(x):
-    return x.floordiv(10000)
-
-
-def _month_as_year_frac_from_contract_series(x):
-    return _month_from_contract_series(x) / 12.0
-
-
-def _month_from_contract_series(x):
-    return x.mod(10000) / 100.0
-
-def calculate_capped_forecast(
-    adjusted_prices_dict: dict,
-    std_dev_dict: dict,
-    carry_prices_dict: dict,
-    carry_spans: list,
-) -> dict:
-
-    list_of_instruments = list(adjusted_prices_dict.keys())
-    capped_forecast_dict = dict(
-        [
-            (
-                instrument_code,
-                calculate_combined_carry_forecast(
-                    stdev_ann_perc=std_dev_dict[instrument_code],
-                    carry_price=carry_prices_dict[instrument_code],
-                    carry_spans=carry_spans,
-                ),
-            )
-            for instrument_code in list_of_instruments
-        ]
-    )
-
-    return capped_forecast_dict
-
-
 # Buffering
 
 def apply_buffering_to_position_dict(
@@ -208,16 +431,32 @@ def apply_buffering_to_position_dict(
 ) -> dict:
 
     instrument_list = list(position_contracts_dict.keys())
+    position_contracts = panel_from_dict(position_contracts_dict, instrument_list)
+    average_position_contracts = panel_from_dict(
+        average_position_contracts_dict, instrument_list
+    ).reindex(position_contracts.index)
+
+    present = presence_from_index_dict(
+        dict(
+            [
+                (instrument_code, position_contracts_dict[instrument_code].index)
+                for instrument_code in instrument_list
+            ]
+        ),
+        instrument_list,
+    )
+
+    buffered_position = apply_buffering_to_positions(
+        position_contracts=position_contracts,
+        average_position_contracts=average_position_contracts,
+        present=present,
+    )
+
     buffered_position_dict = dict(
         [
             (
                 instrument_code,
-                apply_buffering_to_positions(
-                    position_contracts=position_contracts_dict[instrument_code],
-                    average_position_contracts=average_position_contracts_dict[
-                        instrument_code
-                    ],
-                ),
+                buffered_position[instrument_code][present[instrument_code]].rename(None),
             )
             for instrument_code in instrument_list
         ]
@@ -226,12 +465,13 @@ def apply_buffering_to_position_dict(
     return buffered_position_dict
 
 def apply_buffering_to_positions(
-    position_contracts: pd.Series,
-    average_position_contracts: pd.Series,
+    position_contracts,
+    average_position_contracts,
     buffer_size: float = 0.10,
-) -> pd.Series:
+    present: pd.DataFrame = None,
+):
 
-    buffer = average_position_contracts.abs() * buffer_size
+    buffer = abs(average_position_contracts) * buffer_size
     upper_buffer = position_contracts + buffer
     lower_buffer = position_contracts - buffer
 
@@ -239,36 +479,46 @@ def apply_buffering_to_positions(
         optimal_position=position_contracts,
         upper_buffer=upper_buffer,
         lower_buffer=lower_buffer,
+        present=present,
     )
 
     return buffered_position
 
-def apply_buffer(
-    optimal_position: pd.Series, upper_buffer: pd.Series, lower_buffer: pd.Series
-) -> pd.Series:
-
-    upper_buffer = upper_buffer.ffill().round()
-    lower_buffer = lower_buffer.ffill().round()
-    use_optimal_position = optimal_position.ffill()
+def apply_buffer(optimal_position, upper_buffer, lower_buffer, present=None):
 
-    current_position = use_optimal_position.iloc[0]
-    if np.isnan(current_position):
-        current_position = 0.0
+    ## works on a single instrument Series, or a date x instrument DataFrame / 2-D array
+    ## in which case present marks the rows each instrument actually has
+    optimal_position_values = _as_2d_float_array(optimal_position)
+    upper_buffer_values = _as_2d_float_array(pd.DataFrame(upper_buffer).ffill().round())
+    lower_buffer_values = _as_2d_float_array(pd.DataFrame(lower_buffer).ffill().round())
 
-    buffered_position_list = [current_position]
+    if present is None:
+        first_row = np.zeros(optimal_position_values.shape[1], dtype=np.int64)
+    else:
+        first_row = _as_2d_float_array(present).astype(bool).argmax(axis=0)
 
-    for idx in range(len(optimal_position.index))[1:]:
-        current_position = apply_buffer_single_period(
-            last_position=current_position,
-            top_pos=upper_buffer.iloc[idx],
-            bot_pos=lower_buffer.iloc[idx],
-        )
+    current_position = optimal_position_values[
+        first_row, np.arange(optimal_position_values.shape[1])
+    ]
+    current_position = np.where(np.isnan(current_position), 0.0, current_position)
 
-        buffered_position_list.append(current_position)
+    buffered_position_values = apply_buffer_kernel(
+        np.asfortranarray(upper_buffer_values),
+        np.asfortranarray(lower_buffer_values),
+        current_position,
+        first_row,
+    )
 
-    buffered_position = pd.Series(buffered_position_list, index=optimal_position.index)
+    if isinstance(optimal_position, pd.Series):
+        return pd.Series(buffered_position_values[:, 0], index=optimal_position.index)
+    if isinstance(optimal_position, pd.DataFrame):
+        return pd.DataFrame(
+            buffered_position_values,
+            index=optimal_position.index,
+            columns=optimal_position.columns,
+        )
 
-    return buffered_position
+    return buffered_position_values
 
 def apply_buffer_single_period(last_position: int, top_pos: float, bot_pos: float):
 
@@ -279,3 +529,64 @@ def apply_buffer_single_period(last_position: int, top_pos: float, bot_pos: floa
     else:
         return last_position
 
+def _as_2d_float_array(x) -> np.ndarray:
+    values = np.asarray(x, dtype=np.float64)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+
+    return values
+
+def _apply_buffer_loop(
+    upper_buffer: np.ndarray,
+    lower_buffer: np.ndarray,
+    first_position: np.ndarray,
+    first_row: np.ndarray,
+) -> np.ndarray:
+
+    ## one instrument at a time, walking down a column of a Fortran ordered array
+    row_count, instrument_count = upper_buffer.shape
+    buffered_position = np.empty((row_count, instrument_count))
+    for instrument_idx in range(instrument_count):
+        current_position = first_position[instrument_idx]
+        for idx in range(row_count):
+            if idx > first_row[instrument_idx]:
+                top_pos = upper_buffer[idx, instrument_idx]
+                bot_pos = lower_buffer[idx, instrument_idx]
+                if current_position > top_pos:
+                    current_position = top_pos
+                elif current_position < bot_pos:
+                    current_position = bot_pos
+            buffered_position[idx, instrument_idx] = current_position
+
+    return buffered_position
+
+def _apply_buffer_vectorised(
+    upper_buffer: np.ndarray,
+    lower_buffer: np.ndarray,
+    first_position: np.ndarray,
+    first_row: np.ndarray,
+) -> np.ndarray:
+
+    ## one date at a time, clamping every instrument at once
+    buffered_position = np.empty(upper_buffer.shape)
+    current_position = first_position.copy()
+    for idx in range(upper_buffer.shape[0]):
+        top_pos = upper_buffer[idx]
+        bot_pos = lower_buffer[idx]
+        clamped_position = np.where(
+            current_position > top_pos,
+            top_pos,
+            np.where(current_position < bot_pos, bot_pos, current_position),
+        )
+        current_position = np.where(idx > first_row, clamped_position, current_position)
+        buffered_position[idx] = current_position
+
+    return buffered_position
+
+## numba is optional, without it we fall back to the pure numpy kernel
+try:
+    from numba import njit
+except ImportError:
+    apply_buffer_kernel = _apply_buffer_vectorised
+else:
+    apply_buffer_kernel = njit(cache=True)(_apply_buffer_loop)
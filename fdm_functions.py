@@ -0,0 +1,137 @@
+import numpy as np
+
+FDM_CAP = 2.5
+## pooled observations needed before the estimate replaces the default
+FDM_MIN_OBSERVATIONS = 250
+## the old fixed multipliers, equal weights only; used for a span set until it's been estimated
+DEFAULT_FDM_DICT = {1: 1.0, 2: 1.02, 3: 1.03, 4: 1.04}
+
+## Forecast diversification multiplier, FDM = 1 / sqrt(w.rho.wT)
+## rho is the correlation between the forecasts for each span, pooled across instruments:
+## every date of every instrument where all the spans have a forecast is one observation.
+## Negative correlations are floored at zero and the FDM is capped at FDM_CAP.
+## The estimate on each date only uses the observations up to and including that date,
+## so the FDM is a series rather than one number from the whole sample. The state is a
+## running count, sum and sum of products, so new dates are folded in without going
+## back over the history; whoever needs the FDM holds the estimator or the series
+
+
+class fdmEstimator:
+    def __init__(
+        self,
+        carry_spans: list,
+        forecast_weights: list = None,
+        min_observations: int = FDM_MIN_OBSERVATIONS,
+    ):
+        span_count = len(carry_spans)
+        self._weights = normalised_forecast_weights(span_count, forecast_weights)
+        self._default_fdm = default_fdm(carry_spans, forecast_weights)
+        self._min_observations = min_observations
+
+        self._observation_count = 0
+        self._sums = np.zeros(span_count)
+        self._products = np.zeros((span_count, span_count))
+
+    @property
+    def weights(self) -> np.ndarray:
+        return self._weights
+
+    @property
+    def observation_count(self) -> int:
+        return self._observation_count
+
+    def update(self, forecast_list: list) -> np.ndarray:
+
+        ## forecast_list: one date x instrument panel (or array) per span, dates in order
+        ## and after any already folded in. Returns the FDM on each date
+        forecasts = np.stack(
+            [np.asarray(forecast, dtype=np.float64) for forecast in forecast_list], axis=-1
+        )
+        if forecasts.ndim == 2:
+            forecasts = forecasts.reshape(forecasts.shape[0], 1, forecasts.shape[1])
+        if len(forecasts) == 0:
+            return np.zeros(0)
+
+        ## a date contributes the instruments with a forecast for every span
+        observed = np.isfinite(forecasts).all(axis=2)
+        forecasts = np.where(observed[:, :, np.newaxis], forecasts, 0.0)
+
+        observation_count = self._observation_count + np.cumsum(observed.sum(axis=1))
+        sums = self._sums + np.cumsum(forecasts.sum(axis=1), axis=0)
+        products = self._products + np.cumsum(
+            np.einsum("dis,dit->dst", forecasts, forecasts), axis=0
+        )
+
+        self._observation_count = int(observation_count[-1])
+        self._sums = sums[-1]
+        self._products = products[-1]
+
+        return self._fdm_from_sums(observation_count, sums, products)
+
+    def fdm(self) -> float:
+        return float(
+            self._fdm_from_sums(
+                np.array([self._observation_count]),
+                self._sums[np.newaxis],
+                self._products[np.newaxis],
+            )[0]
+        )
+
+    def _fdm_from_sums(
+        self, observation_count: np.ndarray, sums: np.ndarray, products: np.ndarray
+    ) -> np.ndarray:
+
+        ## dates x spans x spans correlations from the running sums, one FDM per date
+        span_count = len(self._weights)
+        if span_count == 1:
+            return np.ones(len(observation_count))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            count = observation_count.astype(np.float64).reshape(-1, 1, 1)
+            covariance = products - sums[:, :, np.newaxis] * sums[:, np.newaxis, :] / count
+            standard_deviation = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+            correlation = covariance / (
+                standard_deviation[:, :, np.newaxis] * standard_deviation[:, np.newaxis, :]
+            )
+        correlation = np.clip(np.nan_to_num(correlation, nan=0.0), 0.0, 1.0)
+        correlation[:, np.arange(span_count), np.arange(span_count)] = 1.0
+
+        portfolio_variance = np.einsum("s,dst,t->d", self._weights, correlation, self._weights)
+        fdm = np.minimum(1 / np.sqrt(portfolio_variance), FDM_CAP)
+
+        return np.where(observation_count >= self._min_observations, fdm, self._default_fdm)
+
+
+def estimate_fdm_series(
+    carry_spans: list,
+    forecast_list: list,
+    forecast_weights: list = None,
+    min_observations: int = FDM_MIN_OBSERVATIONS,
+) -> np.ndarray:
+
+    ## the FDM on each date of a set of date x instrument forecast panels, one per span
+    estimator = fdmEstimator(carry_spans, forecast_weights, min_observations=min_observations)
+
+    return estimator.update(forecast_list)
+
+
+def default_fdm(carry_spans: list, forecast_weights: list = None) -> float:
+
+    ## the old table for equal weights, else no credit at all
+    if forecast_weights is None:
+        return DEFAULT_FDM_DICT.get(len(carry_spans), 1.0)
+
+    return 1.0
+
+
+def normalised_forecast_weights(span_count: int, forecast_weights: list = None) -> np.ndarray:
+    if forecast_weights is None:
+        return np.full(span_count, 1 / span_count)
+
+    weights = np.asarray(forecast_weights, dtype=np.float64)
+    if len(weights) != span_count:
+        raise ValueError(
+            "Got %d forecast weights for %d spans" % (len(weights), span_count)
+        )
+
+    return weights / weights.sum()
@@ -0,0 +1,565 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import resource_tracker, shared_memory
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pandas as pd
+
+try:
+    from . import cache_functions
+    from .idm_functions import idmEstimator, update_idm_estimator
+    from .fx_functions import create_fx_series_given_adjusted_prices_dict
+    from .fdm_functions import fdmEstimator
+    from .incremental_functions import create_incremental_state_dict_from_history
+    from .incremental_functions import update_incremental_state_dict_from_history
+    from .panel_functions import union_of_indices
+    from .getMultiplierDict import getMultiplierDict
+    from .instrument_registry_functions import get_instrument_registry
+except ImportError:
+    import cache_functions
+    from idm_functions import idmEstimator, update_idm_estimator
+    from fx_functions import create_fx_series_given_adjusted_prices_dict
+    from fdm_functions import fdmEstimator
+    from incremental_functions import create_incremental_state_dict_from_history
+    from incremental_functions import update_incremental_state_dict_from_history
+    from panel_functions import union_of_indices
+    from getMultiplierDict import getMultiplierDict
+    from instrument_registry_functions import get_instrument_registry
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+## rows allocated past the end, so most refreshes append in place
+DEFAULT_SPARE_ROWS = 512
+
+SERVED_PANELS = ["capped_forecast", "position", "buffered_position", "std_dev"]
+
+## header block: int64s clients can poll without asking the server
+HEADER_VERSION = 0
+HEADER_ROW_COUNT = 1
+HEADER_CAPACITY = 2
+## odd while rows are being written, moves on with every write
+HEADER_SEQUENCE = 3
+HEADER_SIZE = 4
+## how long a client waits between tries when it catches a write in progress
+READ_RETRY_WAIT = 0.001
+
+## Local forecast service
+## One long lived process holds the latest forecast, position and vol panels (date x
+## instrument float64) in shared memory. Clients map the blocks and read them in place,
+## no serialisation. Refreshes run the incremental state forward over the rows
+## that arrived since the last one: rows are written first, then the row count in the
+## header is bumped. A refresh can also rewrite rows already there (a revised last
+## bar), so every write is bracketed by the header sequence, seqlock style: odd while
+## writing, and moved on after. A client copies the rows out and keeps them only if the
+## sequence was even and unchanged across the copy, else it tries again. When the spare rows
+## run out, or a late bar lands on a date the panels don't have, the panels move to
+## new blocks and the header version is bumped; clients notice and remap.
+## The FDM estimator folds in each date's forecasts as the rows arrive, so a date's FDM
+## only sees the past. Unless a fixed one is given, the IDM estimator folds in each week
+## as it completes.
+## A small HTTP API on localhost gives the block names and triggers refreshes:
+##   GET /metadata   POST /refresh
+
+
+class sharedPanels:
+    def __init__(self, instrument_list: list, panel_names: list, spare_rows: int = DEFAULT_SPARE_ROWS):
+        self._instrument_list = list(instrument_list)
+        self._panel_names = list(panel_names)
+        self._spare_rows = spare_rows
+        self._blocks = {}
+        self._arrays = {}
+        self._header_block = shared_memory.SharedMemory(create=True, size=HEADER_SIZE * 8)
+        self._header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self._header_block.buf)
+        self._header[:] = 0
+
+    @property
+    def row_count(self) -> int:
+        return int(self._header[HEADER_ROW_COUNT])
+
+    @property
+    def index(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(self._arrays["index"][: self.row_count].view("M8[ns]"), name="Date")
+
+    def layout(self, index: pd.DatetimeIndex, panel_dict: dict):
+
+        ## (re)build every block for this index, then publish under a new version
+        capacity = len(index) + self._spare_rows
+        blocks = {}
+        arrays = {}
+        for name in ["index"] + self._panel_names:
+            dtype = np.int64 if name == "index" else np.float64
+            width = () if name == "index" else (len(self._instrument_list),)
+            block = shared_memory.SharedMemory(
+                create=True, size=max(capacity * int(np.prod(width, dtype=np.int64)) * 8, 8)
+            )
+            values = np.ndarray((capacity,) + width, dtype=dtype, buffer=block.buf)
+            if name == "index":
+                values[: len(index)] = index.to_numpy(dtype="M8[ns]").view(np.int64)
+            else:
+                values[:] = np.nan
+                values[: len(index)] = panel_dict[name]
+            blocks[name] = block
+            arrays[name] = values
+
+        old_blocks = self._blocks
+        self._blocks = blocks
+        self._arrays = arrays
+        self._header[HEADER_SEQUENCE] += 1
+        self._header[HEADER_CAPACITY] = capacity
+        self._header[HEADER_ROW_COUNT] = len(index)
+        self._header[HEADER_VERSION] += 1
+        self._header[HEADER_SEQUENCE] += 1
+
+        ## readers still mapping the old blocks keep them until they let go
+        for block in old_blocks.values():
+            block.close()
+            block.unlink()
+
+    def write_rows(self, index: pd.DatetimeIndex, panel_dict: dict) -> bool:
+
+        ## dates already in the panels, or after the last one, go in place; False if
+        ## that isn't possible and the caller has to lay the panels out again
+        current_index = self.index
+        new_dates = index[~index.isin(current_index)]
+        if len(current_index) > 0 and len(new_dates) > 0 and new_dates[0] <= current_index[-1]:
+            return False
+        if self.row_count + len(new_dates) > int(self._header[HEADER_CAPACITY]):
+            return False
+
+        row_count = self.row_count
+        self._header[HEADER_SEQUENCE] += 1
+        self._arrays["index"][row_count : row_count + len(new_dates)] = new_dates.to_numpy(
+            dtype="M8[ns]"
+        ).view(np.int64)
+        rows = current_index.append(new_dates).get_indexer(index)
+        for name in self._panel_names:
+            panel = self._arrays[name]
+            values = panel_dict[name]
+            ## only fill what we have, an instrument without a bar keeps its cell
+            have_value = ~np.isnan(values)
+            existing = panel[rows]
+            panel[rows] = np.where(have_value, values, existing)
+
+        self._header[HEADER_ROW_COUNT] = row_count + len(new_dates)
+        self._header[HEADER_SEQUENCE] += 1
+
+        return True
+
+    def panel(self, name: str) -> pd.DataFrame:
+        return pd.DataFrame(
+            self._arrays[name][: self.row_count].copy(),
+            index=self.index,
+            columns=self._instrument_list,
+        )
+
+    def metadata(self) -> dict:
+        return dict(
+            version=int(self._header[HEADER_VERSION]),
+            row_count=self.row_count,
+            capacity=int(self._header[HEADER_CAPACITY]),
+            instruments=self._instrument_list,
+            header_block=self._header_block.name,
+            index_block=self._blocks["index"].name,
+            panel_blocks=dict([(name, self._blocks[name].name) for name in self._panel_names]),
+        )
+
+    def close(self):
+        for block in list(self._blocks.values()) + [self._header_block]:
+            block.close()
+            block.unlink()
+        self._blocks = {}
+        self._arrays = {}
+
+
+class forecastServer:
+    def __init__(
+        self,
+        instrument_list: list,
+        weights: dict,
+        multipliers: dict,
+        capital: float,
+        risk_target_tau: float,
+        carry_spans: list,
+        buffer_size: float = 0.10,
+        idm: float = None,
+        load_function=None,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        spare_rows: int = DEFAULT_SPARE_ROWS,
+    ):
+        self._instrument_list = list(instrument_list)
+        self._weights = weights
+        self._multipliers = multipliers
+        self._capital = capital
+        self._risk_target_tau = risk_target_tau
+        self._carry_spans = list(carry_spans)
+        self._buffer_size = buffer_size
+        ## a fixed idm, or None to estimate it week by week
+        self._idm = idm
+        self._idm_estimator = None
+        self._fdm_estimator = None
+        ## load_function(instrument_list) -> adjusted, current and carry dicts, all history
+        self._load_function = load_cached_data if load_function is None else load_function
+        self._address = (host, port)
+        self._spare_rows = spare_rows
+
+        self._lock = threading.Lock()
+        self._panels = None
+        self._state_dict = None
+        self._last_date_dict = {}
+        self._http_server = None
+        self._last_refresh = None
+
+    def start(self, serve: bool = True):
+        with self._lock:
+            self._build()
+        if serve:
+            self._http_server = ThreadingHTTPServer(self._address, _forecast_request_handler(self))
+            threading.Thread(target=self._http_server.serve_forever, daemon=True).start()
+
+        return self
+
+    @property
+    def address(self) -> tuple:
+        if self._http_server is None:
+            return self._address
+        return self._http_server.server_address[:2]
+
+    def metadata(self) -> dict:
+
+        ## handler threads call this while a refresh may be moving the panels
+        with self._lock:
+            return self._metadata()
+
+    def panel(self, name: str) -> pd.DataFrame:
+        with self._lock:
+            return self._panels.panel(name)
+
+    def refresh(self) -> dict:
+        with self._lock:
+            start = time.perf_counter()
+            adjusted_prices_dict, current_prices_dict, carry_prices_dict = self._load_function(
+                self._instrument_list
+            )
+            output_dict = update_incremental_state_dict_from_history(
+                state_dict=self._state_dict,
+                adjusted_prices_dict=adjusted_prices_dict,
+                current_prices_dict=current_prices_dict,
+                carry_prices_dict=carry_prices_dict,
+                fx_series_dict=create_fx_series_given_adjusted_prices_dict(adjusted_prices_dict),
+                after_date_dict=self._last_date_dict,
+                idm=self._updated_idm(adjusted_prices_dict, current_prices_dict),
+                fdm=self._fdm_estimator,
+            )
+            output_dict = dict(
+                [(code, outputs) for code, outputs in output_dict.items() if len(outputs) > 0]
+            )
+
+            rows_added = 0
+            if len(output_dict) > 0:
+                self._remember_last_dates(output_dict)
+                index, panel_dict = self._panels_from_outputs(output_dict)
+                if not self._panels.write_rows(index, panel_dict):
+                    self._relayout_with(index, panel_dict)
+                rows_added = len(index)
+
+            self._last_refresh = pd.Timestamp.now().isoformat()
+
+            metadata = self._metadata()
+        metadata.update(rows_added=rows_added, refresh_seconds=time.perf_counter() - start)
+
+        return metadata
+
+    def stop(self):
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+        if self._panels is not None:
+            self._panels.close()
+            self._panels = None
+
+    def _build(self):
+        adjusted_prices_dict, current_prices_dict, carry_prices_dict = self._load_function(
+            self._instrument_list
+        )
+        instrument_list = list(adjusted_prices_dict.keys())
+        fx_series_dict = create_fx_series_given_adjusted_prices_dict(adjusted_prices_dict)
+        if self._idm is None:
+            self._idm_estimator = idmEstimator(instrument_list, self._weights)
+        self._fdm_estimator = fdmEstimator(self._carry_spans)
+
+        self._state_dict, output_dict = create_incremental_state_dict_from_history(
+            capital=self._capital,
+            risk_target_tau=self._risk_target_tau,
+            idm=self._updated_idm(adjusted_prices_dict, current_prices_dict),
+            weights=self._weights,
+            multipliers=self._multipliers,
+            carry_spans=self._carry_spans,
+            adjusted_prices_dict=adjusted_prices_dict,
+            current_prices_dict=current_prices_dict,
+            carry_prices_dict=carry_prices_dict,
+            fx_series_dict=fx_series_dict,
+            buffer_size=self._buffer_size,
+            fdm=self._fdm_estimator,
+        )
+        self._instrument_list = instrument_list
+        self._remember_last_dates(output_dict)
+
+        self._panels = sharedPanels(instrument_list, SERVED_PANELS, spare_rows=self._spare_rows)
+        self._panels.layout(*self._panels_from_outputs(output_dict))
+        self._last_refresh = pd.Timestamp.now().isoformat()
+
+    def _updated_idm(self, adjusted_prices_dict: dict, current_prices_dict: dict):
+
+        ## the IDM by week end, with any weeks completed since the last call folded in
+        if self._idm_estimator is None:
+            return self._idm
+
+        return update_idm_estimator(self._idm_estimator, adjusted_prices_dict, current_prices_dict)
+
+    def _latest_idm(self) -> float:
+        if self._idm_estimator is None:
+            return self._idm
+
+        idm_series = self._idm_estimator.idm_series
+        return 1.0 if len(idm_series) == 0 else float(idm_series.iloc[-1])
+
+    def _metadata(self) -> dict:
+
+        ## callers hold the lock
+        metadata = self._panels.metadata()
+        metadata.update(
+            first_date=_date_or_none(self._panels.index, 0),
+            last_date=_date_or_none(self._panels.index, -1),
+            last_refresh=self._last_refresh,
+            capital=self._capital,
+            risk_target_tau=self._risk_target_tau,
+            carry_spans=self._carry_spans,
+            idm=self._latest_idm(),
+            fdm=self._fdm_estimator.fdm(),
+        )
+
+        return metadata
+
+    def _panels_from_outputs(self, output_dict: dict) -> tuple:
+        index = union_of_indices([outputs.index for outputs in output_dict.values()])
+        panel_dict = {}
+        for name in SERVED_PANELS:
+            values = np.full((len(index), len(self._instrument_list)), np.nan)
+            for instrument_idx, instrument_code in enumerate(self._instrument_list):
+                if instrument_code in output_dict:
+                    outputs = output_dict[instrument_code]
+                    values[index.get_indexer(outputs.index), instrument_idx] = outputs[name]
+            panel_dict[name] = values
+
+        return index, panel_dict
+
+    def _relayout_with(self, index: pd.DatetimeIndex, panel_dict: dict):
+        current_index = self._panels.index
+        merged_index = current_index.union(index)
+        merged_panel_dict = {}
+        for name in SERVED_PANELS:
+            merged = self._panels.panel(name).reindex(merged_index).to_numpy(copy=True)
+            rows = merged_index.get_indexer(index)
+            merged[rows] = np.where(np.isnan(panel_dict[name]), merged[rows], panel_dict[name])
+            merged_panel_dict[name] = merged
+
+        self._panels.layout(merged_index, merged_panel_dict)
+
+    def _remember_last_dates(self, output_dict: dict):
+        for instrument_code, outputs in output_dict.items():
+            if len(outputs) > 0:
+                self._last_date_dict[instrument_code] = outputs.index[-1]
+
+
+class forecastClient:
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self._url = "http://%s:%d" % (host, port)
+        self._metadata = None
+        self._header = None
+        self._header_block = None
+        self._blocks = {}
+
+    def metadata(self) -> dict:
+        return self._request("GET", "/metadata")
+
+    def refresh(self) -> dict:
+        return self._request("POST", "/refresh")
+
+    def panel(self, name: str) -> pd.DataFrame:
+
+        ## a copy of the rows as they were between two writes, straight out of the shared
+        ## block; a write landing during the copy sends us round again
+        while True:
+            self._attach()
+            sequence = int(self._header[HEADER_SEQUENCE])
+            if sequence % 2 == 1:
+                time.sleep(READ_RETRY_WAIT)
+                continue
+
+            row_count = int(self._header[HEADER_ROW_COUNT])
+            index_values = self._block_array("index", np.int64, ())[:row_count].copy()
+            values = self._block_array(
+                name, np.float64, (len(self._metadata["instruments"]),)
+            )[:row_count].copy()
+
+            if int(self._header[HEADER_SEQUENCE]) == sequence:
+                break
+            time.sleep(READ_RETRY_WAIT)
+
+        return pd.DataFrame(
+            values,
+            index=pd.DatetimeIndex(index_values.view("M8[ns]"), name="Date"),
+            columns=self._metadata["instruments"],
+            copy=False,
+        )
+
+    def version(self) -> int:
+        self._attach()
+        return int(self._header[HEADER_VERSION])
+
+    def close(self):
+        for block in self._blocks.values():
+            block.close()
+        if self._header_block is not None:
+            self._header_block.close()
+        self._blocks = {}
+        self._header = None
+        self._header_block = None
+
+    def _attach(self):
+        if self._header is None:
+            self._metadata = self.metadata()
+            self._header_block = _attach_shared_memory(self._metadata["header_block"])
+            self._header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self._header_block.buf)
+
+        if int(self._header[HEADER_VERSION]) != self._metadata["version"] or len(self._blocks) == 0:
+            ## laid out again since we last looked, map the new blocks
+            for block in self._blocks.values():
+                block.close()
+            self._metadata = self.metadata()
+            block_names = dict(self._metadata["panel_blocks"], index=self._metadata["index_block"])
+            self._blocks = dict(
+                [(name, _attach_shared_memory(block_name)) for name, block_name in block_names.items()]
+            )
+
+    def _block_array(self, name: str, dtype, width: tuple) -> np.ndarray:
+        values = np.ndarray(
+            (self._metadata["capacity"],) + width, dtype=dtype, buffer=self._blocks[name].buf
+        )
+        values.flags.writeable = False
+
+        return values
+
+    def _request(self, method: str, path: str) -> dict:
+        try:
+            with urlopen(Request(self._url + path, method=method)) as response:
+                return json.loads(response.read())
+        except HTTPError as error:
+            raise RuntimeError(
+                "%s %s failed: %s" % (method, path, json.loads(error.read()).get("error"))
+            ) from error
+
+
+def load_cached_data(instrument_list: list) -> tuple:
+
+    ## the local table cache pulls only new rows from SQL, then hands back full history
+    adjusted_prices_dict, current_prices_dict = cache_functions.get_data(instrument_list)
+    carry_prices_dict = cache_functions.get_carry_data(instrument_list)
+    instrument_list = [
+        instrument_code
+        for instrument_code in adjusted_prices_dict.keys()
+        if instrument_code in carry_prices_dict
+    ]
+
+    return (
+        dict([(code, adjusted_prices_dict[code]) for code in instrument_list]),
+        dict([(code, current_prices_dict[code]) for code in instrument_list]),
+        dict([(code, carry_prices_dict[code]) for code in instrument_list]),
+    )
+
+
+def main():
+    instrument_list = get_instrument_registry().data_symbols()
+    weights = dict([(code, 1 / len(instrument_list)) for code in instrument_list])
+
+    server = forecastServer(
+        instrument_list,
+        weights=weights,
+        multipliers=getMultiplierDict(),
+        capital=500000,
+        risk_target_tau=0.2,
+        carry_spans=[5, 20, 60, 120],
+    ).start()
+    print("serving forecasts on http://%s:%d" % server.address)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+def _forecast_request_handler(server: forecastServer):
+    class forecastRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metadata":
+                self._reply_with(server.metadata)
+            else:
+                self._reply(404, dict(error="unknown path %s" % self.path))
+
+        def do_POST(self):
+            if self.path == "/refresh":
+                self._reply_with(server.refresh)
+            else:
+                self._reply(404, dict(error="unknown path %s" % self.path))
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply_with(self, function):
+
+            ## a failed refresh (eg the database is down) is a 500 the client can read,
+            ## not a dropped connection
+            try:
+                body = function()
+            except Exception as error:
+                self._reply(500, dict(error="%s: %s" % (type(error).__name__, error)))
+            else:
+                self._reply(200, body)
+
+        def _reply(self, status: int, body: dict):
+            content = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return forecastRequestHandler
+
+
+def _attach_shared_memory(block_name: str) -> shared_memory.SharedMemory:
+
+    ## the server owns the blocks; don't let this process's resource tracker unlink them at exit
+    try:
+        return shared_memory.SharedMemory(name=block_name, track=False)
+    except TypeError:
+        block = shared_memory.SharedMemory(name=block_name)
+        resource_tracker.unregister(block._name, "shared_memory")
+        return block
+
+
+def _date_or_none(index: pd.Index, position: int):
+    if len(index) == 0:
+        return None
+    return index[position].isoformat()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,179 @@
+import os
+
+import numpy as np
 import pandas as pd
 
-def create_fx_series_given_adjusted_prices_dict(adjusted_prices_dict: dict) -> dict:
-    fx_series_dict = dict(
-        [
-            (
-                instrument_code,
-                create_fx_series_given_adjusted_prices(
-                    instrument_code, adjusted_prices
-                ),
-            )
-            for instrument_code, adjusted_prices in adjusted_prices_dict.items()
+try:
+    from .instrument_registry_functions import get_instrument_registry
+except ImportError:
+    from instrument_registry_functions import get_instrument_registry
+
+BASE_CURRENCY = "USD"
+## <currency>_fx.csv: a date column then the rate, one unit of the currency in BASE_CURRENCY
+FX_FILENAME = "%s_fx.csv"
+DEFAULT_FX_DIRECTORY = "."
+
+## FX rates for converting instrument prices into BASE_CURRENCY
+## Each currency is loaded once per process into a date x currency matrix, aligned to
+## every instrument's dates in one reindex. BASE_CURRENCY instruments get the scalar 1.0,
+## which broadcasts anywhere a Series would, rather than a Series of ones per instrument.
+## The currency of each instrument is the Currency column of Symbols.csv, via the
+## instrument registry
+
+
+class fxService:
+    def __init__(
+        self,
+        load_function=None,
+        base_currency: str = BASE_CURRENCY,
+        currency_dict: dict = None,
+    ):
+        ## load_function(currency) -> pd.Series of rates, or None if there are none
+        self._load_function = load_fx_prices_from_csv if load_function is None else load_function
+        self._base_currency = base_currency
+        self._currency_dict = currency_dict
+        self._rates = {}
+
+    def currency_for_instrument(self, instrument_code: str) -> str:
+        if self._currency_dict is None:
+            self._currency_dict = _registry_currency_dict()
+
+        return self._currency_dict.get(instrument_code, self._base_currency)
+
+    def fx_prices(self, currency: str):
+
+        ## None when there are no rates for the currency, callers then use 1.0 as before
+        if currency not in self._rates:
+            fx_prices = self._load_function(currency)
+            if fx_prices is None:
+                print("No FX rates for %s, using 1.0" % currency)
+            self._rates[currency] = fx_prices
+
+        return self._rates[currency]
+
+    def rates_matrix(self, currency_list: list, index: pd.Index) -> pd.DataFrame:
+
+        ## date x currency, each rate the latest on or before the date
+        rates_list = [self.fx_prices(currency) for currency in currency_list]
+        rates = pd.concat(
+            [fx_prices.rename(currency) for currency, fx_prices in zip(currency_list, rates_list)],
+            axis=1,
+            sort=True,
+        )
+
+        return rates.reindex(index, method="ffill")
+
+    def fx_for_instruments(self, index_dict: dict) -> dict:
+
+        ## index_dict maps instrument code to the dates it needs a rate for
+        currency_dict = dict(
+            [
+                (instrument_code, self.currency_for_instrument(instrument_code))
+                for instrument_code in index_dict.keys()
+            ]
+        )
+        converted = [
+            instrument_code
+            for instrument_code, currency in currency_dict.items()
+            if currency != self._base_currency and self.fx_prices(currency) is not None
         ]
-    )
-    return fx_series_dict
+        fx_dict = dict([(instrument_code, 1.0) for instrument_code in index_dict.keys()])
+        if len(converted) == 0:
+            return fx_dict
+
+        index = _sorted_union([index_dict[instrument_code] for instrument_code in converted])
+        currency_list = sorted(set([currency_dict[instrument_code] for instrument_code in converted]))
+        rates = self.rates_matrix(currency_list, index).to_numpy()
+
+        for instrument_code in converted:
+            column = rates[:, currency_list.index(currency_dict[instrument_code])]
+            instrument_index = index_dict[instrument_code]
+            if instrument_index.equals(index):
+                fx_dict[instrument_code] = pd.Series(column, index=instrument_index, copy=False)
+            else:
+                fx_dict[instrument_code] = pd.Series(
+                    column[index.get_indexer(instrument_index)], index=instrument_index
+                )
+
+        return fx_dict
 
-def create_fx_series_given_adjusted_prices(
-    instrument_code: str, adjusted_prices: pd.Series
-) -> pd.Series:
+    def clear(self):
+        self._rates = {}
 
-    currency_for_instrument = fx_dict.get(instrument_code, "usd")
-    if currency_for_instrument == "usd":
-        return pd.Series(1, index=adjusted_prices.index)  ## FX rate, 1 for USD / USD
 
-    fx_prices = get_fx_prices(currency_for_instrument)
-    fx_prices_aligned = fx_prices.reindex(adjusted_prices.index).ffill()
+_fx_service = None
 
-    return fx_prices_aligned
+def get_fx_service() -> fxService:
+    global _fx_service
+    if _fx_service is None:
+        _fx_service = fxService()
 
-fx_dict = dict(eurostx="eur")
+    return _fx_service
+
+def configure_fx_service(**kwargs) -> fxService:
+    ## replace the shared service, eg with a load_function reading rates from SQL
+    global _fx_service
+    _fx_service = fxService(**kwargs)
+
+    return _fx_service
+
+
+def create_fx_series_given_adjusted_prices_dict(adjusted_prices_dict: dict) -> dict:
+    return get_fx_service().fx_for_instruments(
+        dict(
+            [
+                (instrument_code, adjusted_prices.index)
+                for instrument_code, adjusted_prices in adjusted_prices_dict.items()
+            ]
+        )
+    )
+
+def create_fx_series_given_adjusted_prices(instrument_code: str, adjusted_prices: pd.Series):
+    ## FX rate, 1.0 for USD / USD
+    return get_fx_service().fx_for_instruments({instrument_code: adjusted_prices.index})[
+        instrument_code
+    ]
+
+def fx_panel(fx_series_dict: dict, instrument_list: list, index: pd.Index) -> np.ndarray:
+
+    ## date x instrument, scalars broadcast down their column and series are lined up
+    values = np.full((len(index), len(instrument_list)), np.nan)
+    for instrument_idx, instrument_code in enumerate(instrument_list):
+        fx = fx_series_dict[instrument_code]
+        if np.isscalar(fx):
+            values[:, instrument_idx] = fx
+        else:
+            values[:, instrument_idx] = fx.reindex(index).to_numpy(dtype=np.float64)
+
+    return values
 
 def get_fx_prices(currency: str) -> pd.Series:
-    prices_as_df = pd_readcsv("%s_fx.csv" % currency)
-    return prices_as_df.squeeze()
+    return get_fx_service().fx_prices(currency)
+
+
+def load_fx_prices_from_csv(currency: str, directory: str = DEFAULT_FX_DIRECTORY):
+    filename = os.path.join(directory, FX_FILENAME % currency.lower())
+    if not os.path.exists(filename):
+        return None
+
+    prices_as_df = pd.read_csv(filename, index_col=0, parse_dates=True)
+
+    return prices_as_df.iloc[:, 0].astype(np.float64).sort_index()
+
+
+def _sorted_union(index_list: list) -> pd.Index:
+    index = index_list[0]
+    for other_index in index_list[1:]:
+        if not other_index.equals(index):
+            index = index.union(other_index)
+
+    return index
+
+
+def _registry_currency_dict() -> dict:
 
+    ## without a Symbols.csv every instrument is taken to be in BASE_CURRENCY
+    try:
+        return get_instrument_registry().currency_dict()
+    except FileNotFoundError:
+        return {}
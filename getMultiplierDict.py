@@ -1,12 +1,8 @@
-import pandas as pd
+try:
+    from .instrument_registry_functions import get_instrument_registry
+except ImportError:
+    from instrument_registry_functions import get_instrument_registry
 
 def getMultiplierDict():
-    # Read in the multiplier data
-    df = pd.read_csv("Symbols.csv")
-    df.set_index('Data Symbol',inplace=True)
-    # Convert the dataframe to a dictionary
-    m_series = df["Pointsize"].astype(float)
-
-    multiplierDict = m_series.to_dict()
-    # Return the dictionary
-    return multiplierDict
\ No newline at end of file
+    # Pointsize by Data Symbol, from the registry Symbols.csv is parsed into once
+    return get_instrument_registry().multiplier_dict()
@@ -1,57 +1,265 @@
+import numpy as np
 import pandas as pd 
-from sqlalchemy import create_engine
-import urllib
+from pandas.api.types import union_categoricals
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import time
+import urllib.parse
 
 DEFAULT_DATE_FORMAT = "%Y-%m-%d"
 DUSTIN_DATE_FORMAT = "%m/%d/%Y"
 
-def get_data(instrument_list: list):
-    # get all tables from database
-    driver = "ODBC Driver 18 for SQL Server"
-    server = "algo.database.windows.net"
-    username = "dbmaster"
-    password = "Password1"
+DRIVER = "ODBC Driver 18 for SQL Server"
+SERVER = "algo.database.windows.net"
+USERNAME = "dbmaster"
+PASSWORD = "Password1"
 
-    database = "NG_Carver_Data"
+PRICE_DATABASE = "NG_Carver_Data"
+CARRY_DATABASE = "NG_Carver_Data_Carry"
 
-    # Connection string for SQL Server Authentication - do not change
-    params = urllib.parse.quote_plus(fr'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}')
-    engine = create_engine("mssql+pyodbc:///?odbc_connect=%s" % params)
+PRICE_TABLE_SUFFIX = "_Data"
+CARRY_TABLE_SUFFIX = "_Data_Carry"
 
-    # Retrieve a list of all table names in the database - do not change
-    try:
-        table_names_query = "SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_catalog='" + database + "'"
-        table_names = pd.read_sql(table_names_query, engine)['table_name'].tolist()
-    except:
-        print("Error: Unable to retrieve table names from database.")
+## the only columns the pipeline uses from each table
+PRICE_COLUMNS = ["Close", "Unadj_Close"]
+CARRY_COLUMNS = ["PRICE", "CARRY", "PRICE_CONTRACT", "CARRY_CONTRACT"]
+
+## tables per UNION ALL query, chunks are fetched concurrently
+DEFAULT_BATCH_SIZE = 20
+
+## rows per streamed chunk; float32 halves price memory but loses precision,
+## so it is opt in. Integer columns such as contract codes always go to int32 if they fit
+DEFAULT_CHUNKSIZE = 10000
+DEFAULT_FLOAT_DTYPE = "float64"
+## below this many rows a result is kept as read: the category and int32 copies cost
+## more than they save, eg 10 tables of 2000 rows peak higher compacted than not
+DEFAULT_COMPACT_MIN_ROWS = 10000
+
+## sqlalchemy (and through it pyodbc) is imported on first use, not here, so code that
+## only needs the table handling below, such as a run from the local cache, never loads it
+
+class sqlDataAccess:
+    ## one pooled engine per database, built on first use and reused across calls
+    def __init__(
+        self,
+        pool_size: int = 5,
+        max_overflow: int = 5,
+        pool_timeout: float = 30,
+        pool_recycle: int = 1800,
+        database_urls: dict = None,
+        max_concurrency: int = None,
+        retries: int = 2,
+        retry_wait: float = 1.0,
+        chunksize: int = DEFAULT_CHUNKSIZE,
+        compact_min_rows: int = DEFAULT_COMPACT_MIN_ROWS,
+    ):
+
+        self._pool_size = pool_size
+        self._max_overflow = max_overflow
+        self._pool_timeout = pool_timeout
+        self._pool_recycle = pool_recycle
+        ## override the connection url per database, eg sqlite:///prices.db for local testing
+        self._database_urls = dict() if database_urls is None else dict(database_urls)
+        ## never run more table reads at once than the pool can hand out connections
+        if max_concurrency is None:
+            max_concurrency = pool_size
+        self._max_concurrency = max(1, min(max_concurrency, pool_size + max_overflow))
+        self._retries = retries
+        self._retry_wait = retry_wait
+        self._chunksize = chunksize
+        self._compact_min_rows = compact_min_rows
+        self._engines = {}
+
+    def engine(self, database: str):
+        if database not in self._engines:
+            from sqlalchemy import create_engine
+
+            self._engines[database] = create_engine(
+                self.url(database),
+                pool_size=self._pool_size,
+                max_overflow=self._max_overflow,
+                pool_timeout=self._pool_timeout,
+                pool_recycle=self._pool_recycle,
+                pool_pre_ping=True,
+            )
+
+        return self._engines[database]
+
+    def url(self, database: str) -> str:
+        if database in self._database_urls:
+            return self._database_urls[database]
+
+        # Connection string for SQL Server Authentication - do not change
+        params = urllib.parse.quote_plus(fr'DRIVER={DRIVER};SERVER={SERVER};DATABASE={database};UID={USERNAME};PWD={PASSWORD}')
+        return "mssql+pyodbc:///?odbc_connect=%s" % params
+
+    def table_names(self, database: str) -> list:
+        from sqlalchemy import inspect
+
+        return inspect(self.engine(database)).get_table_names()
+
+    def read_sql(self, query: str, database: str, params: dict = None) -> pd.DataFrame:
+        from sqlalchemy import text
+
+        with self.engine(database).connect() as connection:
+            if params is None:
+                return pd.read_sql(query, connection)
+            return pd.read_sql(text(query), connection, params=params)
+
+    def read_sql_compact(
+        self,
+        query: str,
+        database: str,
+        params: dict = None,
+        float_dtype: str = DEFAULT_FLOAT_DTYPE,
+    ) -> pd.DataFrame:
+        ## stream the result over a server side cursor, compacting each chunk as it
+        ## lands so the full object-heavy frame never exists at once. Compacting only
+        ## starts once the result passes compact_min_rows, small pulls are left as read
+        from sqlalchemy import text
+
+        chunks = []
+        row_count = 0
+        compact_types = False
+        with self.engine(database).connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            for chunk in pd.read_sql(
+                text(query), connection, params=params, chunksize=self._chunksize
+            ):
+                row_count += len(chunk)
+                if not compact_types and row_count >= self._compact_min_rows:
+                    compact_types = True
+                    chunks = [_compact_frame(frame, float_dtype=float_dtype) for frame in chunks]
+                chunks.append(
+                    _compact_frame(chunk, float_dtype=float_dtype, compact_types=compact_types)
+                )
+
+        return _concat_compact_frames(chunks)
+
+    def read_sql_tables(
+        self,
+        query_dict: dict,
+        database: str,
+        params_dict: dict = None,
+        float_dtype: str = None,
+    ) -> dict:
+        ## fetch several tables concurrently, returns a dict with the same keys and order
+        ## pass a float_dtype to stream and compact each result with read_sql_compact
+        if len(query_dict) == 0:
+            return {}
+        if params_dict is None:
+            params_dict = {}
+
+        with ThreadPoolExecutor(max_workers=min(self._max_concurrency, len(query_dict))) as executor:
+            futures = dict(
+                [
+                    (
+                        name,
+                        executor.submit(
+                            self._read_sql_with_retry,
+                            query,
+                            database,
+                            params_dict.get(name),
+                            float_dtype,
+                        ),
+                    )
+                    for name, query in query_dict.items()
+                ]
+            )
+
+        return dict([(name, future.result()) for name, future in futures.items()])
+
+    def _read_sql_with_retry(
+        self, query: str, database: str, params: dict = None, float_dtype: str = None
+    ) -> pd.DataFrame:
+
+        ## only a dropped or refused connection is worth another go, anything else
+        ## (a bad table name, a dtype error) goes straight back to the caller
+        from sqlalchemy.exc import DBAPIError, OperationalError
+
+        for attempt in range(self._retries + 1):
+            try:
+                if float_dtype is None:
+                    return self.read_sql(query, database, params=params)
+                return self.read_sql_compact(
+                    query, database, params=params, float_dtype=float_dtype
+                )
+            except DBAPIError as error:
+                transient = isinstance(error, OperationalError) or error.connection_invalidated
+                if not transient or attempt == self._retries:
+                    raise
+                time.sleep(self._retry_wait * (attempt + 1))
+
+    def dispose(self):
+        for engine in self._engines.values():
+            engine.dispose()
+        self._engines = {}
+
+_data_access = sqlDataAccess()
+
+def get_data_access() -> sqlDataAccess:
+    return _data_access
+
+def configure_data_access(**kwargs) -> sqlDataAccess:
+    ## replace the shared data access object, eg to change pool sizes or point at sqlite
+    global _data_access
+    _data_access.dispose()
+    _data_access = sqlDataAccess(**kwargs)
+
+    return _data_access
+
+def get_data(instrument_list: list, start_date=None, float_dtype: str = DEFAULT_FLOAT_DTYPE):
+    dataframes = get_tables_batched(
+        instrument_list,
+        PRICE_DATABASE,
+        PRICE_TABLE_SUFFIX,
+        PRICE_COLUMNS,
+        start_date=start_date,
+        float_dtype=float_dtype,
+    )
+    if dataframes is None:
         return
 
-    # Dictionary to store each table's DataFrame
-    dataframes = {}
+    return prices_from_tables(dataframes)
 
-    usable_list = []
-    # Remove instrument from list table_names if it is not in instrument_list
-    for table_name in table_names:
-        # remove _Data from table name temporarily
-        name = table_name[:-5]
-        if name in instrument_list:
-            usable_list.append(name)
-            
+def get_carry_data(instrument_list: list, start_date=None, float_dtype: str = DEFAULT_FLOAT_DTYPE):
+    carry_data = get_tables_batched(
+        instrument_list,
+        CARRY_DATABASE,
+        CARRY_TABLE_SUFFIX,
+        CARRY_COLUMNS,
+        start_date=start_date,
+        float_dtype=float_dtype,
+    )
+    if carry_data is None:
+        return
 
-    # Remove sysdiagrams from table_names
-    table_names.remove('sysdiagrams')
+    return carry_from_tables(carry_data)
 
-    # Remove _Data from table names
-    for i in range(len(table_names)):
-        table_names[i] = table_names[i][:-5]
+def get_tables(
+    instrument_list: list, database: str, table_suffix: str, after_dates: dict = None
+) -> dict:
+    # get all tables from database, reusing the pooled engine
+    data_access = get_data_access()
 
-    # Print the tables that will be pulled
-    print(sorted(usable_list))
+    usable_list = get_usable_list(instrument_list, database, table_suffix)
+    if usable_list is None:
+        return
 
-    # Loop through all table names, pulling data from each one
+    # Only pull rows after the given date where we have one, eg for a cache refresh
+    if after_dates is None:
+        after_dates = {}
+    query_dict = {}
+    params_dict = {}
     for name in usable_list:
-        table_query = f"SELECT * FROM [{name}_Data]"
-        dataframes[name] = pd.read_sql(table_query, engine)
+        table_query = f"SELECT * FROM [{name}{table_suffix}]"
+        if name in after_dates:
+            table_query += " WHERE [Date] > :after_date"
+            params_dict[name] = dict(after_date=_datetime_param(after_dates[name]))
+        query_dict[name] = table_query
+
+    # Pull every table concurrently over the pooled engine
+    dataframes = data_access.read_sql_tables(query_dict, database, params_dict=params_dict)
 
     # Convert date column to datetime
     for name in usable_list:
@@ -62,76 +270,169 @@ def get_data(instrument_list: list):
         dataframes[name].set_index('Date', inplace=True)
         assert dataframes[name].index.name == 'Date'
 
-    # Get all adjusted close prices in each dataframe
-    adjusted_prices = {}
-    for name in usable_list:
-        adjusted_prices[name] = dataframes[name]['Close']
+    return dataframes
 
-    # Get all unadjusted close prices in each dataframe
-    current_prices = {}
-    for table_name in usable_list:
-        current_prices[table_name] = dataframes[table_name]['Unadj_Close']
-    
-    return adjusted_prices, current_prices
+def get_tables_batched(
+    instrument_list: list,
+    database: str,
+    table_suffix: str,
+    columns: list,
+    start_date=None,
+    after_dates: dict = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    float_dtype: str = DEFAULT_FLOAT_DTYPE,
+) -> dict:
+    ## one UNION ALL query per batch of tables, projecting only the columns we need
+    ## and tagging each row with its instrument, then split back out locally
+    data_access = get_data_access()
 
-def get_carry_data(instrument_list: list):
-    # get all tables from database
-    driver = "ODBC Driver 18 for SQL Server"
-    server = "algo.database.windows.net"
-    username = "dbmaster"
-    password = "Password1"
+    usable_list = get_usable_list(instrument_list, database, table_suffix)
+    if usable_list is None:
+        return
+
+    if after_dates is None:
+        after_dates = {}
+    column_list = ", ".join(
+        ["[Date] AS [Date]"] + ["[%s] AS [%s]" % (column, column) for column in columns]
+    )
+
+    query_dict = {}
+    params_dict = {}
+    for batch_start in range(0, len(usable_list), batch_size):
+        params = {}
+        if start_date is not None:
+            params["start_date"] = _datetime_param(start_date)
+
+        table_queries = []
+        for idx, name in enumerate(usable_list[batch_start : batch_start + batch_size]):
+            ## tag rows with the table's place in the batch, a small int rather than
+            ## a copy of the name on every row
+            table_query = f"SELECT {idx} AS [Instrument], {column_list} FROM [{name}{table_suffix}]"
+
+            conditions = []
+            if start_date is not None:
+                conditions.append("[Date] >= :start_date")
+            if name in after_dates:
+                conditions.append("[Date] > :after_date_%d" % idx)
+                params["after_date_%d" % idx] = _datetime_param(after_dates[name])
+            if len(conditions) > 0:
+                table_query += " WHERE " + " AND ".join(conditions)
 
-    database = "NG_Carver_Data_Carry"
+            table_queries.append(table_query)
 
-    # Connection string for SQL Server Authentication - do not change
-    params = urllib.parse.quote_plus(fr'DRIVER={driver};SERVER={server};DATABASE={database};UID={username};PWD={password}')
-    engine = create_engine("mssql+pyodbc:///?odbc_connect=%s" % params)
+        query_dict[batch_start] = " UNION ALL ".join(table_queries)
+        params_dict[batch_start] = params
 
-    # Retrieve a list of all table names in the database - do not change
+    batches = data_access.read_sql_tables(
+        query_dict, database, params_dict=params_dict, float_dtype=float_dtype
+    )
+    if len(batches) == 0:
+        return {}
+
+    # Dates are already parsed as each chunk streamed in, so split each batch by
+    # instrument, copying every column exactly once
+    value_columns = list(columns)
+    grouped = {}
+    for batch_start, batch in batches.items():
+        for idx, positions in batch.groupby('Instrument', observed=True).indices.items():
+            name = usable_list[batch_start + int(idx)]
+            index = pd.DatetimeIndex(batch['Date'].to_numpy()[positions], name='Date')
+            rows = pd.DataFrame(
+                dict([(column, batch[column].to_numpy()[positions]) for column in value_columns]),
+                index=index,
+            )
+            if not index.is_monotonic_increasing:
+                rows = rows.sort_index()
+            grouped[name] = rows
+
+    empty = next(iter(batches.values()))[['Date'] + value_columns].iloc[:0].set_index('Date')
+    dataframes = dict(
+        [(name, grouped.get(name, empty)) for name in usable_list]
+    )
+
+    return dataframes
+
+def get_usable_list(instrument_list: list, database: str, table_suffix: str) -> list:
+    # Retrieve a list of all table names in the database
     try:
-        table_names_query = "SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_catalog='" + database + "'"
-        table_names = pd.read_sql(table_names_query, engine)['table_name'].tolist()
+        table_names = get_data_access().table_names(database)
     except:
         print("Error: Unable to retrieve table names from database.")
         return
 
-    # Dictionary to store each table's DataFrame
-    carry_data = {}
-
     usable_list = []
     # Remove instrument from list table_names if it is not in instrument_list
     for table_name in table_names:
-        # remove _Data from table name temporarily
-        name = table_name[:-11]
+        # remove the suffix from table name temporarily
+        name = table_name[:-len(table_suffix)]
         if name in instrument_list:
             usable_list.append(name)
             
 
-    # Remove _Data from table names
-    for i in range(len(table_names)):
-        table_names[i] = table_names[i][:-11]
-
     # Print the tables that will be pulled
     print(sorted(usable_list))
 
-    # Loop through all table names, pulling data from each one
-    for name in usable_list:
-        table_query = f"SELECT * FROM [{name}_Data_Carry]"
-        carry_data[name] = pd.read_sql(table_query, engine)
+    return usable_list
 
-    # Convert date column to datetime
-    for name in usable_list:
-        carry_data[name]['Date'] = pd.to_datetime(carry_data[name]['Date'])
+def _datetime_param(date) -> datetime.datetime:
+    ## bound as a datetime, so [Date] is compared as a date and not as text
+    return pd.Timestamp(date).to_pydatetime()
 
-    # Set index to date column
-    for name in usable_list:
-        carry_data[name].set_index('Date', inplace=True)
-        assert carry_data[name].index.name == 'Date'
+def _compact_frame(
+    frame: pd.DataFrame, float_dtype: str = DEFAULT_FLOAT_DTYPE, compact_types: bool = True
+) -> pd.DataFrame:
+    ## compact_types=False only parses the dates and sets the float dtype
+    int32_info = np.iinfo(np.int32)
+    compact = {}
+    for column in frame.columns:
+        values = frame[column]
+        if column == 'Date':
+            values = pd.to_datetime(values)
+        elif not compact_types:
+            if pd.api.types.is_float_dtype(values.dtype):
+                values = values.astype(float_dtype)
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            if len(values) == 0 or (values.min() >= int32_info.min and values.max() <= int32_info.max):
+                values = values.astype(np.int32)
+        elif pd.api.types.is_float_dtype(values.dtype):
+            values = values.astype(float_dtype)
+        elif values.dtype == object:
+            values = values.astype('category')
+        compact[column] = values
+
+    return pd.DataFrame(compact)
+
+def _concat_compact_frames(frames: list) -> pd.DataFrame:
+    ## line up categories first, otherwise concat falls back to object columns
+    frames = list(frames)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            categories = union_categoricals(
+                [frame[column] for frame in frames], ignore_order=True
+            ).categories
+            for frame in frames:
+                frame[column] = pd.Categorical(frame[column], categories=categories)
+
+    return pd.concat(frames, ignore_index=True)
+
+def prices_from_tables(dataframes: dict) -> tuple:
+    # Get all adjusted close prices in each dataframe
+    adjusted_prices = {}
+    for name in dataframes.keys():
+        adjusted_prices[name] = dataframes[name]['Close']
+
+    # Get all unadjusted close prices in each dataframe
+    current_prices = {}
+    for table_name in dataframes.keys():
+        current_prices[table_name] = dataframes[table_name]['Unadj_Close']
+    
+    return adjusted_prices, current_prices
 
+def carry_from_tables(carry_data: dict) -> dict:
     # SET ALL COL NAMES TO CAPS
-    for name in usable_list:
-        carry_data[name].columns = carry_data[name].columns.str.upper()
-    return carry_data
+    return dict(
+        [(name, carry_data[name].rename(columns=str.upper)) for name in carry_data.keys()]
+    )
 
 def main():
     instrument_list = ['CL', 'ES', 'GC', 'HG', 'HO', 'NG', 'RB', 'SI']
@@ -0,0 +1,272 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .risk_functions import calculate_percentage_returns, idm_for_dates
+    from .panel_functions import panel_from_dict
+except ImportError:
+    from risk_functions import calculate_percentage_returns, idm_for_dates
+    from panel_functions import panel_from_dict
+
+IDM_CORRELATION_SPAN_WEEKS = 52
+IDM_MIN_PERIODS_WEEKS = 26
+IDM_CAP = 2.5
+IDM_WEEK_END = "W-FRI"
+IDM_ESTIMATOR_FILENAME = "idm_estimator.pkl"
+
+## Instrument diversification multiplier, IDM = 1 / sqrt(w.rho.wT)
+## rho is an exponentially weighted correlation of weekly percentage returns, so
+## instruments closing at different times of day still line up. Returns aren't demeaned,
+## negative correlations are floored at zero and the IDM is capped at IDM_CAP.
+## Instruments join once they have IDM_MIN_PERIODS_WEEKS returns; until then the
+## weights are rescaled over the ones that have.
+## The state is a set of decayed sums of products, so new weeks are folded in without
+## going back over the history: run it once, save it, then update it each week. Weeks
+## are folded in a block at a time as one matrix product, which is what keeps hundreds
+## of instruments cheap. Only complete weeks go in, and the IDM recorded at the end of
+## a week applies from that date on (idm_for_dates), so no date is sized on returns
+## from after it
+
+
+class idmEstimator:
+    def __init__(
+        self,
+        instrument_list: list,
+        weights: dict,
+        span_weeks: int = IDM_CORRELATION_SPAN_WEEKS,
+        min_periods: int = IDM_MIN_PERIODS_WEEKS,
+    ):
+        self._instrument_list = list(instrument_list)
+        self._weights = np.array(
+            [weights.get(instrument_code, 0.0) for instrument_code in self._instrument_list],
+            dtype=np.float64,
+        )
+        self._decay = 1 - 2 / (span_weeks + 1)
+        self._min_periods = min_periods
+
+        instrument_count = len(self._instrument_list)
+        ## decayed sums over the weeks each pair shares: x_i.x_j, and x_i^2 where j has a return
+        self._cross_products = np.zeros((instrument_count, instrument_count))
+        self._paired_squares = np.zeros((instrument_count, instrument_count))
+        self._observation_count = np.zeros(instrument_count, dtype=np.int64)
+        self._last_week = None
+        self._idm_series = pd.Series(dtype=np.float64)
+
+    @property
+    def instrument_list(self) -> list:
+        return self._instrument_list
+
+    @property
+    def last_week(self):
+        return self._last_week
+
+    @property
+    def idm_series(self) -> pd.Series:
+        ## every IDM recorded so far, by week end
+        return self._idm_series
+
+    def same_setup(self, instrument_list: list, weights: dict) -> bool:
+        return self._instrument_list == list(instrument_list) and np.array_equal(
+            self._weights,
+            [weights.get(instrument_code, 0.0) for instrument_code in self._instrument_list],
+        )
+
+    def update(self, weekly_returns: pd.DataFrame, block_weeks: int = 1) -> pd.Series:
+
+        ## weekly_returns: week x instrument, eg from weekly_percentage_returns. Weeks up to
+        ## last_week are already in, and skipped. The IDM is recorded at the end of each
+        ## block of block_weeks; a bigger block is fewer matrix products when the
+        ## intermediate values aren't needed
+        if self._last_week is not None:
+            weekly_returns = weekly_returns[weekly_returns.index > self._last_week]
+        returns = weekly_returns.reindex(columns=self._instrument_list).to_numpy(
+            dtype=np.float64
+        )
+
+        idm_list = []
+        week_list = []
+        for block_start in range(0, len(returns), block_weeks):
+            block = returns[block_start : block_start + block_weeks]
+            self._add_block(block)
+            idm_list.append(self.idm())
+            week_list.append(weekly_returns.index[block_start + len(block) - 1])
+
+        new_idm_series = pd.Series(
+            idm_list, index=pd.Index(week_list, name=weekly_returns.index.name), dtype=np.float64
+        )
+        if len(week_list) > 0:
+            self._last_week = week_list[-1]
+            self._idm_series = (
+                new_idm_series
+                if len(self._idm_series) == 0
+                else pd.concat([self._idm_series, new_idm_series])
+            )
+
+        return new_idm_series
+
+    def correlation(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            self._correlation_values(),
+            index=self._instrument_list,
+            columns=self._instrument_list,
+        )
+
+    def idm(self) -> float:
+        live = self._observation_count >= self._min_periods
+        weights = np.where(live, self._weights, 0.0)
+        if weights.sum() <= 0:
+            return 1.0
+
+        weights = weights / weights.sum()
+        correlation = self._correlation_values()
+        portfolio_variance = weights @ correlation @ weights
+
+        return float(min(1 / np.sqrt(portfolio_variance), IDM_CAP))
+
+    def _add_block(self, block: np.ndarray):
+
+        ## decay the sums by the block length, then add the block's weeks weighted by
+        ## how far each is from the block end: sums_new = d^b sums + X' diag(d^k) X
+        present = ~np.isnan(block)
+        values = np.where(present, block, 0.0)
+        block_decay = self._decay ** np.arange(len(block) - 1, -1, -1)
+
+        weighted_values = values * block_decay.reshape(-1, 1)
+        self._cross_products *= self._decay ** len(block)
+        self._cross_products += weighted_values.T @ values
+        self._paired_squares *= self._decay ** len(block)
+        self._paired_squares += (weighted_values * values).T @ present.astype(np.float64)
+        self._observation_count += present.sum(axis=0)
+
+    def _correlation_values(self) -> np.ndarray:
+
+        ## pairwise: each instrument's variance over only the weeks it shares with the other
+        normaliser = np.sqrt(self._paired_squares * self._paired_squares.T)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = self._cross_products / normaliser
+        correlation = np.clip(np.nan_to_num(correlation, nan=0.0), 0.0, 1.0)
+        np.fill_diagonal(correlation, 1.0)
+
+        return correlation
+
+
+def weekly_percentage_returns(
+    adjusted_prices_dict: dict, current_prices_dict: dict, instrument_list: list = None
+) -> pd.DataFrame:
+
+    if instrument_list is None:
+        instrument_list = list(adjusted_prices_dict.keys())
+
+    daily_returns = panel_from_dict(
+        dict(
+            [
+                (
+                    instrument_code,
+                    calculate_percentage_returns(
+                        adjusted_prices_dict[instrument_code], current_prices_dict[instrument_code]
+                    ),
+                )
+                for instrument_code in instrument_list
+            ]
+        ),
+        instrument_list,
+    )
+
+    ## a week with no return at all stays NaN rather than becoming a zero return
+    return daily_returns.resample(IDM_WEEK_END).sum(min_count=1)
+
+
+def calculate_idm_series(
+    adjusted_prices_dict: dict,
+    current_prices_dict: dict,
+    weights: dict,
+    span_weeks: int = IDM_CORRELATION_SPAN_WEEKS,
+    min_periods: int = IDM_MIN_PERIODS_WEEKS,
+    block_weeks: int = 1,
+) -> pd.Series:
+
+    instrument_list = list(adjusted_prices_dict.keys())
+    estimator = idmEstimator(
+        instrument_list, weights=weights, span_weeks=span_weeks, min_periods=min_periods
+    )
+
+    return update_idm_estimator(
+        estimator, adjusted_prices_dict, current_prices_dict, block_weeks=block_weeks
+    )
+
+
+def update_idm_estimator(
+    estimator: idmEstimator,
+    adjusted_prices_dict: dict,
+    current_prices_dict: dict,
+    block_weeks: int = 1,
+) -> pd.Series:
+
+    ## folds in the complete weeks after estimator.last_week, returns the whole IDM series.
+    ## Only the prices from the last bar before that week on are needed for the returns
+    instrument_list = [
+        instrument_code
+        for instrument_code in estimator.instrument_list
+        if len(adjusted_prices_dict.get(instrument_code, [])) > 0
+    ]
+    if len(instrument_list) == 0:
+        return estimator.idm_series
+
+    if estimator.last_week is not None:
+        adjusted_prices_dict = _prices_from_week(
+            adjusted_prices_dict, instrument_list, estimator.last_week
+        )
+        current_prices_dict = _prices_from_week(
+            current_prices_dict, instrument_list, estimator.last_week
+        )
+
+    weekly_returns = weekly_percentage_returns(
+        adjusted_prices_dict, current_prices_dict, instrument_list
+    )
+    ## the week still running has more returns to come
+    last_date = max([adjusted_prices_dict[instrument_code].index[-1] for instrument_code in instrument_list])
+    estimator.update(weekly_returns[weekly_returns.index <= last_date], block_weeks=block_weeks)
+
+    return estimator.idm_series
+
+
+def save_idm_estimator(estimator: idmEstimator, filename: str):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename + ".tmp", "wb") as state_file:
+        pickle.dump(estimator, state_file)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_idm_estimator(filename: str) -> idmEstimator:
+    with open(filename, "rb") as state_file:
+        return pickle.load(state_file)
+
+
+def load_or_create_idm_estimator(filename: str, instrument_list: list, weights: dict) -> idmEstimator:
+
+    ## the saved estimator if it was built for the same instruments and weights, else a new one
+    if os.path.exists(filename):
+        estimator = load_idm_estimator(filename)
+        if estimator.same_setup(instrument_list, weights):
+            return estimator
+
+    return idmEstimator(instrument_list, weights)
+
+
+def _prices_from_week(prices_dict: dict, instrument_list: list, last_week) -> dict:
+
+    ## each series from its last bar on or before last_week
+    return dict(
+        [
+            (
+                instrument_code,
+                prices_dict[instrument_code].iloc[
+                    max(prices_dict[instrument_code].index.searchsorted(last_week, side="right") - 1, 0) :
+                ],
+            )
+            for instrument_code in instrument_list
+        ]
+    )
@@ -0,0 +1,501 @@
+import pickle
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .risk_functions import BUSINESS_DAYS_IN_YEAR, VOL_EWM_SPAN, TEN_YEAR_VOL_WINDOW
+    from .risk_functions import initialise_rolling_mean_state, rolling_mean_add, rolling_mean_remove, rolling_mean_value
+    from .risk_functions import initialise_ewm_std_state, ewm_std_add, ewm_std_value
+    from .risk_functions import idm_for_dates
+    from .fdm_functions import fdmEstimator, default_fdm, normalised_forecast_weights
+    from .panel_functions import union_of_indices
+    from .roll_calendar_functions import total_year_frac_from_contract
+except ImportError:
+    from risk_functions import BUSINESS_DAYS_IN_YEAR, VOL_EWM_SPAN, TEN_YEAR_VOL_WINDOW
+    from risk_functions import initialise_rolling_mean_state, rolling_mean_add, rolling_mean_remove, rolling_mean_value
+    from risk_functions import initialise_ewm_std_state, ewm_std_add, ewm_std_value
+    from risk_functions import idm_for_dates
+    from fdm_functions import fdmEstimator, default_fdm, normalised_forecast_weights
+    from panel_functions import union_of_indices
+    from roll_calendar_functions import total_year_frac_from_contract
+
+INCREMENTAL_OUTPUTS = ["std_dev", "average_position", "capped_forecast", "position", "buffered_position"]
+
+## Incremental (append-one-day) mode
+## Each instrument keeps the EWMA accumulators, the ten year vol window and the
+## last buffered position, so a new bar costs O(1) instead of a full recompute.
+## The FDM is pooled across instruments, so it's passed in: a float, or an fdmEstimator
+## that each date's forecasts are folded into before that date's FDM is read off it,
+## as the full path does. Keep the estimator with the states between updates
+
+
+def create_incremental_state_dict_from_history(
+    capital: float,
+    risk_target_tau: float,
+    idm,
+    weights: dict,
+    multipliers: dict,
+    carry_spans: list,
+    adjusted_prices_dict: dict,
+    current_prices_dict: dict,
+    carry_prices_dict: dict,
+    fx_series_dict: dict,
+    buffer_size: float = 0.10,
+    forecast_weights: list = None,
+    fdm=None,
+) -> tuple:
+
+    ## idm is a float, or the IDM series by week end as Carry.estimate_idm_series gives it.
+    ## fdm is a float or an fdmEstimator; without one the history is pooled into a new
+    ## estimator, and later updates keep the last FDM unless they're given one
+    if fdm is None:
+        fdm = fdmEstimator(carry_spans, forecast_weights)
+
+    state_dict = {}
+    history_dict = {}
+    for instrument_code in adjusted_prices_dict.keys():
+        state_dict[instrument_code] = initialise_incremental_state(
+            capital=capital * weights[instrument_code],
+            risk_target_tau=risk_target_tau,
+            multiplier=multipliers[instrument_code],
+            carry_spans=carry_spans,
+            buffer_size=buffer_size,
+            forecast_weights=forecast_weights,
+            fdm=None if isinstance(fdm, fdmEstimator) else fdm,
+        )
+        history_dict[instrument_code] = _history_as_frame(
+            adjusted_price=adjusted_prices_dict[instrument_code],
+            current_price=current_prices_dict[instrument_code],
+            carry_price=carry_prices_dict[instrument_code],
+            fx=fx_series_dict[instrument_code],
+            idm=idm,
+        )
+
+    output_dict = _replay_history(state_dict, history_dict, fdm)
+
+    return state_dict, output_dict
+
+
+def update_incremental_state_dict_from_history(
+    state_dict: dict,
+    adjusted_prices_dict: dict,
+    current_prices_dict: dict,
+    carry_prices_dict: dict,
+    fx_series_dict: dict,
+    after_date_dict: dict,
+    idm=None,
+    fdm=None,
+) -> dict:
+
+    ## feeds each instrument the rows of its history after after_date_dict[instrument_code],
+    ## eg the full tables from a cache refresh; returns the outputs for just those rows.
+    ## Without an idm or an fdm each state keeps the last one it had
+    history_dict = {}
+    for instrument_code in state_dict.keys():
+        history = _history_as_frame(
+            adjusted_price=adjusted_prices_dict[instrument_code],
+            current_price=current_prices_dict[instrument_code],
+            carry_price=carry_prices_dict[instrument_code],
+            fx=fx_series_dict[instrument_code],
+            idm=idm,
+        )
+        after_date = after_date_dict.get(instrument_code)
+        if after_date is not None:
+            history = history[history.index > after_date]
+        history_dict[instrument_code] = history
+
+    return _replay_history(state_dict, history_dict, fdm)
+
+
+def update_incremental_state_dict(state_dict: dict, new_bar_dict: dict, fdm=None) -> dict:
+
+    ## new_bar_dict maps instrument code to a dict with keys matching the
+    ## arguments of update_incremental_state, all for the same date; instruments without
+    ## a new bar are skipped. fdm as update_incremental_state_dict_from_history
+    forecasts_dict = dict(
+        [
+            (instrument_code, _update_forecasts(state_dict[instrument_code], **new_bar))
+            for instrument_code, new_bar in new_bar_dict.items()
+        ]
+    )
+    if isinstance(fdm, fdmEstimator):
+        fdm = _fdm_on_each_date(fdm, [list(forecasts_dict.values())])[0]
+
+    output_dict = dict(
+        [
+            (instrument_code, _apply_fdm(state_dict[instrument_code], forecasts, fdm))
+            for instrument_code, forecasts in forecasts_dict.items()
+        ]
+    )
+
+    return output_dict
+
+
+def initialise_incremental_state(
+    capital: float,
+    risk_target_tau: float,
+    multiplier: float,
+    carry_spans: list,
+    buffer_size: float = 0.10,
+    forecast_weights: list = None,
+    fdm: float = None,
+    idm: float = 1.0,
+) -> dict:
+
+    ## capital is already scaled by the instrument weight, the idm and the fdm can
+    ## change with each bar. Until there's an fdm take the default for the spans
+    if fdm is None:
+        fdm = default_fdm(carry_spans, forecast_weights)
+
+    return dict(
+        capital=capital,
+        idm=idm,
+        risk_target_tau=risk_target_tau,
+        multiplier=multiplier,
+        carry_spans=list(carry_spans),
+        forecast_weights=None
+        if forecast_weights is None
+        else normalised_forecast_weights(len(carry_spans), forecast_weights),
+        fdm=fdm,
+        buffer_size=buffer_size,
+        last_adjusted_price=np.nan,
+        last_current_price=np.nan,
+        vol_ewm=_initialise_ewm_std(VOL_EWM_SPAN),
+        ten_year_vol=_initialise_rolling_mean(TEN_YEAR_VOL_WINDOW),
+        last_ann_carry=np.nan,
+        last_ann_price_vol=np.nan,
+        ## the carry smoothing calls ewm(span), which pandas takes as the centre of mass
+        carry_ewm=dict([(span, _initialise_ewm_mean(com=span)) for span in carry_spans]),
+        last_upper_buffer=np.nan,
+        last_lower_buffer=np.nan,
+        buffered_position=None,
+    )
+
+
+def update_incremental_state(
+    state: dict,
+    adjusted_price: float,
+    current_price: float,
+    price: float,
+    carry: float,
+    price_contract: float,
+    carry_contract: float,
+    fx: float = 1.0,
+    has_price: bool = True,
+    has_carry: bool = True,
+    idm: float = None,
+    fdm: float = None,
+) -> dict:
+
+    ## has_price / has_carry say whether the instrument has a price bar / carry row on this
+    ## date. The full path keeps each on its own calendar, so the vol and the average
+    ## position only move on price bars and the carry is only carried forward on carry rows
+    forecasts = _update_forecasts(
+        state,
+        adjusted_price=adjusted_price,
+        current_price=current_price,
+        price=price,
+        carry=carry,
+        price_contract=price_contract,
+        carry_contract=carry_contract,
+        fx=fx,
+        has_price=has_price,
+        has_carry=has_carry,
+        idm=idm,
+    )
+
+    return _apply_fdm(state, forecasts, fdm)
+
+
+def save_incremental_state(state_dict: dict, filename: str):
+    with open(filename, "wb") as state_file:
+        pickle.dump(state_dict, state_file)
+
+
+def load_incremental_state(filename: str) -> dict:
+    with open(filename, "rb") as state_file:
+        return pickle.load(state_file)
+
+
+def _replay_history(state_dict: dict, history_dict: dict, fdm) -> dict:
+
+    ## the forecasts for every row first, so an estimator can pool each date across
+    ## instruments, then the FDM, positions and buffers
+    forecasts_dict = dict(
+        [
+            (
+                instrument_code,
+                [
+                    _update_forecasts(state_dict[instrument_code], *row)
+                    for row in history.itertuples(index=False, name=None)
+                ],
+            )
+            for instrument_code, history in history_dict.items()
+        ]
+    )
+    fdm_dict = _fdm_for_history(fdm, history_dict, forecasts_dict)
+
+    output_dict = {}
+    for instrument_code, history in history_dict.items():
+        outputs = [
+            _apply_fdm(state_dict[instrument_code], forecasts, row_fdm)
+            for forecasts, row_fdm in zip(forecasts_dict[instrument_code], fdm_dict[instrument_code])
+        ]
+        output_dict[instrument_code] = pd.DataFrame(
+            outputs, index=history.index, columns=INCREMENTAL_OUTPUTS
+        )
+
+    return output_dict
+
+
+def _fdm_for_history(fdm, history_dict: dict, forecasts_dict: dict) -> dict:
+
+    ## the FDM on each history row of each instrument
+    if not isinstance(fdm, fdmEstimator):
+        return dict(
+            [(instrument_code, [fdm] * len(history)) for instrument_code, history in history_dict.items()]
+        )
+
+    index_list = [history.index for history in history_dict.values() if len(history) > 0]
+    if len(index_list) == 0:
+        return dict([(instrument_code, []) for instrument_code in history_dict.keys()])
+    index = union_of_indices(index_list)
+
+    ## the forecasts by date, in instrument order as the panel has them
+    row_dict = dict(
+        [
+            (instrument_code, index.get_indexer(history.index))
+            for instrument_code, history in history_dict.items()
+        ]
+    )
+    forecasts_by_date = [[] for _ in range(len(index))]
+    for instrument_code, rows in row_dict.items():
+        for row, forecasts in zip(rows, forecasts_dict[instrument_code]):
+            forecasts_by_date[row].append(forecasts)
+    fdm_values = _fdm_on_each_date(fdm, forecasts_by_date)
+
+    return dict(
+        [(instrument_code, fdm_values[rows]) for instrument_code, rows in row_dict.items()]
+    )
+
+
+def _fdm_on_each_date(fdm_estimator: fdmEstimator, forecasts_by_date: list) -> np.ndarray:
+
+    ## forecasts_by_date: for each date, the forecasts of the instruments with a row
+    instrument_count = max([len(forecasts_list) for forecasts_list in forecasts_by_date] + [1])
+    span_count = len(fdm_estimator.weights)
+    forecast_panel = np.full((len(forecasts_by_date), instrument_count, span_count), np.nan)
+    for row, forecasts_list in enumerate(forecasts_by_date):
+        for column, forecasts in enumerate(forecasts_list):
+            forecast_panel[row, column] = forecasts["span_forecasts"]
+
+    return fdm_estimator.update([forecast_panel[:, :, span_idx] for span_idx in range(span_count)])
+
+
+def _update_forecasts(
+    state: dict,
+    adjusted_price: float,
+    current_price: float,
+    price: float,
+    carry: float,
+    price_contract: float,
+    carry_contract: float,
+    fx: float = 1.0,
+    has_price: bool = True,
+    has_carry: bool = True,
+    idm: float = None,
+) -> dict:
+
+    ## everything up to the forecast for each span; the FDM needs the other instruments
+    if idm is not None:
+        state["idm"] = idm
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if has_price:
+            ## Risk, as calculate_variable_standard_deviation_for_risk_targeting
+            daily_return = np.float64(adjusted_price - state["last_adjusted_price"]) / (
+                state["last_current_price"]
+            )
+            state["last_adjusted_price"] = adjusted_price
+            state["last_current_price"] = current_price
+
+            annualised_std_dev = _update_ewm_std(state["vol_ewm"], daily_return) * (
+                BUSINESS_DAYS_IN_YEAR ** 0.5
+            )
+            ten_year_vol = _update_rolling_mean(state["ten_year_vol"], annualised_std_dev)
+            std_dev = 0.3 * ten_year_vol + 0.7 * annualised_std_dev
+
+            ## Average position, as calculate_position_series_given_variable_risk
+            daily_risk_price_terms = std_dev / (BUSINESS_DAYS_IN_YEAR ** 0.5) * current_price
+            average_position = (
+                state["capital"]
+                * state["idm"]
+                * state["risk_target_tau"]
+                / (
+                    state["multiplier"]
+                    * fx
+                    * daily_risk_price_terms
+                    * (BUSINESS_DAYS_IN_YEAR ** 0.5)
+                )
+            )
+
+            ann_price_vol = std_dev * current_price
+            if not np.isnan(ann_price_vol):
+                state["last_ann_price_vol"] = ann_price_vol
+        else:
+            std_dev = np.nan
+            average_position = np.nan
+
+        ## Forecast, as calculate_capped_forecast
+        contract_diff = total_year_frac_from_contract(
+            np.float64(carry_contract)
+        ) - total_year_frac_from_contract(np.float64(price_contract))
+        ann_carry = np.float64(price - carry) / contract_diff
+        if has_carry and not np.isnan(ann_carry):
+            state["last_ann_carry"] = ann_carry
+
+        ## the carry and the vol are aligned on the union of dates, so a date missing
+        ## either is a gap in the smoothed forecast, not a repeat of the last value
+        if has_price and has_carry:
+            risk_adj_carry = np.float64(state["last_ann_carry"]) / state["last_ann_price_vol"]
+        else:
+            risk_adj_carry = np.nan
+
+        span_forecasts = [
+            np.clip(_update_ewm_mean(state["carry_ewm"][span], risk_adj_carry) * 30, -20, 20)
+            for span in state["carry_spans"]
+        ]
+
+    return dict(std_dev=std_dev, average_position=average_position, span_forecasts=span_forecasts)
+
+
+def _apply_fdm(state: dict, forecasts: dict, fdm: float = None) -> dict:
+
+    ## the rest of the bar once the FDM for the date is known
+    if fdm is not None:
+        state["fdm"] = fdm
+
+    span_forecasts = forecasts["span_forecasts"]
+    average_position = forecasts["average_position"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if state["forecast_weights"] is None:
+            average_forecast = sum(span_forecasts) / len(span_forecasts)
+        else:
+            average_forecast = sum(
+                [weight * forecast for weight, forecast in zip(state["forecast_weights"], span_forecasts)]
+            )
+        capped_forecast = np.clip(average_forecast * state["fdm"], -20, 20)
+
+        position = capped_forecast * average_position / 10
+
+        ## Buffering, as apply_buffer
+        buffer = abs(average_position) * state["buffer_size"]
+        upper_buffer = position + buffer
+        lower_buffer = position - buffer
+        if not np.isnan(upper_buffer):
+            state["last_upper_buffer"] = np.round(upper_buffer)
+        if not np.isnan(lower_buffer):
+            state["last_lower_buffer"] = np.round(lower_buffer)
+
+        if state["buffered_position"] is None:
+            buffered_position = 0.0 if np.isnan(position) else position
+        else:
+            buffered_position = state["buffered_position"]
+            if buffered_position > state["last_upper_buffer"]:
+                buffered_position = state["last_upper_buffer"]
+            elif buffered_position < state["last_lower_buffer"]:
+                buffered_position = state["last_lower_buffer"]
+        state["buffered_position"] = buffered_position
+
+    return dict(
+        std_dev=forecasts["std_dev"],
+        average_position=average_position,
+        capped_forecast=capped_forecast,
+        position=position,
+        buffered_position=buffered_position,
+    )
+
+
+def _history_as_frame(
+    adjusted_price: pd.Series,
+    current_price: pd.Series,
+    carry_price: pd.DataFrame,
+    fx,
+    idm=None,
+) -> pd.DataFrame:
+
+    history = pd.DataFrame(
+        dict(
+            adjusted_price=adjusted_price,
+            current_price=current_price,
+            price=carry_price["PRICE"],
+            carry=carry_price["CARRY"],
+            price_contract=carry_price["PRICE_CONTRACT"],
+            carry_contract=carry_price["CARRY_CONTRACT"],
+        )
+    )
+    history["fx"] = pd.Series(fx, index=history.index) if np.isscalar(fx) else fx
+    history["has_price"] = history.index.isin(adjusted_price.index)
+    history["has_carry"] = history.index.isin(carry_price.index)
+    if idm is not None:
+        history["idm"] = idm_for_dates(idm, history.index)
+
+    return history
+
+
+## Online versions of the pandas window calculations, matching
+## ewm(com).mean(), ewm(span=span).std() and rolling(window, min_periods=1).mean()
+
+def _initialise_ewm_mean(com: float) -> dict:
+    return dict(alpha=1.0 / (1.0 + com), mean=np.nan, old_wt=1.0)
+
+
+def _update_ewm_mean(ewm_state: dict, value: float) -> float:
+
+    ## a missing value leaves the mean but still ages the old weight, as pandas does
+    ## with ignore_na=False
+    if np.isnan(value):
+        if not np.isnan(ewm_state["mean"]):
+            ewm_state["old_wt"] = ewm_state["old_wt"] * (1.0 - ewm_state["alpha"])
+        return ewm_state["mean"]
+
+    if np.isnan(ewm_state["mean"]):
+        ewm_state["mean"] = value
+        return value
+
+    old_wt = ewm_state["old_wt"] * (1.0 - ewm_state["alpha"])
+    if ewm_state["mean"] != value:
+        ewm_state["mean"] = (old_wt * ewm_state["mean"] + value) / (old_wt + 1.0)
+    ewm_state["old_wt"] = old_wt + 1.0
+
+    return ewm_state["mean"]
+
+
+def _initialise_ewm_std(span: int) -> dict:
+    return dict(alpha=2.0 / (span + 1.0), state=initialise_ewm_std_state())
+
+
+def _update_ewm_std(ewm_state: dict, value: float) -> float:
+
+    ## same accumulator helpers as the batched kernel in risk_functions
+    ewm_std_add(ewm_state["state"], value, ewm_state["alpha"])
+
+    return ewm_std_value(ewm_state["state"])
+
+
+def _initialise_rolling_mean(window: int) -> dict:
+    return dict(values=deque(maxlen=window), state=initialise_rolling_mean_state())
+
+
+def _update_rolling_mean(rolling_state: dict, value: float) -> float:
+
+    ## same running sum helpers as the batched kernel in risk_functions
+    values = rolling_state["values"]
+    if len(values) == values.maxlen:
+        rolling_mean_remove(rolling_state["state"], values[0])
+    values.append(value)
+    rolling_mean_add(rolling_state["state"], value)
+
+    return rolling_mean_value(rolling_state["state"], 1)
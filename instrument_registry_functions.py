@@ -0,0 +1,183 @@
+import csv
+import os
+
+import numpy as np
+
+## next to this module, so it doesn't matter which directory it's run from
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SYMBOLS_FILENAME = os.path.join(MODULE_DIRECTORY, "Symbols.csv")
+DEFAULT_REGISTRY_CACHE_FILENAME = os.path.join(MODULE_DIRECTORY, "data_cache", "symbols.npz")
+
+## Symbols.csv column -> registry field and type
+SYMBOL_FIELDS = [
+    ("Asset", "asset", str),
+    ("Description", "description", str),
+    ("Pointsize", "multiplier", float),
+    ("Currency", "currency", str),
+    ("Class", "asset_class", str),
+    ("Region", "region", str),
+    ("IB Sym", "ib_symbol", str),
+    ("Data Symbol", "data_symbol", str),
+    ("Exchange", "exchange", str),
+    ("IB Mult", "ib_multiplier", float),
+    ("MC Symbol", "mc_symbol", str),
+    ("Data", "data_start_year", int),
+]
+## symbol kinds instruments can be looked up by
+LOOKUP_FIELDS = dict(data="data_symbol", ib="ib_symbol", mc="mc_symbol")
+
+## Instrument metadata from Symbols.csv, parsed once per process
+## One numpy array per field, in file order, and a dict from each kind of symbol to its
+## row, so a lookup is a dict hit and a getter for a list of instruments is one take:
+##   registry = get_instrument_registry()
+##   registry.multipliers(["ES", "GC"]) -> array([50., 100.])
+##   registry.data_symbol("CAC40", by="ib") -> "FCE"
+## The parsed arrays are kept in an npz next to the data cache, keyed on the csv's size
+## and modification time, so loading needs neither pandas nor the csv parse
+
+
+class instrumentRegistry:
+    def __init__(self, fields: dict):
+        self._fields = fields
+        self._rows = dict(
+            [
+                (
+                    kind,
+                    dict([(symbol, row) for row, symbol in enumerate(fields[field_name].tolist())]),
+                )
+                for kind, field_name in LOOKUP_FIELDS.items()
+            ]
+        )
+
+    def __len__(self) -> int:
+        return len(self._fields["data_symbol"])
+
+    def __contains__(self, data_symbol: str) -> bool:
+        return data_symbol in self._rows["data"]
+
+    def field_names(self) -> list:
+        return list(self._fields.keys())
+
+    def data_symbols(self) -> list:
+        return self._fields["data_symbol"].tolist()
+
+    def row(self, symbol: str, by: str = "data") -> int:
+        try:
+            return self._rows[by][symbol]
+        except KeyError:
+            raise KeyError("No instrument with %s symbol %s in the registry" % (by, symbol))
+
+    def rows(self, instrument_list: list, by: str = "data") -> np.ndarray:
+        return np.array([self.row(symbol, by=by) for symbol in instrument_list], dtype=np.intp)
+
+    def get(self, field_name: str, instrument_list: list = None, by: str = "data") -> np.ndarray:
+
+        ## aligned with instrument_list, or the whole column in file order
+        values = self._fields[field_name]
+        if instrument_list is None:
+            return values
+
+        return values[self.rows(instrument_list, by=by)]
+
+    def multipliers(self, instrument_list: list = None) -> np.ndarray:
+        return self.get("multiplier", instrument_list)
+
+    def currencies(self, instrument_list: list = None) -> np.ndarray:
+        return self.get("currency", instrument_list)
+
+    def asset_classes(self, instrument_list: list = None) -> np.ndarray:
+        return self.get("asset_class", instrument_list)
+
+    def exchanges(self, instrument_list: list = None) -> np.ndarray:
+        return self.get("exchange", instrument_list)
+
+    def data_symbol(self, symbol: str, by: str = "data") -> str:
+        return str(self._fields["data_symbol"][self.row(symbol, by=by)])
+
+    def record(self, symbol: str, by: str = "data") -> dict:
+        row = self.row(symbol, by=by)
+
+        return dict(
+            [(field_name, values[row].item()) for field_name, values in self._fields.items()]
+        )
+
+    def field_dict(self, field_name: str) -> dict:
+        ## data symbol -> value, for code that wants a dict
+        return dict(zip(self.data_symbols(), self._fields[field_name].tolist()))
+
+    def multiplier_dict(self) -> dict:
+        return self.field_dict("multiplier")
+
+    def currency_dict(self) -> dict:
+        return self.field_dict("currency")
+
+    def save(self, filename: str, source_stamp: tuple = (0, 0)):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename + ".tmp", "wb") as cache_file:
+            np.savez(cache_file, _source_stamp=np.array(source_stamp, dtype=np.int64), **self._fields)
+        os.replace(filename + ".tmp", filename)
+
+
+def parse_symbols_file(filename: str = SYMBOLS_FILENAME) -> instrumentRegistry:
+    with open(filename, "r", newline="") as symbols_file:
+        row_list = list(csv.DictReader(symbols_file))
+
+    fields = {}
+    for column, field_name, field_type in SYMBOL_FIELDS:
+        values = [field_type(row[column].strip()) for row in row_list]
+        if field_name == "currency":
+            values = [currency.upper() for currency in values]
+        if field_type is str:
+            fields[field_name] = np.array(values, dtype=str)
+        else:
+            fields[field_name] = np.array(values, dtype=np.float64 if field_type is float else np.int64)
+
+    return instrumentRegistry(fields)
+
+
+def load_instrument_registry(
+    filename: str = SYMBOLS_FILENAME,
+    cache_filename: str = DEFAULT_REGISTRY_CACHE_FILENAME,
+) -> instrumentRegistry:
+
+    ## cache_filename=None always parses the csv
+    source_stamp = _source_stamp(filename)
+    if cache_filename is not None and os.path.exists(cache_filename):
+        with np.load(cache_filename, allow_pickle=False) as cached:
+            if tuple(cached["_source_stamp"].tolist()) == source_stamp:
+                return instrumentRegistry(
+                    dict([(name, cached[name]) for name in cached.files if name != "_source_stamp"])
+                )
+
+    registry = parse_symbols_file(filename)
+    if cache_filename is not None:
+        ## the cache only saves a parse next time, so a read only checkout still loads
+        try:
+            registry.save(cache_filename, source_stamp)
+        except OSError:
+            pass
+
+    return registry
+
+
+_instrument_registry = None
+
+def get_instrument_registry() -> instrumentRegistry:
+    global _instrument_registry
+    if _instrument_registry is None:
+        _instrument_registry = load_instrument_registry()
+
+    return _instrument_registry
+
+def configure_instrument_registry(**kwargs) -> instrumentRegistry:
+    ## reload from another file or cache, eg configure_instrument_registry(cache_filename=None)
+    global _instrument_registry
+    _instrument_registry = load_instrument_registry(**kwargs)
+
+    return _instrument_registry
+
+
+def _source_stamp(filename: str) -> tuple:
+    file_stat = os.stat(filename)
+
+    return file_stat.st_size, file_stat.st_mtime_ns
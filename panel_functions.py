@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+## Helpers for moving between the per-instrument dicts and wide date x instrument panels.
+## Instruments trade on different calendars, so a panel is built on the union of dates
+## together with a presence mask marking the rows each instrument actually has
+
+
+def panel_from_dict(
+    series_dict: dict, list_of_instruments: list, index: pd.Index = None
+) -> pd.DataFrame:
+
+    ## index, if given, must cover every series' dates, eg from union_of_indices
+    series_list = [series_dict[instrument_code] for instrument_code in list_of_instruments]
+    if not all(
+        isinstance(series, pd.Series) and series.dtype.kind == "f" for series in series_list
+    ):
+        panel = pd.concat(series_list, axis=1, keys=list_of_instruments, sort=True)
+        if index is not None:
+            panel = panel.reindex(index)
+        return panel
+
+    ## float series: scatter each into one preallocated array, much cheaper than concat
+    if index is None:
+        index = union_of_indices([series.index for series in series_list])
+    ## column major, so each instrument is contiguous and the frame wraps it without a copy
+    values = np.full((len(index), len(series_list)), np.nan, order="F")
+    for instrument_idx, series in enumerate(series_list):
+        values[_positions_in(index, series.index), instrument_idx] = series.to_numpy()
+
+    return pd.DataFrame(values, index=index, columns=list_of_instruments)
+
+
+def presence_from_index_dict(
+    index_dict: dict, list_of_instruments: list, index: pd.Index = None
+) -> pd.DataFrame:
+
+    index_list = [index_dict[instrument_code] for instrument_code in list_of_instruments]
+    if index is None:
+        index = union_of_indices(index_list)
+    present = np.zeros((len(index), len(index_list)), dtype=np.bool_, order="F")
+    for instrument_idx, instrument_index in enumerate(index_list):
+        present[_positions_in(index, instrument_index), instrument_idx] = True
+
+    return pd.DataFrame(present, index=index, columns=list_of_instruments)
+
+
+def union_of_indices(index_list: list) -> pd.Index:
+
+    ## sorted union, as concat(sort=True) builds; calendars are often shared, so
+    ## drop repeats first and skip the work entirely if there's only one
+    distinct_indices = []
+    candidates = {}
+    for index in index_list:
+        key = (len(index), index[0], index[-1]) if len(index) > 0 else (0,)
+        same_key = candidates.setdefault(key, [])
+        if not any(index.equals(distinct_index) for distinct_index in same_key):
+            same_key.append(index)
+            distinct_indices.append(index)
+
+    if len(distinct_indices) == 1:
+        return distinct_indices[0]
+
+    ## ragged start and end dates on one calendar: the longest already covers the rest
+    longest_index = max(distinct_indices, key=len)
+    if longest_index.is_monotonic_increasing and all(
+        _block_in(longest_index.to_numpy(), index.to_numpy()) is not None
+        for index in distinct_indices
+    ):
+        return longest_index
+
+    return distinct_indices[0].append(distinct_indices[1:]).unique().sort_values()
+
+
+def carry_own_rows_forward(panel: pd.DataFrame, present: pd.DataFrame) -> pd.DataFrame:
+
+    ## fill the gaps between an instrument's own rows with its last own row, NaN or not,
+    ## so diff / shift on the panel see the same neighbours as on the instrument's own dates.
+    ## Rows before its first or after its last own row are NaN
+    present_values = present.to_numpy()
+    values = np.where(present_values, panel.to_numpy(dtype=np.float64), np.nan)
+
+    gaps = columns_with_gaps(present_values)
+    if gaps.any():
+        row_count = values.shape[0]
+        gap_present = present_values[:, gaps]
+        last_own_row = np.where(gap_present, np.arange(row_count).reshape(-1, 1), -1)
+        last_own_row = np.maximum.accumulate(last_own_row, axis=0)
+
+        gap_values = np.take_along_axis(values[:, gaps], np.maximum(last_own_row, 0), axis=0)
+        after_last_own_row = last_own_row[-1] < np.arange(row_count).reshape(-1, 1)
+        gap_values[(last_own_row < 0) | after_last_own_row] = np.nan
+        values[:, gaps] = gap_values
+
+    return pd.DataFrame(values, index=panel.index, columns=panel.columns)
+
+
+def apply_to_own_rows(window_function, values: np.ndarray, present: np.ndarray) -> np.ndarray:
+
+    ## columns whose own rows are one unbroken block go through a single wide call,
+    ## columns with gaps in their calendar are squeezed down to their own rows
+    values = np.where(present, values, np.nan)
+    result = np.full(values.shape, np.nan)
+    has_gaps = columns_with_gaps(present)
+
+    unbroken = np.flatnonzero(~has_gaps)
+    if len(unbroken) > 0:
+        result[:, unbroken] = window_function(pd.DataFrame(values[:, unbroken]))
+
+    for instrument_idx in np.flatnonzero(has_gaps):
+        own_rows = present[:, instrument_idx]
+        result[own_rows, instrument_idx] = window_function(
+            pd.DataFrame(values[own_rows, instrument_idx])
+        )[:, 0]
+
+    result[~present] = np.nan
+
+    return result
+
+
+def columns_with_gaps(present: np.ndarray) -> np.ndarray:
+
+    ## True for columns whose own rows aren't one unbroken block; rows before an
+    ## instrument starts or after it stops never matter to a window calculation
+    row_count = present.shape[0]
+    own_row_count = present.sum(axis=0)
+    first_own_row = present.argmax(axis=0)
+    last_own_row = row_count - 1 - present[::-1].argmax(axis=0)
+
+    return (own_row_count > 0) & (last_own_row - first_own_row + 1 != own_row_count)
+
+
+def dict_from_panel(panel: pd.DataFrame, present: pd.DataFrame) -> dict:
+    return dict(
+        [
+            (instrument_code, panel[instrument_code][present[instrument_code]])
+            for instrument_code in panel.columns
+        ]
+    )
+
+
+def _positions_in(index: pd.Index, sub_index: pd.Index):
+
+    ## the rows of index holding each date of sub_index; every date has to be there
+    if index is sub_index:
+        return slice(None)
+
+    if not index.is_monotonic_increasing:
+        positions = index.get_indexer(sub_index)
+        if (positions < 0).any():
+            raise KeyError(
+                "%d of %d dates aren't in the index" % ((positions < 0).sum(), len(positions))
+            )
+        return positions
+
+    ## plain numpy on the date values, this runs once per instrument
+    index_values = index.to_numpy()
+    sub_values = sub_index.to_numpy()
+
+    ## the same calendar, or a later start / earlier end on it, is just a slice
+    block = _block_in(index_values, sub_values)
+    if block is not None:
+        return block
+
+    ## the union is sorted, so a binary search finds each date without hashing; it
+    ## lands somewhere for a date that isn't there too, so check what it found
+    positions = np.searchsorted(index_values, sub_values)
+    found = positions < len(index_values)
+    found[found] = index_values[positions[found]] == sub_values[found]
+    if not found.all():
+        raise KeyError(
+            "%d of %d dates aren't in the index, eg %s"
+            % ((~found).sum(), len(found), sub_values[~found][0])
+        )
+
+    return positions
+
+
+def _block_in(index_values: np.ndarray, sub_values: np.ndarray):
+
+    ## the slice of index_values equal to sub_values, or None if it isn't one block
+    start = np.searchsorted(index_values, sub_values[0]) if len(sub_values) > 0 else 0
+    block = slice(start, start + len(sub_values))
+    if np.array_equal(index_values[block], sub_values):
+        return block
+
+    return None
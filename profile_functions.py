@@ -0,0 +1,188 @@
+import json
+import os
+import platform
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+import numpy as np
+
+## resource is unix only, without it we skip the RSS figures
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## CARRY_PROFILE=1 profiles and writes the report to DEFAULT_REPORT_FILENAME,
+## any other non empty value (bar 0) is taken as the report path.
+## CARRY_PROFILE_MEMORY=1 adds tracemalloc figures, which slows the run down
+PROFILE_ENV_VAR = "CARRY_PROFILE"
+PROFILE_MEMORY_ENV_VAR = "CARRY_PROFILE_MEMORY"
+DEFAULT_REPORT_FILENAME = "carry_profile_%Y%m%d_%H%M%S.json"
+
+## Per stage timing and memory instrumentation
+## Each stage records wall time, CPU time, peak RSS and optionally the tracemalloc
+## delta and peak, plus the rows and bytes it returned for each instrument. Stages run
+## the whole universe as one panel, so there is no time per instrument to report.
+## When disabled the wrappers hand back the undecorated stage runner, so the cost is
+## one check
+
+
+class stageProfiler:
+    def __init__(
+        self, enabled: bool = False, trace_memory: bool = False, report_filename: str = None
+    ):
+        self._enabled = enabled
+        self._trace_memory = trace_memory
+        self._report_filename = report_filename
+        self._started = datetime.now()
+        self._records = []
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def stage(self, stage_name: str, function_name: str = None):
+        if not self._enabled:
+            return nullcontext({})
+
+        return self._profile_stage(stage_name, function_name)
+
+    def wrap(self, run_stage):
+
+        ## run_stage has the signature of stageCache.call: (stage_name, function, **kwargs)
+        if not self._enabled:
+            return run_stage
+
+        def profiled_run_stage(stage_name: str, function, **kwargs):
+            with self._profile_stage(stage_name, function.__name__) as record:
+                output = run_stage(stage_name, function, **kwargs)
+                self.record_output(record, output)
+
+            return output
+
+        return profiled_run_stage
+
+    def record_output(self, record: dict, output):
+        ## size of each instrument's output for a stage() block, eg the dicts a SQL load returns
+        if self._enabled:
+            record["instruments"] = _instrument_breakdown(output)
+
+    def report(self) -> dict:
+        return dict(
+            started=self._started.isoformat(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            trace_memory=self._trace_memory,
+            total_wall_seconds=sum([record["wall_seconds"] for record in self._records]),
+            total_cpu_seconds=sum([record["cpu_seconds"] for record in self._records]),
+            stages=self._records,
+        )
+
+    def write_report(self, filename: str = None) -> str:
+        if filename is None:
+            filename = self._report_filename
+        if filename is None:
+            filename = self._started.strftime(DEFAULT_REPORT_FILENAME)
+
+        with open(filename, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+        return filename
+
+    def clear(self):
+        self._records = []
+
+    @contextmanager
+    def _profile_stage(self, stage_name: str, function_name: str = None):
+        record = dict(stage=stage_name, function=function_name)
+
+        started_tracing = False
+        if self._trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            traced_memory_before = tracemalloc.get_traced_memory()[0]
+
+        rss_peak_before = _rss_peak_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - wall_start
+            record["cpu_seconds"] = time.process_time() - cpu_start
+
+            rss_peak_after = _rss_peak_mb()
+            record["rss_peak_mb"] = rss_peak_after
+            record["rss_peak_growth_mb"] = (
+                None if rss_peak_after is None else rss_peak_after - rss_peak_before
+            )
+
+            if self._trace_memory:
+                traced_memory, traced_peak = tracemalloc.get_traced_memory()
+                record["tracemalloc_delta_mb"] = (traced_memory - traced_memory_before) / 1e6
+                record["tracemalloc_peak_mb"] = (traced_peak - traced_memory_before) / 1e6
+                if started_tracing:
+                    tracemalloc.stop()
+
+            self._records.append(record)
+
+
+def profiler_from_environment() -> stageProfiler:
+    setting = os.environ.get(PROFILE_ENV_VAR, "")
+    enabled = setting not in ["", "0"]
+
+    return stageProfiler(
+        enabled=enabled,
+        trace_memory=os.environ.get(PROFILE_MEMORY_ENV_VAR, "") not in ["", "0"],
+        report_filename=None if setting in ["", "0", "1"] else setting,
+    )
+
+
+_profiler = None
+
+def get_profiler() -> stageProfiler:
+    global _profiler
+    if _profiler is None:
+        _profiler = profiler_from_environment()
+
+    return _profiler
+
+def configure_profiler(**kwargs) -> stageProfiler:
+    ## replace the shared profiler, eg configure_profiler(enabled=True) from a notebook
+    global _profiler
+    _profiler = stageProfiler(**kwargs)
+
+    return _profiler
+
+
+def _rss_peak_mb():
+    if resource is None:
+        return None
+
+    ## ru_maxrss is kilobytes on linux, bytes on macOS
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        return rss_peak / 1e6
+
+    return rss_peak / 1e3
+
+
+def _instrument_breakdown(output) -> dict:
+
+    ## stages hand back dicts keyed by instrument; report the size of each entry
+    if not isinstance(output, dict):
+        return {}
+
+    breakdown = {}
+    for instrument_code, value in output.items():
+        values = getattr(value, "values", value)
+        breakdown[str(instrument_code)] = dict(
+            rows=len(value) if hasattr(value, "__len__") else None,
+            bytes=int(np.asarray(values).nbytes) if hasattr(value, "__len__") else None,
+        )
+
+    return breakdown
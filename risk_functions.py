@@ -1,7 +1,16 @@
+import numpy as np
 import pandas as pd
-from copy import copy
+
+try:
+    from .panel_functions import panel_from_dict, presence_from_index_dict, union_of_indices
+    from .panel_functions import carry_own_rows_forward, apply_to_own_rows
+except ImportError:
+    from panel_functions import panel_from_dict, presence_from_index_dict, union_of_indices
+    from panel_functions import carry_own_rows_forward, apply_to_own_rows
 
 BUSINESS_DAYS_IN_YEAR = 256
+VOL_EWM_SPAN = 32
+TEN_YEAR_VOL_WINDOW = BUSINESS_DAYS_IN_YEAR * 10
 
 def calculate_variable_standard_deviation_for_risk_targeting_from_dict(
     adjusted_prices: dict,
@@ -10,25 +19,66 @@ def calculate_variable_standard_deviation_for_risk_targeting_from_dict(
     annualise_stdev: bool = True,
 ) -> dict:
 
-    std_dev_dict = dict(
+    list_of_instruments = list(adjusted_prices.keys())
+
+    ## each instrument keeps its own calendar inside the panel
+    adjusted_index_dict = dict(
         [
-            (
-                instrument_code,
-                standardDeviation(
-                    adjusted_price=adjusted_prices[instrument_code],
-                    current_price=current_prices[instrument_code],
-                    use_perc_returns=use_perc_returns,
-                    annualise_stdev=annualise_stdev,
-                ),
-            )
-            for instrument_code in adjusted_prices.keys()
+            (instrument_code, adjusted_prices[instrument_code].index)
+            for instrument_code in list_of_instruments
         ]
     )
+    current_index_dict = dict(
+        [
+            (instrument_code, current_prices[instrument_code].index)
+            for instrument_code in list_of_instruments
+        ]
+    )
+    index = union_of_indices(
+        list(adjusted_index_dict.values()) + list(current_index_dict.values())
+    )
+    adjusted_present = presence_from_index_dict(adjusted_index_dict, list_of_instruments, index)
+    current_present = presence_from_index_dict(current_index_dict, list_of_instruments, index)
+    present = adjusted_present | current_present
+    current_price = panel_from_dict(current_prices, list_of_instruments, index)
+
+    stdev = calculate_variable_standard_deviation_for_risk_targeting_panel(
+        adjusted_price=panel_from_dict(adjusted_prices, list_of_instruments, index),
+        current_price=current_price,
+        use_perc_returns=use_perc_returns,
+        annualise_stdev=annualise_stdev,
+        present=present,
+        adjusted_present=adjusted_present,
+        current_present=current_present,
+    )
+
+    std_dev_dict = {}
+    for instrument_code in list_of_instruments:
+        own_rows = present[instrument_code].to_numpy()
+        std_dev_dict[instrument_code] = standardDeviation.from_arrays(
+            index=index[own_rows],
+            stdev=stdev[instrument_code].to_numpy()[own_rows],
+            current_price=current_price[instrument_code].to_numpy()[own_rows],
+            use_perc_returns=use_perc_returns,
+            annualise_stdev=annualise_stdev,
+        )
 
     return std_dev_dict
 
-class standardDeviation(pd.Series):
+class standardDeviation:
     ## class that can be eithier % or price based standard deviation estimate
+    ## backed by numpy arrays aligned to one index; the price terms views are
+    ## built on first use and cached, so repeated calls cost nothing
+    __slots__ = (
+        "_index",
+        "_stdev",
+        "_current_price",
+        "_use_perc_returns",
+        "_annualised",
+        "_daily_risk_price_terms",
+        "_annual_risk_price_terms",
+    )
+
     def __init__(
         self,
         adjusted_price: pd.Series,
@@ -43,32 +93,96 @@ class standardDeviation(pd.Series):
             annualise_stdev=annualise_stdev,
             use_perc_returns=use_perc_returns,
         )
-        super().__init__(stdev)
 
+        ## the stdev index already covers every current price date
+        self._set_arrays(
+            index=stdev.index,
+            stdev=stdev.to_numpy(),
+            current_price=current_price.reindex(stdev.index).to_numpy(),
+            use_perc_returns=use_perc_returns,
+            annualise_stdev=annualise_stdev,
+        )
+
+    @classmethod
+    def from_arrays(
+        cls,
+        index: pd.Index,
+        stdev: np.ndarray,
+        current_price: np.ndarray,
+        use_perc_returns: bool = True,
+        annualise_stdev: bool = True,
+    ):
+        ## wrap an already calculated estimate, eg one column of the panel calculation
+        std_dev = cls.__new__(cls)
+        std_dev._set_arrays(
+            index=index,
+            stdev=stdev,
+            current_price=current_price,
+            use_perc_returns=use_perc_returns,
+            annualise_stdev=annualise_stdev,
+        )
+
+        return std_dev
+
+    def _set_arrays(
+        self,
+        index: pd.Index,
+        stdev: np.ndarray,
+        current_price: np.ndarray,
+        use_perc_returns: bool,
+        annualise_stdev: bool,
+    ):
+        self._index = index
+        self._stdev = stdev
+        self._current_price = current_price
         self._use_perc_returns = use_perc_returns
         self._annualised = annualise_stdev
-        self._current_price = current_price
+        self._daily_risk_price_terms = None
+        self._annual_risk_price_terms = None
+
+    def daily_risk_price_terms(self) -> pd.Series:
+        if self._daily_risk_price_terms is None:
+            stdev = self._stdev
+            if self.annualised:
+                stdev = stdev / (BUSINESS_DAYS_IN_YEAR ** 0.5)
 
-    def daily_risk_price_terms(self):
-        stdev = copy(self)
-        if self.annualised:
-            stdev = stdev / (BUSINESS_DAYS_IN_YEAR ** 0.5)
+            if self.use_perc_returns:
+                stdev = stdev * self._current_price
 
-        if self.use_perc_returns:
-            stdev = stdev * self.current_price
+            self._daily_risk_price_terms = pd.Series(stdev, index=self._index, copy=False)
 
-        return stdev
+        return self._daily_risk_price_terms
 
-    def annual_risk_price_terms(self):
-        stdev = copy(self)
-        if not self.annualised:
-            # daily
-            stdev = stdev * (BUSINESS_DAYS_IN_YEAR ** 0.5)
+    def annual_risk_price_terms(self) -> pd.Series:
+        if self._annual_risk_price_terms is None:
+            stdev = self._stdev
+            if not self.annualised:
+                # daily
+                stdev = stdev * (BUSINESS_DAYS_IN_YEAR ** 0.5)
 
-        if self.use_perc_returns:
-            stdev = stdev * self.current_price
+            if self.use_perc_returns:
+                stdev = stdev * self._current_price
 
-        return stdev
+            self._annual_risk_price_terms = pd.Series(stdev, index=self._index, copy=False)
+
+        return self._annual_risk_price_terms
+
+    def as_series(self) -> pd.Series:
+        return pd.Series(self._stdev, index=self._index, copy=False)
+
+    @property
+    def index(self) -> pd.Index:
+        return self._index
+
+    @property
+    def values(self):
+        return self._stdev
+
+    def __len__(self) -> int:
+        return len(self._stdev)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._stdev, dtype=dtype)
 
     @property
     def annualised(self) -> bool:
@@ -80,7 +194,7 @@ class standardDeviation(pd.Series):
 
     @property
     def current_price(self) -> pd.Series:
-        return self._current_price
+        return pd.Series(self._current_price, index=self._index, copy=False)
 
 def calculate_variable_standard_deviation_for_risk_targeting(
     adjusted_price: pd.Series,
@@ -97,7 +211,7 @@ def calculate_variable_standard_deviation_for_risk_targeting(
         daily_returns = calculate_daily_returns(adjusted_price=adjusted_price)
 
     ## Can do the whole series or recent history
-    daily_exp_std_dev = daily_returns.ewm(span=32).std()
+    daily_exp_std_dev = daily_returns.ewm(span=VOL_EWM_SPAN).std()
 
     if annualise_stdev:
         annualisation_factor = BUSINESS_DAYS_IN_YEAR ** 0.5
@@ -108,13 +222,93 @@ def calculate_variable_standard_deviation_for_risk_targeting(
     annualised_std_dev = daily_exp_std_dev * annualisation_factor
 
     ## Weight with ten year vol
-    ten_year_vol = annualised_std_dev.rolling(
-        BUSINESS_DAYS_IN_YEAR * 10, min_periods=1
-    ).mean()
+    ten_year_vol = pd.Series(
+        calculate_rolling_mean(
+            annualised_std_dev.to_numpy(), window=TEN_YEAR_VOL_WINDOW
+        ),
+        index=annualised_std_dev.index,
+    )
     weighted_vol = 0.3 * ten_year_vol + 0.7 * annualised_std_dev
 
     return weighted_vol
 
+def calculate_variable_standard_deviation_for_risk_targeting_panel(
+    adjusted_price,
+    current_price,
+    use_perc_returns: bool = True,
+    annualise_stdev: bool = True,
+    present=None,
+    adjusted_present=None,
+    current_present=None,
+):
+
+    ## wide date x instrument frames (or 2-D arrays); present marks the rows each
+    ## instrument actually has, without it every row counts as the instrument's own.
+    ## adjusted_present / current_present are only needed if the two price series
+    ## don't share dates, returns are taken between each series' own rows
+    as_array = isinstance(adjusted_price, np.ndarray)
+    if as_array:
+        adjusted_price, current_price, present, adjusted_present, current_present = [
+            None if panel is None else pd.DataFrame(panel)
+            for panel in [adjusted_price, current_price, present, adjusted_present, current_present]
+        ]
+
+    if present is None:
+        present = pd.DataFrame(True, index=adjusted_price.index, columns=adjusted_price.columns)
+    if adjusted_present is None:
+        adjusted_present = present
+    if current_present is None:
+        current_present = present
+
+    if annualise_stdev:
+        annualisation_factor = BUSINESS_DAYS_IN_YEAR ** 0.5
+    else:
+        ## leave at daily
+        annualisation_factor = 1.0
+
+    ## returns, EWMA std and the ten year blend in one pass over each column
+    weighted_vol = variable_standard_deviation_kernel(
+        *[
+            np.asfortranarray(panel.to_numpy(dtype=np.float64))
+            for panel in [adjusted_price, current_price]
+        ],
+        *[
+            np.asfortranarray(panel.to_numpy(dtype=np.bool_))
+            for panel in [present, adjusted_present, current_present]
+        ],
+        use_perc_returns,
+        float(annualisation_factor),
+        VOL_EWM_SPAN,
+        TEN_YEAR_VOL_WINDOW,
+    )
+
+    if as_array:
+        return weighted_vol
+
+    return pd.DataFrame(weighted_vol, index=adjusted_price.index, columns=adjusted_price.columns)
+
+def calculate_percentage_returns_panel(
+    adjusted_price: pd.DataFrame,
+    current_price: pd.DataFrame,
+    adjusted_present: pd.DataFrame,
+    current_present: pd.DataFrame,
+) -> pd.DataFrame:
+
+    daily_price_changes = calculate_daily_returns_panel(adjusted_price, present=adjusted_present)
+    previous_current_price = (
+        carry_own_rows_forward(current_price, current_present).shift(1).where(current_present)
+    )
+    percentage_changes = daily_price_changes / previous_current_price
+
+    return percentage_changes
+
+def calculate_daily_returns_panel(
+    adjusted_price: pd.DataFrame, present: pd.DataFrame
+) -> pd.DataFrame:
+
+    ## diff against the instrument's previous own row, not the previous panel row
+    return carry_own_rows_forward(adjusted_price, present).diff().where(present)
+
 def calculate_percentage_returns(
     adjusted_price: pd.Series, current_price: pd.Series
 ) -> pd.Series:
@@ -131,19 +325,23 @@ def calculate_daily_returns(adjusted_price: pd.Series) -> pd.Series:
 def calculate_position_series_given_variable_risk_for_dict(
     capital: float,
     risk_target_tau: float,
-    idm: float,
+    idm,
     weights: dict,
     fx_series_dict: dict,
     multipliers: dict,
     std_dev_dict: dict,
 ) -> dict:
 
+    ## idm is a float, or the IDM series by week end from idm_functions, applied date by date
+
     position_series_dict = dict(
         [
             (
                 instrument_code,
                 calculate_position_series_given_variable_risk(
-                    capital=capital * idm * weights[instrument_code],
+                    capital=capital
+                    * idm_for_dates(idm, std_dev_dict[instrument_code].index)
+                    * weights[instrument_code],
                     risk_target_tau=risk_target_tau,
                     multiplier=multipliers[instrument_code],
                     fx=fx_series_dict[instrument_code],
@@ -156,15 +354,30 @@ def calculate_position_series_given_variable_risk_for_dict(
 
     return position_series_dict
 
+def idm_for_dates(idm, index: pd.Index):
+
+    ## the IDM in force on each date: the last one recorded on or before it, and 1.0
+    ## before the first. A float is the same on every date
+    if np.isscalar(idm):
+        return idm
+
+    positions = idm.index.searchsorted(index, side="right") - 1
+    values = np.where(
+        positions >= 0, idm.to_numpy(dtype=np.float64)[np.maximum(positions, 0)], 1.0
+    )
+
+    return pd.Series(values, index=index)
+
 def calculate_position_series_given_variable_risk(
     capital: float,
     risk_target_tau: float,
-    fx: pd.Series,
+    fx,
     multiplier: float,
     instrument_risk: standardDeviation,
 ) -> pd.Series:
 
     # N = (Capital × τ) ÷ (Multiplier × Price × FX × σ %)
+    ## fx is a pd.Series, or a float such as the 1.0 for USD instruments
     ## resolves to N = (Capital × τ) ÷ (Multiplier × FX × daily stdev price terms × 16)
     ## for simplicity we use the daily risk in price terms, even if we calculated annualised % returns
     daily_risk_price_terms = instrument_risk.daily_risk_price_terms()
@@ -174,3 +387,353 @@ def calculate_position_series_given_variable_risk(
         * risk_target_tau
         / (multiplier * fx * daily_risk_price_terms * (BUSINESS_DAYS_IN_YEAR ** 0.5))
     )
+
+def calculate_position_panel_given_variable_risk(
+    capital: float,
+    risk_target_tau: float,
+    idm: float,
+    weights: np.ndarray,
+    fx,
+    multipliers: np.ndarray,
+    daily_risk_price_terms,
+):
+
+    ## calculate_position_series_given_variable_risk for a date x instrument panel,
+    ## weights and multipliers are per instrument arrays lined up with the columns,
+    ## idm a float or a column of one value per date
+    return (
+        capital
+        * idm
+        * weights
+        * risk_target_tau
+        / (multipliers * fx * daily_risk_price_terms * (BUSINESS_DAYS_IN_YEAR ** 0.5))
+    )
+
+# EWMA standard deviation
+## Same algorithm as pandas ewm(span).std() (adjust=True, bias corrected): missing
+## values inside a series decay the weights, leading missing values are skipped.
+## Rows an instrument doesn't have (present False) are skipped entirely, so a
+## column of the panel gives the same answer as the instrument's own series
+
+EWM_MEAN = 0
+EWM_COV = 1
+EWM_SUM_WT = 2
+EWM_SUM_WT2 = 3
+EWM_OLD_WT = 4
+EWM_STATE_SIZE = 5
+
+def calculate_ewm_std(values: np.ndarray, span: float, present: np.ndarray = None) -> np.ndarray:
+
+    ## values is dates x instruments (or a single 1-D series), each column on its own
+    ## the kernels walk one column at a time, so hand them column major arrays
+    values = np.asarray(values, dtype=np.float64)
+    is_series = values.ndim == 1
+    if is_series:
+        values = values.reshape(-1, 1)
+    values = np.asfortranarray(values)
+
+    if present is None:
+        present = np.ones(values.shape, dtype=np.bool_, order="F")
+    else:
+        present = np.asfortranarray(np.asarray(present, dtype=np.bool_).reshape(values.shape))
+
+    ewm_std = ewm_std_kernel(values, span, present)
+    if is_series:
+        return ewm_std[:, 0]
+
+    return ewm_std
+
+def initialise_ewm_std_state() -> np.ndarray:
+    ewm_state = np.ones(EWM_STATE_SIZE)
+    ewm_state[EWM_MEAN] = np.nan
+    ewm_state[EWM_COV] = 0.0
+
+    return ewm_state
+
+def ewm_std_add(ewm_state: np.ndarray, value: float, alpha: float):
+    is_observation = value == value
+    if ewm_state[EWM_MEAN] == ewm_state[EWM_MEAN]:
+        old_wt_factor = 1.0 - alpha
+        ewm_state[EWM_SUM_WT] *= old_wt_factor
+        ewm_state[EWM_SUM_WT2] *= old_wt_factor * old_wt_factor
+        ewm_state[EWM_OLD_WT] *= old_wt_factor
+        if is_observation:
+            old_wt = ewm_state[EWM_OLD_WT]
+            old_mean = ewm_state[EWM_MEAN]
+            if old_mean != value:
+                ewm_state[EWM_MEAN] = (old_wt * old_mean + value) / (old_wt + 1.0)
+            mean = ewm_state[EWM_MEAN]
+            ewm_state[EWM_COV] = (
+                old_wt * (ewm_state[EWM_COV] + (old_mean - mean) * (old_mean - mean))
+                + (value - mean) * (value - mean)
+            ) / (old_wt + 1.0)
+            ewm_state[EWM_SUM_WT] += 1.0
+            ewm_state[EWM_SUM_WT2] += 1.0
+            ewm_state[EWM_OLD_WT] += 1.0
+    elif is_observation:
+        ewm_state[EWM_MEAN] = value
+
+def ewm_std_value(ewm_state: np.ndarray) -> float:
+    if ewm_state[EWM_MEAN] != ewm_state[EWM_MEAN]:
+        return np.nan
+
+    numerator = ewm_state[EWM_SUM_WT] * ewm_state[EWM_SUM_WT]
+    denominator = numerator - ewm_state[EWM_SUM_WT2]
+    if denominator <= 0:
+        return np.nan
+
+    variance = (numerator / denominator) * ewm_state[EWM_COV]
+    if variance < 0:
+        return 0.0
+
+    return np.sqrt(variance)
+
+def _ewm_std_loop(values: np.ndarray, span: float, present: np.ndarray) -> np.ndarray:
+    alpha = 2.0 / (span + 1.0)
+    row_count, instrument_count = values.shape
+    ## column major, built as the transpose since numba has no order argument
+    ewm_std = np.full((instrument_count, row_count), np.nan).T
+    for instrument_idx in range(instrument_count):
+        ewm_state = initialise_ewm_std_state()
+        for idx in range(row_count):
+            if present[idx, instrument_idx]:
+                ewm_std_add(ewm_state, values[idx, instrument_idx], alpha)
+                ewm_std[idx, instrument_idx] = ewm_std_value(ewm_state)
+
+    return ewm_std
+
+def _ewm_std_pandas(values: np.ndarray, span: float, present: np.ndarray) -> np.ndarray:
+    return apply_to_own_rows(
+        lambda frame: frame.ewm(span=span).std().to_numpy(), values, present
+    )
+
+# Rolling mean
+## Same running sum algorithm as pandas rolling(window, min_periods).mean(): Kahan
+## compensated, with separate compensation for values entering and leaving the window.
+## The state for one series is a small float array, so the same helpers drive the
+## batched kernel below and the one-bar-at-a-time update in incremental_functions
+
+ROLLING_SUM = 0
+ROLLING_COMPENSATION_ADD = 1
+ROLLING_COMPENSATION_REMOVE = 2
+ROLLING_NOBS = 3
+ROLLING_NEG_CT = 4
+ROLLING_CONSECUTIVE_SAME = 5
+ROLLING_PREV_VALUE = 6
+ROLLING_STATE_SIZE = 7
+
+def calculate_rolling_mean(
+    values: np.ndarray, window: int, min_periods: int = 1, present: np.ndarray = None
+) -> np.ndarray:
+
+    ## values is dates x instruments (or a single 1-D series), each column rolled on its own;
+    ## with present the window counts only the rows each instrument has
+    ## the kernels walk one column at a time, so hand them column major arrays
+    values = np.asarray(values, dtype=np.float64)
+    is_series = values.ndim == 1
+    if is_series:
+        values = values.reshape(-1, 1)
+    values = np.asfortranarray(values)
+
+    if present is None:
+        present = np.ones(values.shape, dtype=np.bool_, order="F")
+    else:
+        present = np.asfortranarray(np.asarray(present, dtype=np.bool_).reshape(values.shape))
+
+    rolling_mean = rolling_mean_kernel(values, window, min_periods, present)
+    if is_series:
+        return rolling_mean[:, 0]
+
+    return rolling_mean
+
+def initialise_rolling_mean_state() -> np.ndarray:
+    rolling_state = np.zeros(ROLLING_STATE_SIZE)
+    rolling_state[ROLLING_PREV_VALUE] = np.nan
+
+    return rolling_state
+
+def rolling_mean_add(rolling_state: np.ndarray, value: float):
+    if value == value:
+        rolling_state[ROLLING_NOBS] += 1
+        y = value - rolling_state[ROLLING_COMPENSATION_ADD]
+        t = rolling_state[ROLLING_SUM] + y
+        rolling_state[ROLLING_COMPENSATION_ADD] = t - rolling_state[ROLLING_SUM] - y
+        rolling_state[ROLLING_SUM] = t
+        if np.signbit(value):
+            rolling_state[ROLLING_NEG_CT] += 1
+        if value == rolling_state[ROLLING_PREV_VALUE]:
+            rolling_state[ROLLING_CONSECUTIVE_SAME] += 1
+        else:
+            rolling_state[ROLLING_CONSECUTIVE_SAME] = 1
+        rolling_state[ROLLING_PREV_VALUE] = value
+
+def rolling_mean_remove(rolling_state: np.ndarray, value: float):
+    if value == value:
+        rolling_state[ROLLING_NOBS] -= 1
+        y = -value - rolling_state[ROLLING_COMPENSATION_REMOVE]
+        t = rolling_state[ROLLING_SUM] + y
+        rolling_state[ROLLING_COMPENSATION_REMOVE] = t - rolling_state[ROLLING_SUM] - y
+        rolling_state[ROLLING_SUM] = t
+        if np.signbit(value):
+            rolling_state[ROLLING_NEG_CT] -= 1
+
+def rolling_mean_value(rolling_state: np.ndarray, min_periods: int = 1) -> float:
+    nobs = rolling_state[ROLLING_NOBS]
+    if nobs < min_periods or nobs == 0:
+        return np.nan
+
+    ## a run of identical values returns the value itself, free of rounding
+    if rolling_state[ROLLING_CONSECUTIVE_SAME] >= nobs:
+        return rolling_state[ROLLING_PREV_VALUE]
+
+    result = rolling_state[ROLLING_SUM] / nobs
+    if rolling_state[ROLLING_NEG_CT] == 0 and result < 0:
+        return 0.0
+    elif rolling_state[ROLLING_NEG_CT] == nobs and result > 0:
+        return 0.0
+
+    return result
+
+def _rolling_mean_loop(
+    values: np.ndarray, window: int, min_periods: int, present: np.ndarray
+) -> np.ndarray:
+    row_count, instrument_count = values.shape
+    rolling_mean = np.full((instrument_count, row_count), np.nan).T
+    own_rows = np.empty(row_count, dtype=np.int64)
+    for instrument_idx in range(instrument_count):
+        rolling_state = initialise_rolling_mean_state()
+        own_row_count = 0
+        for idx in range(row_count):
+            if not present[idx, instrument_idx]:
+                continue
+            own_rows[own_row_count] = idx
+            if own_row_count >= window:
+                rolling_mean_remove(
+                    rolling_state, values[own_rows[own_row_count - window], instrument_idx]
+                )
+            rolling_mean_add(rolling_state, values[idx, instrument_idx])
+            rolling_mean[idx, instrument_idx] = rolling_mean_value(rolling_state, min_periods)
+            own_row_count += 1
+
+    return rolling_mean
+
+def _rolling_mean_pandas(
+    values: np.ndarray, window: int, min_periods: int, present: np.ndarray
+) -> np.ndarray:
+    ## pandas loops the columns in cython
+    return apply_to_own_rows(
+        lambda frame: frame.rolling(window, min_periods=min_periods).mean().to_numpy(),
+        values,
+        present,
+    )
+
+
+# Panel standard deviation
+## calculate_variable_standard_deviation_for_risk_targeting for every column of a
+## panel. Each instrument walks its own rows only, returns are taken against the
+## previous row each price series has, matching diff() / shift(1) on the series
+
+def _variable_standard_deviation_loop(
+    adjusted_price: np.ndarray,
+    current_price: np.ndarray,
+    present: np.ndarray,
+    adjusted_present: np.ndarray,
+    current_present: np.ndarray,
+    use_perc_returns: bool,
+    annualisation_factor: float,
+    span: float,
+    window: int,
+) -> np.ndarray:
+    alpha = 2.0 / (span + 1.0)
+    row_count, instrument_count = adjusted_price.shape
+    weighted_vol = np.full((instrument_count, row_count), np.nan).T
+    annualised_std_dev_window = np.empty(window)
+    for instrument_idx in range(instrument_count):
+        ewm_state = initialise_ewm_std_state()
+        rolling_state = initialise_rolling_mean_state()
+        last_adjusted_price = np.nan
+        last_current_price = np.nan
+        own_row_count = 0
+        for idx in range(row_count):
+            if not present[idx, instrument_idx]:
+                continue
+
+            daily_return = np.nan
+            if adjusted_present[idx, instrument_idx]:
+                adjusted = adjusted_price[idx, instrument_idx]
+                daily_return = adjusted - last_adjusted_price
+                last_adjusted_price = adjusted
+            if use_perc_returns:
+                if current_present[idx, instrument_idx]:
+                    daily_return = daily_return / last_current_price
+                    last_current_price = current_price[idx, instrument_idx]
+                else:
+                    daily_return = np.nan
+
+            ewm_std_add(ewm_state, daily_return, alpha)
+            annualised_std_dev = ewm_std_value(ewm_state) * annualisation_factor
+
+            window_position = own_row_count % window
+            if own_row_count >= window:
+                rolling_mean_remove(rolling_state, annualised_std_dev_window[window_position])
+            annualised_std_dev_window[window_position] = annualised_std_dev
+            rolling_mean_add(rolling_state, annualised_std_dev)
+            own_row_count += 1
+
+            ten_year_vol = rolling_mean_value(rolling_state, 1)
+            weighted_vol[idx, instrument_idx] = 0.3 * ten_year_vol + 0.7 * annualised_std_dev
+
+    return weighted_vol
+
+def _variable_standard_deviation_pandas(
+    adjusted_price: np.ndarray,
+    current_price: np.ndarray,
+    present: np.ndarray,
+    adjusted_present: np.ndarray,
+    current_present: np.ndarray,
+    use_perc_returns: bool,
+    annualisation_factor: float,
+    span: float,
+    window: int,
+) -> np.ndarray:
+    adjusted_present = pd.DataFrame(adjusted_present)
+    if use_perc_returns:
+        daily_returns = calculate_percentage_returns_panel(
+            adjusted_price=pd.DataFrame(adjusted_price),
+            current_price=pd.DataFrame(current_price),
+            adjusted_present=adjusted_present,
+            current_present=pd.DataFrame(current_present),
+        )
+    else:
+        daily_returns = calculate_daily_returns_panel(
+            adjusted_price=pd.DataFrame(adjusted_price), present=adjusted_present
+        )
+
+    annualised_std_dev = (
+        calculate_ewm_std(daily_returns.to_numpy(), span=span, present=present)
+        * annualisation_factor
+    )
+    ten_year_vol = calculate_rolling_mean(annualised_std_dev, window=window, present=present)
+    weighted_vol = 0.3 * ten_year_vol + 0.7 * annualised_std_dev
+    weighted_vol[~present] = np.nan
+
+    return weighted_vol
+
+## numba is optional, without it pandas runs the same algorithms column by column
+try:
+    from numba import njit
+except ImportError:
+    ewm_std_kernel = _ewm_std_pandas
+    rolling_mean_kernel = _rolling_mean_pandas
+    variable_standard_deviation_kernel = _variable_standard_deviation_pandas
+else:
+    initialise_ewm_std_state = njit(cache=True)(initialise_ewm_std_state)
+    ewm_std_add = njit(cache=True)(ewm_std_add)
+    ewm_std_value = njit(cache=True)(ewm_std_value)
+    ewm_std_kernel = njit(cache=True)(_ewm_std_loop)
+    initialise_rolling_mean_state = njit(cache=True)(initialise_rolling_mean_state)
+    rolling_mean_add = njit(cache=True)(rolling_mean_add)
+    rolling_mean_remove = njit(cache=True)(rolling_mean_remove)
+    rolling_mean_value = njit(cache=True)(rolling_mean_value)
+    rolling_mean_kernel = njit(cache=True)(_rolling_mean_loop)
+    variable_standard_deviation_kernel = njit(cache=True)(_variable_standard_deviation_loop)
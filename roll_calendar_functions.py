@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+## Roll calendar: the (price contract, carry contract) pairs as run length segments
+## Contract codes (yyyymmdd, eg 20230300) only change at a roll, so the year fraction
+## between the carry and price contracts is worked out once per segment and repeated
+## back over the segment's dates, rather than on every row:
+##   calendar = rollCalendar(price_contract, carry_contract)
+##   calendar.contract_diff() -> years from price contract to carry contract, per date
+##   calendar.roll_rows()     -> rows where the price contract changes
+## Works on one instrument (1-D) or a dates x instruments panel (2-D), where every
+## instrument starts a new segment. Missing codes are segments of their own, with a
+## NaN difference, as the row by row arithmetic gave
+
+
+class rollCalendar:
+    def __init__(self, price_contract, carry_contract):
+        price_contract = _as_float_array(price_contract)
+        carry_contract = _as_float_array(carry_contract)
+        self._shape = price_contract.shape
+        self._row_count = self._shape[0]
+
+        ## instrument by instrument, dates in order within each
+        price_flat = price_contract.T.reshape(-1)
+        carry_flat = carry_contract.T.reshape(-1)
+
+        segment_start = np.ones(len(price_flat), dtype=bool)
+        segment_start[1:] = ~(
+            _same_code(price_flat[1:], price_flat[:-1]) & _same_code(carry_flat[1:], carry_flat[:-1])
+        )
+        if self._row_count > 0:
+            segment_start[:: self._row_count] = True
+
+        self._segment_starts = np.flatnonzero(segment_start)
+        self._segment_lengths = np.diff(np.append(self._segment_starts, len(price_flat)))
+        self._price_contract = price_flat[self._segment_starts]
+        self._carry_contract = carry_flat[self._segment_starts]
+        self._contract_diff = total_year_frac_from_contract(
+            self._carry_contract
+        ) - total_year_frac_from_contract(self._price_contract)
+
+    @property
+    def segment_count(self) -> int:
+        return len(self._segment_starts)
+
+    def segments(self, column: int = 0) -> pd.DataFrame:
+
+        ## one row per segment of an instrument: where it starts, how long, the contracts
+        in_column = self._segment_starts // max(self._row_count, 1) == column
+
+        return pd.DataFrame(
+            dict(
+                start_row=self._segment_starts[in_column] % max(self._row_count, 1),
+                length=self._segment_lengths[in_column],
+                price_contract=self._price_contract[in_column],
+                carry_contract=self._carry_contract[in_column],
+                contract_diff=self._contract_diff[in_column],
+            )
+        )
+
+    def contract_diff(self) -> np.ndarray:
+        contract_diff = np.repeat(self._contract_diff, self._segment_lengths)
+        if len(self._shape) == 1:
+            return contract_diff
+
+        return contract_diff.reshape(self._shape[::-1]).T
+
+    def roll_rows(self, column: int = 0) -> np.ndarray:
+
+        ## rows where the price contract differs from the last one we had
+        segments = self.segments(column)
+        segments = segments[~np.isnan(segments.price_contract.to_numpy())]
+        price_contract = segments.price_contract.to_numpy()
+        rolled = price_contract[1:] != price_contract[:-1]
+
+        return segments.start_row.to_numpy()[1:][rolled]
+
+
+def contract_year_frac_difference(price_contract, carry_contract):
+
+    ## years from the price contract to the carry contract, same shape and labels as the input
+    contract_diff = rollCalendar(price_contract, carry_contract).contract_diff()
+    if isinstance(price_contract, pd.DataFrame):
+        return pd.DataFrame(
+            contract_diff, index=price_contract.index, columns=price_contract.columns
+        )
+    if isinstance(price_contract, pd.Series):
+        return pd.Series(contract_diff, index=price_contract.index)
+
+    return contract_diff
+
+
+def roll_dates(carry_price: pd.DataFrame) -> pd.Index:
+    calendar = rollCalendar(carry_price["PRICE_CONTRACT"], carry_price["CARRY_CONTRACT"])
+
+    return carry_price.index[calendar.roll_rows()]
+
+
+def roll_dates_for_dict(carry_prices_dict: dict) -> dict:
+    return dict(
+        [
+            (instrument_code, roll_dates(carry_price))
+            for instrument_code, carry_price in carry_prices_dict.items()
+        ]
+    )
+
+
+def total_year_frac_from_contract(x: np.ndarray) -> np.ndarray:
+    ## yyyymmdd -> years, eg 20230600 -> 2023.5
+    return np.floor_divide(x, 10000) + (np.mod(x, 10000) / 100.0) / 12.0
+
+
+def _as_float_array(x) -> np.ndarray:
+    if isinstance(x, (pd.Series, pd.DataFrame)):
+        return x.astype(float).to_numpy(dtype=np.float64, na_value=np.nan)
+
+    return np.asarray(x, dtype=np.float64)
+
+
+def _same_code(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    return (x == y) | (np.isnan(x) & np.isnan(y))
@@ -0,0 +1,309 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+## next to this module, so it doesn't matter which directory it's run from
+DEFAULT_SERIES_STORE_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "series_store"
+)
+STORE_METADATA_FILENAME = "store.json"
+DATES_FILENAME = "dates.i8"
+VALUES_SUFFIX = ".f8"
+MASK_SUFFIX = ".mask"
+
+CARRY_FORECAST_SERIES = ["buffered_position", "position", "capped_forecast", "std_dev"]
+
+## Memory mapped store for the per instrument series carry_forecast produces
+## One shared date index (int64 nanoseconds, sorted), and for each series and instrument
+## a raw float64 file with one value per index date plus a one byte mask of the dates the
+## instrument actually has, so a read gives back the instrument's own index:
+##   <directory>/dates.i8
+##   <directory>/<series>/<instrument>.f8 and .mask
+## Reads map the files and touch only the pages of the slice asked for. Appends add to
+## the end of each file and never rewrite one: the values go first and the date index
+## last, so a reader never sees a date without its values. Instruments with nothing on a
+## date are padded lazily, a file shorter than the index reads as missing at the end
+
+
+class seriesStore:
+    def __init__(self, directory: str = DEFAULT_SERIES_STORE_DIRECTORY):
+        self._directory = directory
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    def exists(self) -> bool:
+        return os.path.exists(self._metadata_filename())
+
+    def metadata(self) -> dict:
+        with open(self._metadata_filename(), "r") as metadata_file:
+            return json.load(metadata_file)
+
+    def series_names(self) -> list:
+        return sorted(self.metadata()["series"].keys())
+
+    def instruments(self, series_name: str) -> list:
+        return self.metadata()["series"][series_name]
+
+    def dates(self) -> np.ndarray:
+        ## int64 nanoseconds, mapped not loaded
+        return _map_file(os.path.join(self._directory, DATES_FILENAME), np.int64)
+
+    def last_date(self):
+        dates = self.dates()
+        if len(dates) == 0:
+            return None
+        return pd.Timestamp(int(dates[-1]))
+
+    def read(self, series_name: str, instrument_code: str, start=None, end=None) -> pd.Series:
+
+        ## start and end are inclusive dates, eg read("position", "ES", "2020-01-01", "2020-12-31")
+        dates = self.dates()
+        start_row = 0 if start is None else int(np.searchsorted(dates, pd.Timestamp(start).value, "left"))
+        end_row = len(dates) if end is None else int(np.searchsorted(dates, pd.Timestamp(end).value, "right"))
+        end_row = max(start_row, end_row)
+
+        values = _map_file(self._values_filename(series_name, instrument_code), np.float64)
+        mask = _map_file(self._mask_filename(series_name, instrument_code), np.uint8)
+
+        ## past the end of a file is dates the instrument doesn't have yet
+        available_end = min(end_row, len(values), len(mask))
+        present = np.zeros(end_row - start_row, dtype=bool)
+        slice_values = np.full(end_row - start_row, np.nan)
+        if available_end > start_row:
+            present[: available_end - start_row] = mask[start_row:available_end] != 0
+            slice_values[: available_end - start_row] = values[start_row:available_end]
+
+        index = pd.DatetimeIndex(dates[start_row:end_row][present].view("M8[ns]"), name="Date")
+
+        return pd.Series(slice_values[present], index=index, name=instrument_code)
+
+    def read_dict(self, series_name: str, start=None, end=None) -> dict:
+        return dict(
+            [
+                (instrument_code, self.read(series_name, instrument_code, start=start, end=end))
+                for instrument_code in self.instruments(series_name)
+            ]
+        )
+
+    def write(self, series_dict: dict):
+
+        ## replace the whole store; series_dict maps series name to {instrument: pd.Series}.
+        ## Only the store's own files are removed, and a directory with other things in
+        ## it but no store.json is left alone
+        series_dict = _as_series_dict(series_dict)
+        if self.exists():
+            self._remove_store_files()
+        elif os.path.isdir(self._directory) and len(os.listdir(self._directory)) > 0:
+            raise ValueError(
+                "%s isn't empty and has no %s, not writing a series store over it"
+                % (self._directory, STORE_METADATA_FILENAME)
+            )
+        os.makedirs(self._directory, exist_ok=True)
+
+        index = _union_of_series_dates(series_dict)
+        _write_new_file(os.path.join(self._directory, DATES_FILENAME), _as_nanoseconds(index))
+        for series_name, instrument_dict in series_dict.items():
+            os.makedirs(os.path.join(self._directory, series_name), exist_ok=True)
+            for instrument_code, series in instrument_dict.items():
+                rows = index.get_indexer(series.index)
+                values = np.full(len(index), np.nan)
+                values[rows] = series.to_numpy(dtype=np.float64)
+                mask = np.zeros(len(index), dtype=np.uint8)
+                mask[rows] = 1
+                _write_new_file(self._values_filename(series_name, instrument_code), values)
+                _write_new_file(self._mask_filename(series_name, instrument_code), mask)
+
+        self._save_metadata(
+            dict(
+                [
+                    (series_name, sorted(instrument_dict.keys()))
+                    for series_name, instrument_dict in series_dict.items()
+                ]
+            )
+        )
+
+    def append(self, series_dict: dict) -> int:
+
+        ## add the dates after the last one in the store; earlier dates are already in
+        ## and are skipped. Returns the number of dates added
+        if not self.exists():
+            self.write(series_dict)
+            return len(self.dates())
+
+        last_date = self.last_date()
+        series_dict = _as_series_dict(series_dict)
+        series_dict = dict(
+            [
+                (
+                    series_name,
+                    dict(
+                        [
+                            (
+                                instrument_code,
+                                series if last_date is None else series[series.index > last_date],
+                            )
+                            for instrument_code, series in instrument_dict.items()
+                        ]
+                    ),
+                )
+                for series_name, instrument_dict in series_dict.items()
+            ]
+        )
+        new_index = _union_of_series_dates(series_dict)
+        if len(new_index) == 0:
+            return 0
+
+        old_row_count = len(self.dates())
+        row_count = old_row_count + len(new_index)
+        instruments_by_series = self.metadata()["series"]
+        for series_name, instrument_dict in series_dict.items():
+            os.makedirs(os.path.join(self._directory, series_name), exist_ok=True)
+            known = instruments_by_series.setdefault(series_name, [])
+            for instrument_code, series in instrument_dict.items():
+                if len(series) == 0:
+                    continue
+                rows = new_index.get_indexer(series.index)
+                ## only up to this instrument's last new date, the rest pads lazily
+                block_length = rows.max() + 1
+                values = np.full(block_length, np.nan)
+                values[rows] = series.to_numpy(dtype=np.float64)
+                mask = np.zeros(block_length, dtype=np.uint8)
+                mask[rows] = 1
+                _append_to_file(self._values_filename(series_name, instrument_code), values, old_row_count, np.nan)
+                _append_to_file(self._mask_filename(series_name, instrument_code), mask, old_row_count, 0)
+                if instrument_code not in known:
+                    known.append(instrument_code)
+                    known.sort()
+
+        self._save_metadata(instruments_by_series)
+        ## last, this is what makes the new dates visible
+        _append_to_file(os.path.join(self._directory, DATES_FILENAME), _as_nanoseconds(new_index), old_row_count, 0)
+
+        return row_count - old_row_count
+
+    def _remove_store_files(self):
+
+        ## the files store.json lists, then any series directories they leave empty
+        for series_name, instrument_list in self.metadata()["series"].items():
+            for instrument_code in instrument_list:
+                for filename in [
+                    self._values_filename(series_name, instrument_code),
+                    self._mask_filename(series_name, instrument_code),
+                ]:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+            series_directory = os.path.join(self._directory, series_name)
+            if os.path.isdir(series_directory) and len(os.listdir(series_directory)) == 0:
+                os.rmdir(series_directory)
+
+        for filename in [os.path.join(self._directory, DATES_FILENAME), self._metadata_filename()]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _save_metadata(self, instruments_by_series: dict):
+        filename = self._metadata_filename()
+        with open(filename + ".tmp", "w") as metadata_file:
+            json.dump(dict(series=instruments_by_series), metadata_file, indent=2)
+        os.replace(filename + ".tmp", filename)
+
+    def _metadata_filename(self) -> str:
+        return os.path.join(self._directory, STORE_METADATA_FILENAME)
+
+    def _values_filename(self, series_name: str, instrument_code: str) -> str:
+        return os.path.join(self._directory, series_name, instrument_code + VALUES_SUFFIX)
+
+    def _mask_filename(self, series_name: str, instrument_code: str) -> str:
+        return os.path.join(self._directory, series_name, instrument_code + MASK_SUFFIX)
+
+
+def write_carry_forecast_results(
+    buffered_position_dict: dict,
+    position_dict: dict,
+    capped_forecast_dict: dict,
+    std_dev_dict: dict,
+    directory: str = DEFAULT_SERIES_STORE_DIRECTORY,
+    append: bool = False,
+) -> seriesStore:
+
+    store = seriesStore(directory)
+    series_dict = dict(
+        zip(
+            CARRY_FORECAST_SERIES,
+            [buffered_position_dict, position_dict, capped_forecast_dict, std_dev_dict],
+        )
+    )
+    if append:
+        store.append(series_dict)
+    else:
+        store.write(series_dict)
+
+    return store
+
+
+def _union_of_series_dates(series_dict: dict) -> pd.DatetimeIndex:
+    index_list = [
+        pd.DatetimeIndex(series.index)
+        for instrument_dict in series_dict.values()
+        for series in instrument_dict.values()
+        if len(series) > 0
+    ]
+    if len(index_list) == 0:
+        return pd.DatetimeIndex([], name="Date")
+
+    return index_list[0].append(index_list[1:]).unique().sort_values()
+
+
+def _as_series_dict(series_dict: dict) -> dict:
+
+    ## standardDeviation and friends hand their values over as_series
+    return dict(
+        [
+            (
+                series_name,
+                dict(
+                    [
+                        (
+                            instrument_code,
+                            series.as_series() if hasattr(series, "as_series") else series,
+                        )
+                        for instrument_code, series in instrument_dict.items()
+                    ]
+                ),
+            )
+            for series_name, instrument_dict in series_dict.items()
+        ]
+    )
+
+
+def _as_nanoseconds(index: pd.DatetimeIndex) -> np.ndarray:
+    return index.to_numpy(dtype="M8[ns]").view(np.int64)
+
+
+def _map_file(filename: str, dtype) -> np.ndarray:
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(filename, dtype=dtype, mode="r")
+
+
+def _write_new_file(filename: str, values: np.ndarray):
+    with open(filename, "wb") as store_file:
+        store_file.write(np.ascontiguousarray(values).tobytes())
+
+
+def _append_to_file(filename: str, values: np.ndarray, start_row: int, fill_value):
+
+    ## write values from start_row on, padding a short file with fill_value first.
+    ## A file left longer by an interrupted append is cut back to start_row
+    itemsize = values.dtype.itemsize
+    with open(filename, "ab") as store_file:
+        row_count = store_file.tell() // itemsize
+        if row_count > start_row:
+            store_file.truncate(start_row * itemsize)
+        elif row_count < start_row:
+            store_file.write(np.full(start_row - row_count, fill_value, dtype=values.dtype).tobytes())
+        store_file.write(np.ascontiguousarray(values).tobytes())
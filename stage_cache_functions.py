@@ -0,0 +1,198 @@
+import hashlib
+import numbers
+import os
+import pickle
+from collections import Counter, OrderedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .risk_functions import standardDeviation
+except ImportError:
+    from risk_functions import standardDeviation
+
+DEFAULT_MAX_ENTRIES = 64
+
+## Memoization for the pipeline stages
+## Each stage call is keyed by the stage name plus a fingerprint of its inputs: a hash
+## of the data and the parameters. Outputs are kept in memory with LRU eviction and,
+## given a cache_directory, pickled to disk so a later run can pick them up
+
+
+class stageCache:
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, cache_directory: str = None):
+        self._max_entries = max_entries
+        self._cache_directory = cache_directory
+        self._entries = OrderedDict()
+        ## outputs we produced, so passing one on to the next stage doesn't rehash it
+        self._output_fingerprints = {}
+        self._hits = Counter()
+        self._disk_hits = Counter()
+        self._misses = Counter()
+
+    def call(self, stage_name: str, function, **kwargs):
+        key = (stage_name, self.fingerprint_arguments(kwargs))
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self._hits[stage_name] += 1
+            return self._entries[key]
+
+        output = self._read_from_disk(key)
+        if output is not None:
+            self._disk_hits[stage_name] += 1
+        else:
+            self._misses[stage_name] += 1
+            output = function(**kwargs)
+            self._write_to_disk(key, output)
+
+        self._store(key, output)
+
+        return output
+
+    def fingerprint_arguments(self, kwargs: dict) -> str:
+        hasher = hashlib.blake2b(digest_size=16)
+        for name in sorted(kwargs.keys()):
+            hasher.update(name.encode())
+            known_fingerprint = self._known_output_fingerprint(kwargs[name])
+            if known_fingerprint is None:
+                _update_fingerprint(hasher, kwargs[name])
+            else:
+                hasher.update(known_fingerprint.encode())
+
+        return hasher.hexdigest()
+
+    def stats(self) -> pd.DataFrame:
+        stage_names = sorted(set(self._hits) | set(self._disk_hits) | set(self._misses))
+        stats = pd.DataFrame(
+            dict(
+                hits=[self._hits[stage_name] for stage_name in stage_names],
+                disk_hits=[self._disk_hits[stage_name] for stage_name in stage_names],
+                misses=[self._misses[stage_name] for stage_name in stage_names],
+            ),
+            index=pd.Index(stage_names, name="stage"),
+        )
+        calls = stats.sum(axis=1)
+        stats["hit_rate"] = (stats.hits + stats.disk_hits) / calls.where(calls > 0)
+
+        return stats
+
+    def clear(self):
+        ## empties memory and resets the statistics, files on disk are left alone
+        self._entries.clear()
+        self._output_fingerprints.clear()
+        self._hits.clear()
+        self._disk_hits.clear()
+        self._misses.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _store(self, key: tuple, output):
+        self._entries[key] = output
+        self._output_fingerprints[id(output)] = key
+        while len(self._entries) > self._max_entries:
+            _, evicted_output = self._entries.popitem(last=False)
+            self._output_fingerprints.pop(id(evicted_output), None)
+
+    def _known_output_fingerprint(self, value):
+        key = self._output_fingerprints.get(id(value))
+        if key is None or key not in self._entries or self._entries[key] is not value:
+            return None
+
+        return "%s:%s" % key
+
+    def _filename(self, key: tuple) -> str:
+        return os.path.join(self._cache_directory, "%s_%s.pkl" % key)
+
+    def _read_from_disk(self, key: tuple):
+        if self._cache_directory is None or not os.path.exists(self._filename(key)):
+            return None
+
+        with open(self._filename(key), "rb") as cache_file:
+            return pickle.load(cache_file)
+
+    def _write_to_disk(self, key: tuple, output):
+        if self._cache_directory is None:
+            return
+
+        os.makedirs(self._cache_directory, exist_ok=True)
+        filename = self._filename(key)
+        ## write then rename, so a crash never leaves a half written file
+        with open(filename + ".tmp", "wb") as cache_file:
+            pickle.dump(output, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + ".tmp", filename)
+
+
+_stage_cache = None
+
+def get_stage_cache() -> stageCache:
+    global _stage_cache
+    if _stage_cache is None:
+        _stage_cache = stageCache()
+
+    return _stage_cache
+
+def configure_stage_cache(**kwargs) -> stageCache:
+    ## replace the shared cache, eg to change its size or add a cache directory
+    global _stage_cache
+    _stage_cache = stageCache(**kwargs)
+
+    return _stage_cache
+
+
+def fingerprint(value) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    _update_fingerprint(hasher, value)
+
+    return hasher.hexdigest()
+
+
+def _update_fingerprint(hasher, value):
+
+    ## type tags keep eg the string "1" and the number 1 apart
+    if isinstance(value, (pd.Series, pd.DataFrame)):
+        hasher.update(b"pandas")
+        hasher.update(repr((type(value).__name__, value.shape)).encode())
+        if isinstance(value, pd.DataFrame):
+            hasher.update(repr(list(value.columns)).encode())
+            hasher.update(repr(list(value.dtypes.astype(str))).encode())
+        else:
+            hasher.update(repr((value.name, str(value.dtype))).encode())
+        hasher.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, pd.Index):
+        hasher.update(b"index")
+        hasher.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        hasher.update(b"array")
+        hasher.update(repr((value.dtype.str, value.shape)).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, standardDeviation):
+        hasher.update(b"standardDeviation")
+        hasher.update(repr((value.use_perc_returns, value.annualised)).encode())
+        _update_fingerprint(hasher, value.index)
+        _update_fingerprint(hasher, value.values)
+        _update_fingerprint(hasher, value.current_price.to_numpy())
+    elif isinstance(value, dict):
+        hasher.update(b"dict")
+        for key in sorted(value.keys(), key=repr):
+            _update_fingerprint(hasher, key)
+            _update_fingerprint(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(type(value).__name__.encode())
+        hasher.update(repr(len(value)).encode())
+        for item in value:
+            _update_fingerprint(hasher, item)
+    elif value is None or isinstance(value, (bool, np.bool_)):
+        hasher.update(repr(value if value is None else bool(value)).encode())
+    elif isinstance(value, numbers.Real):
+        ## 500000 and 500000.0 give the same outputs, so share a key
+        hasher.update(b"number")
+        hasher.update(repr(float(value)).encode())
+    elif isinstance(value, str):
+        hasher.update(b"str")
+        hasher.update(value.encode())
+    else:
+        hasher.update(b"pickle")
+        hasher.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
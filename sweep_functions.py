@@ -0,0 +1,366 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+try:
+    from . import get_carry_sql_functions as sql
+    from .Carry import estimate_idm_series
+    from .fx_functions import create_fx_series_given_adjusted_prices_dict, fx_panel
+    from .risk_functions import calculate_variable_standard_deviation_for_risk_targeting_from_dict
+    from .risk_functions import calculate_position_panel_given_variable_risk, idm_for_dates
+    from .carry_functions import calculate_capped_forecast_panel, apply_buffering_to_positions
+    from .panel_functions import panel_from_dict, presence_from_index_dict, union_of_indices
+    from .roll_calendar_functions import contract_year_frac_difference
+except ImportError:
+    import get_carry_sql_functions as sql
+    from Carry import estimate_idm_series
+    from fx_functions import create_fx_series_given_adjusted_prices_dict, fx_panel
+    from risk_functions import calculate_variable_standard_deviation_for_risk_targeting_from_dict
+    from risk_functions import calculate_position_panel_given_variable_risk, idm_for_dates
+    from carry_functions import calculate_capped_forecast_panel, apply_buffering_to_positions
+    from panel_functions import panel_from_dict, presence_from_index_dict, union_of_indices
+    from roll_calendar_functions import contract_year_frac_difference
+
+SWEEP_PARAMETERS = ["capital", "risk_target_tau", "carry_spans", "buffer_size"]
+SWEEP_OUTPUTS = ["capped_forecast", "average_position", "position", "buffered_position"]
+CARRY_COLUMNS = ["PRICE", "CARRY", "PRICE_CONTRACT", "CARRY_CONTRACT"]
+
+## Parameter sweep over capital, risk_target_tau, carry_spans and buffer size
+## The data is loaded and the vol estimated once, in this process. The read only
+## panels go into shared memory, and each worker process maps them without a copy.
+## Work is split by carry_spans so a worker builds each forecast once, and reuses the
+## average position for every buffer size. Matches Carry.carry_forecast point for point
+
+## arrays a worker process has mapped from shared memory, set by _attach_sweep_arrays
+_sweep_arrays = {}
+_sweep_shared_memory = []
+
+
+def run_carry_forecast_sweep(
+    instr_list: list,
+    weights: dict,
+    multipliers: dict,
+    capital_list: list,
+    risk_target_tau_list: list,
+    carry_spans_list: list,
+    buffer_size_list: list = (0.10,),
+    adjusted_prices_dict: dict = None,
+    current_prices_dict: dict = None,
+    carry_prices_dict: dict = None,
+    max_workers: int = None,
+) -> pd.DataFrame:
+
+    if adjusted_prices_dict is None:
+        adjusted_prices_dict, current_prices_dict = sql.get_data(instr_list)
+        carry_prices_dict = sql.get_carry_data(instr_list)
+
+    index, instrument_list, arrays = build_sweep_arrays(
+        instr_list=instr_list,
+        weights=weights,
+        multipliers=multipliers,
+        adjusted_prices_dict=adjusted_prices_dict,
+        current_prices_dict=current_prices_dict,
+        carry_prices_dict=carry_prices_dict,
+    )
+
+    ## one task per set of spans, carrying every capital / tau / buffer combination
+    parameter_list = list(
+        itertools.product(capital_list, risk_target_tau_list, buffer_size_list)
+    )
+    task_list = [tuple(carry_spans) for carry_spans in carry_spans_list]
+
+    if max_workers is None:
+        max_workers = min(len(task_list), os.cpu_count() or 1)
+
+    if max_workers <= 1:
+        _sweep_arrays.update(arrays)
+        try:
+            result_list = [
+                _run_sweep_task(carry_spans, parameter_list) for carry_spans in task_list
+            ]
+        finally:
+            _sweep_arrays.clear()
+    else:
+        shared_array_specs, shared_memory_list = _share_arrays(arrays)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_attach_sweep_arrays,
+                initargs=(shared_array_specs,),
+            ) as executor:
+                result_list = list(
+                    executor.map(
+                        _run_sweep_task, task_list, itertools.repeat(parameter_list)
+                    )
+                )
+        finally:
+            for shared_block in shared_memory_list:
+                shared_block.close()
+                shared_block.unlink()
+
+    return _sweep_results_as_frame(
+        result_list=result_list,
+        task_list=task_list,
+        parameter_list=parameter_list,
+        index=index,
+        instrument_list=instrument_list,
+        position_present=arrays["position_present"],
+    )
+
+
+def build_sweep_arrays(
+    instr_list: list,
+    weights: dict,
+    multipliers: dict,
+    adjusted_prices_dict: dict,
+    current_prices_dict: dict,
+    carry_prices_dict: dict,
+) -> tuple:
+
+    ## everything that doesn't depend on a swept parameter, as plain date x instrument arrays
+    instrument_list = list(adjusted_prices_dict.keys())
+    fx_series_dict = create_fx_series_given_adjusted_prices_dict(adjusted_prices_dict)
+    std_dev_dict = calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices=adjusted_prices_dict, current_prices=current_prices_dict
+    )
+
+    ## the calendars Carry.carry_forecast ends up with: the forecast lives on the carry and
+    ## vol dates, the average position on the fx and vol dates, the position on both
+    forecast_index_dict = dict(
+        [
+            (
+                instrument_code,
+                carry_prices_dict[instrument_code].index.union(std_dev_dict[instrument_code].index),
+            )
+            for instrument_code in instrument_list
+        ]
+    )
+    position_index_dict = dict(
+        [
+            (
+                instrument_code,
+                _union_with_fx_index(
+                    forecast_index_dict[instrument_code], fx_series_dict[instrument_code]
+                ),
+            )
+            for instrument_code in instrument_list
+        ]
+    )
+    index = union_of_indices(list(position_index_dict.values()))
+
+    carry_panel = panel_from_dict(carry_prices_dict, instrument_list).reindex(index)
+    arrays = dict(
+        [
+            (
+                column.lower(),
+                carry_panel.xs(column, axis=1, level=1).to_numpy(dtype=np.float64),
+            )
+            for column in CARRY_COLUMNS
+        ]
+    )
+    ## the contracts only matter through the year fraction between them, which no
+    ## parameter changes, so work it out here rather than in every task
+    arrays["contract_diff"] = contract_year_frac_difference(
+        arrays.pop("price_contract"), arrays.pop("carry_contract")
+    )
+    arrays["ann_price_vol"] = panel_from_dict(
+        dict(
+            [
+                (instrument_code, std_dev.annual_risk_price_terms())
+                for instrument_code, std_dev in std_dev_dict.items()
+            ]
+        ),
+        instrument_list,
+        index,
+    ).to_numpy()
+    arrays["daily_risk_price_terms"] = panel_from_dict(
+        dict(
+            [
+                (instrument_code, std_dev.daily_risk_price_terms())
+                for instrument_code, std_dev in std_dev_dict.items()
+            ]
+        ),
+        instrument_list,
+        index,
+    ).to_numpy()
+    arrays["fx"] = fx_panel(fx_series_dict, instrument_list, index)
+    arrays["forecast_present"] = presence_from_index_dict(
+        forecast_index_dict, instrument_list, index
+    ).to_numpy()
+    arrays["carry_present"] = presence_from_index_dict(
+        dict(
+            [
+                (instrument_code, carry_prices_dict[instrument_code].index)
+                for instrument_code in instrument_list
+            ]
+        ),
+        instrument_list,
+        index,
+    ).to_numpy()
+    arrays["vol_present"] = presence_from_index_dict(
+        dict(
+            [
+                (instrument_code, std_dev_dict[instrument_code].index)
+                for instrument_code in instrument_list
+            ]
+        ),
+        instrument_list,
+        index,
+    ).to_numpy()
+    arrays["position_present"] = presence_from_index_dict(
+        position_index_dict, instrument_list, index
+    ).to_numpy()
+    arrays["weights"] = np.array(
+        [weights[instrument_code] for instrument_code in instrument_list], dtype=np.float64
+    )
+    arrays["multipliers"] = np.array(
+        [multipliers[instrument_code] for instrument_code in instrument_list], dtype=np.float64
+    )
+    ## the IDM in force on each date, as a column so it broadcasts across instruments
+    arrays["idm"] = np.asarray(
+        idm_for_dates(estimate_idm_series(instr_list, adjusted_prices_dict, current_prices_dict, weights), index),
+        dtype=np.float64,
+    ).reshape(-1, 1)
+
+    return index, instrument_list, arrays
+
+
+def _run_sweep_task(carry_spans: tuple, parameter_list: list) -> dict:
+
+    arrays = _sweep_arrays
+    position_present = arrays["position_present"]
+    instrument_rows, instrument_columns = _present_rows_and_columns(position_present)
+
+    capped_forecast = calculate_capped_forecast_panel(
+        price=arrays["price"],
+        carry=arrays["carry"],
+        price_contract=None,
+        carry_contract=None,
+        ann_price_vol=arrays["ann_price_vol"],
+        carry_spans=list(carry_spans),
+        present=arrays["forecast_present"],
+        contract_diff=arrays["contract_diff"],
+        carry_present=arrays["carry_present"],
+        vol_present=arrays["vol_present"],
+    )
+    capped_forecast = np.where(arrays["forecast_present"], capped_forecast, np.nan)
+
+    ## the average position and position don't depend on the buffer size
+    position_cache = {}
+    results = dict(capped_forecast=capped_forecast[instrument_rows, instrument_columns])
+    for capital, risk_target_tau, buffer_size in parameter_list:
+        if (capital, risk_target_tau) not in position_cache:
+            average_position = calculate_position_panel_given_variable_risk(
+                capital=capital,
+                risk_target_tau=risk_target_tau,
+                idm=arrays["idm"],
+                weights=arrays["weights"],
+                fx=arrays["fx"],
+                multipliers=arrays["multipliers"],
+                daily_risk_price_terms=arrays["daily_risk_price_terms"],
+            )
+            position = capped_forecast * average_position / 10
+            position_cache[(capital, risk_target_tau)] = (average_position, position)
+
+        average_position, position = position_cache[(capital, risk_target_tau)]
+        buffered_position = apply_buffering_to_positions(
+            position_contracts=position,
+            average_position_contracts=average_position,
+            buffer_size=buffer_size,
+            present=position_present,
+        )
+
+        results[(capital, risk_target_tau, buffer_size)] = dict(
+            average_position=average_position[instrument_rows, instrument_columns],
+            position=position[instrument_rows, instrument_columns],
+            buffered_position=buffered_position[instrument_rows, instrument_columns],
+        )
+
+    return results
+
+
+def _sweep_results_as_frame(
+    result_list: list,
+    task_list: list,
+    parameter_list: list,
+    index: pd.Index,
+    instrument_list: list,
+    position_present: np.ndarray,
+) -> pd.DataFrame:
+
+    ## long format, one row per parameter tuple, instrument and date
+    instrument_rows, instrument_columns = _present_rows_and_columns(position_present)
+    row_count = len(instrument_rows)
+
+    frame_list = []
+    for carry_spans, results in zip(task_list, result_list):
+        for capital, risk_target_tau, buffer_size in parameter_list:
+            outputs = results[(capital, risk_target_tau, buffer_size)]
+            frame_list.append(
+                pd.DataFrame(
+                    dict(
+                        capital=np.repeat(capital, row_count),
+                        risk_target_tau=np.repeat(risk_target_tau, row_count),
+                        carry_spans=pd.Series([carry_spans] * row_count, dtype=object),
+                        buffer_size=np.repeat(buffer_size, row_count),
+                        instrument=pd.Categorical.from_codes(
+                            instrument_columns, categories=instrument_list
+                        ),
+                        Date=index[instrument_rows],
+                        capped_forecast=results["capped_forecast"],
+                        average_position=outputs["average_position"],
+                        position=outputs["position"],
+                        buffered_position=outputs["buffered_position"],
+                    )
+                )
+            )
+
+    sweep_results = pd.concat(frame_list, ignore_index=True)
+
+    return sweep_results.set_index(SWEEP_PARAMETERS + ["instrument", "Date"])
+
+
+def _present_rows_and_columns(present: np.ndarray) -> tuple:
+
+    ## instrument by instrument, dates in order within each
+    instrument_columns, instrument_rows = np.nonzero(present.T)
+
+    return instrument_rows, instrument_columns
+
+
+def _share_arrays(arrays: dict) -> tuple:
+
+    shared_array_specs = {}
+    shared_memory_list = []
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        shared_block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shared_block.buf)[...] = values
+        shared_array_specs[name] = (shared_block.name, values.shape, values.dtype.str)
+        shared_memory_list.append(shared_block)
+
+    return shared_array_specs, shared_memory_list
+
+
+def _attach_sweep_arrays(shared_array_specs: dict):
+
+    ## runs once in each worker: map the blocks read only, no copy
+    for name, (block_name, shape, dtype) in shared_array_specs.items():
+        shared_block = shared_memory.SharedMemory(name=block_name)
+        values = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_block.buf)
+        values.flags.writeable = False
+        _sweep_arrays[name] = values
+        _sweep_shared_memory.append(shared_block)
+
+
+def _union_with_fx_index(index: pd.Index, fx) -> pd.Index:
+
+    ## a scalar fx rate is there on every date, so it adds none
+    if np.isscalar(fx):
+        return index
+
+    return index.union(fx.index)
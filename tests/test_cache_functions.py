@@ -0,0 +1,75 @@
+import os
+
+import pandas as pd
+import pytest
+
+import cache_functions
+import get_carry_sql_functions as sql
+from benchmark_functions import make_synthetic_data
+
+sqlalchemy = pytest.importorskip("sqlalchemy")
+
+
+@pytest.fixture
+def sqlite_databases(tmp_path):
+    database_urls = {
+        sql.PRICE_DATABASE: "sqlite:///%s" % (tmp_path / "prices.db"),
+        sql.CARRY_DATABASE: "sqlite:///%s" % (tmp_path / "carry.db"),
+    }
+    sql.configure_data_access(database_urls=database_urls)
+    yield database_urls
+    sql.configure_data_access()
+
+
+def _write_tables(database_urls: dict, adjusted_prices: dict, current_prices: dict, carry_prices: dict, up_to):
+
+    ## Date as a real datetime column, as the SQL Server tables have
+    price_engine = sqlalchemy.create_engine(database_urls[sql.PRICE_DATABASE])
+    carry_engine = sqlalchemy.create_engine(database_urls[sql.CARRY_DATABASE])
+    for name in adjusted_prices.keys():
+        pd.DataFrame(
+            dict(
+                Date=adjusted_prices[name][:up_to].index,
+                Close=adjusted_prices[name][:up_to].to_numpy(),
+                Unadj_Close=current_prices[name][:up_to].to_numpy(),
+            )
+        ).to_sql(name + sql.PRICE_TABLE_SUFFIX, price_engine, index=False, if_exists="replace")
+        carry_table = carry_prices[name][:up_to].reset_index()
+        carry_table.columns = ["Date", "Price", "Carry", "Price_Contract", "Carry_Contract"]
+        carry_table.to_sql(name + sql.CARRY_TABLE_SUFFIX, carry_engine, index=False, if_exists="replace")
+    price_engine.dispose()
+    carry_engine.dispose()
+
+
+def test_refresh_does_not_repeat_the_last_cached_day(sqlite_databases, tmp_path):
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=3, days=300, seed=1
+    )
+    instrument_list = list(adjusted_prices.keys())
+    cache_directory = str(tmp_path / "cache")
+    split_date = adjusted_prices[instrument_list[0]].index[200]
+
+    _write_tables(sqlite_databases, adjusted_prices, current_prices, carry_prices, split_date)
+    cache_functions.get_data(instrument_list, cache_directory=cache_directory)
+    cache_functions.get_carry_data(instrument_list, cache_directory=cache_directory)
+    ## nothing new in the database, then the rest of the history
+    cache_functions.get_data(instrument_list, cache_directory=cache_directory)
+    _write_tables(sqlite_databases, adjusted_prices, current_prices, carry_prices, None)
+    cached_adjusted_prices, _ = cache_functions.get_data(instrument_list, cache_directory=cache_directory)
+    cached_carry_prices = cache_functions.get_carry_data(instrument_list, cache_directory=cache_directory)
+
+    for name in instrument_list:
+        assert not cached_adjusted_prices[name].index.duplicated().any()
+        assert not cached_carry_prices[name].index.duplicated().any()
+        pd.testing.assert_series_equal(
+            cached_adjusted_prices[name], adjusted_prices[name], check_names=False, check_freq=False
+        )
+
+
+def test_default_cache_directory_does_not_depend_on_the_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert os.path.isabs(cache_functions.DEFAULT_CACHE_DIRECTORY)
+    assert os.path.dirname(cache_functions.DEFAULT_CACHE_DIRECTORY) == os.path.dirname(
+        os.path.abspath(cache_functions.__file__)
+    )
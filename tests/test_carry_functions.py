@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import carry_functions
+from benchmark_functions import make_synthetic_data
+from carry_functions import calculate_capped_forecast, calculate_combined_carry_forecast
+from carry_functions import apply_buffer, apply_buffer_single_period
+from risk_functions import calculate_variable_standard_deviation_for_risk_targeting_from_dict
+
+CARRY_SPANS = [5, 20, 60, 120]
+## the numba kernel when it's installed, and both python paths whether it is or not
+BUFFER_KERNELS = [
+    carry_functions.apply_buffer_kernel,
+    carry_functions._apply_buffer_loop,
+    carry_functions._apply_buffer_vectorised,
+]
+
+
+def _data_with_carry_missing_price_dates(seed: int = 0):
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=4, days=1500, seed=seed, ragged_starts=True
+    )
+
+    ## the carry table misses some of the dates the price series has
+    rng = np.random.default_rng(seed)
+    for instrument_code, carry_price in carry_prices.items():
+        carry_prices[instrument_code] = carry_price[rng.random(len(carry_price)) > 0.1]
+
+    return adjusted_prices, current_prices, carry_prices
+
+
+def _apply_buffer_row_by_row(
+    optimal_position: pd.Series, upper_buffer: pd.Series, lower_buffer: pd.Series
+) -> pd.Series:
+
+    ## the original one row at a time loop
+    upper_buffer = upper_buffer.ffill().round()
+    lower_buffer = lower_buffer.ffill().round()
+    current_position = optimal_position.ffill().iloc[0]
+    if np.isnan(current_position):
+        current_position = 0.0
+
+    buffered_position_list = [current_position]
+    for idx in range(len(optimal_position.index))[1:]:
+        current_position = apply_buffer_single_period(
+            last_position=current_position,
+            top_pos=upper_buffer.iloc[idx],
+            bot_pos=lower_buffer.iloc[idx],
+        )
+        buffered_position_list.append(current_position)
+
+    return pd.Series(buffered_position_list, index=optimal_position.index)
+
+
+def _positions_and_buffers(days: int, instrument_count: int, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range("2000-01-01", periods=days, name="Date")
+    columns = ["SYN%d" % idx for idx in range(instrument_count)]
+    average_position = pd.DataFrame(rng.uniform(5, 50, (days, instrument_count)), index=index, columns=columns)
+    forecast = pd.DataFrame(
+        np.cumsum(rng.normal(0, 1, (days, instrument_count)), axis=0).clip(-20, 20),
+        index=index,
+        columns=columns,
+    )
+    position = forecast * average_position / 10
+    buffer = average_position.abs() * 0.10
+
+    return position, position + buffer, position - buffer
+
+
+@pytest.mark.parametrize("kernel", BUFFER_KERNELS)
+def test_apply_buffer_series_with_leading_nans_matches_row_by_row(kernel, monkeypatch):
+    monkeypatch.setattr(carry_functions, "apply_buffer_kernel", kernel)
+    position, upper_buffer, lower_buffer = _positions_and_buffers(days=300, instrument_count=1)
+    position.iloc[:10] = np.nan
+    upper_buffer.iloc[:10] = np.nan
+    lower_buffer.iloc[:10] = np.nan
+
+    expected = _apply_buffer_row_by_row(position["SYN0"], upper_buffer["SYN0"], lower_buffer["SYN0"])
+    got = apply_buffer(position["SYN0"], upper_buffer["SYN0"], lower_buffer["SYN0"])
+
+    assert isinstance(got, pd.Series)
+    assert got.index.equals(expected.index)
+    np.testing.assert_array_equal(got.to_numpy(), expected.to_numpy())
+
+
+@pytest.mark.parametrize("kernel", BUFFER_KERNELS)
+def test_apply_buffer_dataframe_matches_row_by_row(kernel, monkeypatch):
+    monkeypatch.setattr(carry_functions, "apply_buffer_kernel", kernel)
+    position, upper_buffer, lower_buffer = _positions_and_buffers(days=300, instrument_count=4, seed=1)
+    position.iloc[:5] = np.nan
+
+    got = apply_buffer(position, upper_buffer, lower_buffer)
+
+    assert isinstance(got, pd.DataFrame)
+    assert got.columns.equals(position.columns)
+    for code in position.columns:
+        expected = _apply_buffer_row_by_row(position[code], upper_buffer[code], lower_buffer[code])
+        np.testing.assert_array_equal(got[code].to_numpy(), expected.to_numpy())
+
+
+@pytest.mark.parametrize("kernel", BUFFER_KERNELS)
+def test_apply_buffer_ragged_panel_with_present_matches_row_by_row(kernel, monkeypatch):
+    monkeypatch.setattr(carry_functions, "apply_buffer_kernel", kernel)
+    position, upper_buffer, lower_buffer = _positions_and_buffers(days=300, instrument_count=4, seed=2)
+
+    ## different start dates, and rows some instruments don't have at all
+    rng = np.random.default_rng(2)
+    present = pd.DataFrame(rng.random(position.shape) > 0.1, index=position.index, columns=position.columns)
+    for column, start_row in enumerate([0, 20, 75, 140]):
+        present.iloc[:start_row, column] = False
+    position, upper_buffer, lower_buffer = [
+        panel.where(present) for panel in [position, upper_buffer, lower_buffer]
+    ]
+
+    got = apply_buffer(position.to_numpy(), upper_buffer.to_numpy(), lower_buffer.to_numpy(), present=present.to_numpy())
+
+    for column, code in enumerate(position.columns):
+        own_rows = present[code].to_numpy()
+        expected = _apply_buffer_row_by_row(
+            position[code][own_rows], upper_buffer[code][own_rows], lower_buffer[code][own_rows]
+        )
+        np.testing.assert_array_equal(got[own_rows, column], expected.to_numpy())
+
+
+def test_panel_forecast_matches_per_instrument_when_calendars_differ():
+    adjusted_prices, current_prices, carry_prices = _data_with_carry_missing_price_dates()
+    std_dev_dict = calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices=adjusted_prices, current_prices=current_prices
+    )
+
+    capped_forecast_dict, fdm_series = calculate_capped_forecast(
+        adjusted_prices, std_dev_dict, carry_prices, CARRY_SPANS, return_fdm=True
+    )
+
+    for instrument_code in adjusted_prices.keys():
+        expected = calculate_combined_carry_forecast(
+            stdev_ann_perc=std_dev_dict[instrument_code],
+            carry_price=carry_prices[instrument_code],
+            carry_spans=CARRY_SPANS,
+            fdm=fdm_series,
+        )
+        got = capped_forecast_dict[instrument_code]
+
+        assert got.index.equals(expected.index)
+        np.testing.assert_allclose(got.to_numpy(), expected.to_numpy(), rtol=0, atol=1e-12)
+
+
+def test_fdm_only_uses_forecasts_up_to_each_date():
+    adjusted_prices, current_prices, carry_prices = _data_with_carry_missing_price_dates(seed=1)
+    std_dev_dict = calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices=adjusted_prices, current_prices=current_prices
+    )
+    cut_off = adjusted_prices[next(iter(adjusted_prices))].index[-400]
+
+    full_forecast_dict, full_fdm_series = calculate_capped_forecast(
+        adjusted_prices, std_dev_dict, carry_prices, CARRY_SPANS, return_fdm=True
+    )
+
+    early_adjusted_prices = dict([(code, series[:cut_off]) for code, series in adjusted_prices.items()])
+    early_std_dev_dict = calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices=early_adjusted_prices,
+        current_prices=dict([(code, series[:cut_off]) for code, series in current_prices.items()]),
+    )
+    early_forecast_dict, early_fdm_series = calculate_capped_forecast(
+        early_adjusted_prices,
+        early_std_dev_dict,
+        dict([(code, carry_price[:cut_off]) for code, carry_price in carry_prices.items()]),
+        CARRY_SPANS,
+        return_fdm=True,
+    )
+
+    ## later forecasts don't move the FDM, or the forecast, on an earlier day
+    assert full_fdm_series[early_fdm_series.index].nunique() > 1
+    np.testing.assert_allclose(
+        full_fdm_series[early_fdm_series.index].to_numpy(), early_fdm_series.to_numpy(), rtol=1e-12
+    )
+    for instrument_code, early in early_forecast_dict.items():
+        np.testing.assert_allclose(
+            full_forecast_dict[instrument_code][early.index].to_numpy(), early.to_numpy(), rtol=1e-12
+        )
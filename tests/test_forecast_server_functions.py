@@ -0,0 +1,143 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Carry
+from benchmark_functions import make_synthetic_data
+from forecast_server_functions import forecastServer, forecastClient, HEADER_SEQUENCE
+
+CARRY_SPANS = [5, 20, 60, 120]
+CAPITAL = 5000000
+RISK_TARGET_TAU = 0.2
+
+
+def _up_to(data: tuple, date) -> tuple:
+    return tuple(dict([(code, series[:date]) for code, series in series_dict.items()]) for series_dict in data)
+
+
+def test_refreshed_panels_match_full_path():
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=4, days=1500, seed=4, ragged_starts=True
+    )
+
+    ## price only and carry only rows, as the cached tables have
+    rng = np.random.default_rng(4)
+    for instrument_code in adjusted_prices.keys():
+        keep_price = rng.random(len(adjusted_prices[instrument_code])) > 0.05
+        adjusted_prices[instrument_code] = adjusted_prices[instrument_code][keep_price]
+        current_prices[instrument_code] = current_prices[instrument_code][keep_price]
+        carry_price = carry_prices[instrument_code]
+        carry_prices[instrument_code] = carry_price[rng.random(len(carry_price)) > 0.1]
+
+    instrument_list = list(adjusted_prices.keys())
+    weights = dict([(code, 1 / len(instrument_list)) for code in instrument_list])
+    multipliers = dict([(code, 20.0) for code in instrument_list])
+    buffered_position_dict, position_dict, capped_forecast_dict = Carry.carry_forecast(
+        instrument_list,
+        weights,
+        CAPITAL,
+        RISK_TARGET_TAU,
+        multipliers,
+        CARRY_SPANS,
+        adjusted_prices,
+        current_prices,
+        carry_prices,
+    )
+
+    ## start on part of the history, then refresh twice as the tables grow
+    data = (adjusted_prices, current_prices, carry_prices)
+    dates = adjusted_prices[instrument_list[0]].index
+    loaded = dict(data=_up_to(data, dates[-300]))
+    server = forecastServer(
+        instrument_list,
+        weights,
+        multipliers,
+        CAPITAL,
+        RISK_TARGET_TAU,
+        CARRY_SPANS,
+        load_function=lambda instrument_list: loaded["data"],
+    ).start(serve=False)
+    try:
+        for date in [dates[-150], dates[-1]]:
+            loaded["data"] = _up_to(data, date)
+            server.refresh()
+
+        assert pd.Timestamp(server.metadata()["last_date"]) == max(
+            [series.index[-1] for series in adjusted_prices.values()]
+        )
+        for name, full_dict in [
+            ("capped_forecast", capped_forecast_dict),
+            ("position", position_dict),
+            ("buffered_position", buffered_position_dict),
+        ]:
+            panel = server.panel(name)
+            for instrument_code, expected in full_dict.items():
+                got = panel[instrument_code].reindex(expected.index)
+                np.testing.assert_allclose(got.to_numpy(), expected.to_numpy(), rtol=1e-9, atol=1e-9)
+    finally:
+        server.stop()
+
+
+def _served_server(load_function) -> forecastServer:
+    adjusted_prices, _, _ = load_function(None)
+    instrument_list = list(adjusted_prices.keys())
+
+    return forecastServer(
+        instrument_list,
+        dict([(code, 1 / len(instrument_list)) for code in instrument_list]),
+        dict([(code, 20.0) for code in instrument_list]),
+        CAPITAL,
+        RISK_TARGET_TAU,
+        CARRY_SPANS,
+        load_function=load_function,
+        port=0,
+    ).start()
+
+
+def test_client_waits_out_a_write_in_progress():
+    data = make_synthetic_data(instrument_count=3, days=600, seed=5)
+    server = _served_server(lambda instrument_list: data)
+    client = forecastClient(*server.address)
+    try:
+        expected = server.panel("position")
+
+        ## hold the sequence odd, as a write would, then finish the "write" a bit later
+        header = server._panels._header
+        header[HEADER_SEQUENCE] += 1
+        finish = threading.Timer(0.2, lambda: header.__setitem__(HEADER_SEQUENCE, header[HEADER_SEQUENCE] + 1))
+        start = time.perf_counter()
+        finish.start()
+        got = client.panel("position")
+
+        assert time.perf_counter() - start >= 0.2
+        pd.testing.assert_frame_equal(got, expected)
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_failed_refresh_comes_back_as_an_error():
+    data = make_synthetic_data(instrument_count=3, days=600, seed=6)
+    loaded = dict(fail=False)
+
+    def load_function(instrument_list):
+        if loaded["fail"]:
+            raise ConnectionError("database unavailable")
+        return data
+
+    server = _served_server(load_function)
+    client = forecastClient(*server.address)
+    try:
+        loaded["fail"] = True
+        with pytest.raises(RuntimeError, match="database unavailable"):
+            client.refresh()
+
+        ## and the server carries on
+        loaded["fail"] = False
+        assert client.refresh()["rows_added"] == 0
+    finally:
+        client.close()
+        server.stop()
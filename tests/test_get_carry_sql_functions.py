@@ -0,0 +1,48 @@
+import pytest
+
+import get_carry_sql_functions as sql
+
+sqlalchemy = pytest.importorskip("sqlalchemy")
+
+
+def _failing_data_access(error: Exception) -> tuple:
+    data_access = sql.sqlDataAccess(retries=2, retry_wait=0)
+    calls = []
+
+    def read_sql(query, database, params=None):
+        calls.append(query)
+        raise error
+
+    data_access.read_sql = read_sql
+
+    return data_access, calls
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        sqlalchemy.exc.OperationalError("SELECT", {}, Exception("connection refused")),
+        sqlalchemy.exc.DBAPIError("SELECT", {}, Exception("connection reset"), connection_invalidated=True),
+    ],
+)
+def test_read_retries_a_lost_connection(error):
+    data_access, calls = _failing_data_access(error)
+
+    with pytest.raises(type(error)):
+        data_access._read_sql_with_retry("SELECT 1", sql.PRICE_DATABASE)
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        sqlalchemy.exc.ProgrammingError("SELECT", {}, Exception("invalid object name")),
+        ValueError("can't compact"),
+    ],
+)
+def test_read_raises_anything_else_straight_away(error):
+    data_access, calls = _failing_data_access(error)
+
+    with pytest.raises(type(error)):
+        data_access._read_sql_with_retry("SELECT 1", sql.PRICE_DATABASE)
+    assert len(calls) == 1
@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+
+import Carry
+from benchmark_functions import make_synthetic_data
+from fx_functions import create_fx_series_given_adjusted_prices_dict
+from idm_functions import idmEstimator, calculate_idm_series, update_idm_estimator
+from idm_functions import save_idm_estimator, load_idm_estimator
+from risk_functions import calculate_variable_standard_deviation_for_risk_targeting_from_dict
+from risk_functions import calculate_position_series_given_variable_risk_for_dict
+from stage_cache_functions import stageCache
+
+
+def _up_to(series_dict: dict, date) -> dict:
+    return dict([(code, series[:date]) for code, series in series_dict.items()])
+
+
+def test_weekly_updates_from_saved_state_match_one_run(tmp_path):
+    adjusted_prices, current_prices, _ = make_synthetic_data(
+        instrument_count=6, days=2000, seed=2, ragged_starts=True
+    )
+    weights = dict([(code, 1 / 6) for code in adjusted_prices.keys()])
+    filename = str(tmp_path / "idm_estimator.pkl")
+    dates = adjusted_prices["SYN0"].index
+
+    save_idm_estimator(idmEstimator(list(adjusted_prices.keys()), weights), filename)
+    ## mid week cut offs, so the week still running has to wait for the next update
+    for date in [dates[900], dates[903], dates[1301], dates[-1]]:
+        estimator = load_idm_estimator(filename)
+        idm_series = update_idm_estimator(
+            estimator, _up_to(adjusted_prices, date), _up_to(current_prices, date)
+        )
+        save_idm_estimator(estimator, filename)
+
+    expected = calculate_idm_series(adjusted_prices, current_prices, weights)
+
+    assert idm_series.index.equals(expected.index)
+    np.testing.assert_allclose(idm_series.to_numpy(), expected.to_numpy(), rtol=0, atol=1e-12)
+
+
+def test_average_position_only_uses_the_idm_known_on_the_day():
+    adjusted_prices, current_prices, _ = make_synthetic_data(
+        instrument_count=4, days=1500, seed=3, ragged_starts=True
+    )
+    instrument_list = list(adjusted_prices.keys())
+    weights = dict([(code, 1 / 4) for code in instrument_list])
+    multipliers = dict([(code, 20.0) for code in instrument_list])
+
+    def _average_position(adjusted_prices_dict: dict, current_prices_dict: dict) -> dict:
+        return calculate_position_series_given_variable_risk_for_dict(
+            capital=1000000,
+            risk_target_tau=0.2,
+            idm=Carry.estimate_idm_series(instrument_list, adjusted_prices_dict, current_prices_dict, weights),
+            weights=weights,
+            fx_series_dict=create_fx_series_given_adjusted_prices_dict(adjusted_prices_dict),
+            multipliers=multipliers,
+            std_dev_dict=calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+                adjusted_prices=adjusted_prices_dict, current_prices=current_prices_dict
+            ),
+        )
+
+    full_average_position = _average_position(adjusted_prices, current_prices)
+    cut_off = adjusted_prices[instrument_list[0]].index[-400]
+    early_average_position = _average_position(
+        _up_to(adjusted_prices, cut_off), _up_to(current_prices, cut_off)
+    )
+
+    ## later prices don't change the position sized on an earlier day
+    for code in instrument_list:
+        early = early_average_position[code]
+        np.testing.assert_allclose(
+            full_average_position[code][early.index].to_numpy(), early.to_numpy(), rtol=1e-12
+        )
+
+
+def test_carry_forecast_saves_the_estimator_even_when_the_stages_are_cached(tmp_path):
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=4, days=1200, seed=5, ragged_starts=True
+    )
+    instrument_list = list(adjusted_prices.keys())
+    weights = dict([(code, 1 / 4) for code in instrument_list])
+    multipliers = dict([(code, 20.0) for code in instrument_list])
+    filename = str(tmp_path / "idm_estimator.pkl")
+    stage_cache = stageCache()
+
+    def _run(date):
+        return Carry.carry_forecast(
+            instrument_list,
+            weights,
+            1000000,
+            0.2,
+            multipliers,
+            [5, 20],
+            adjusted_prices_dict=_up_to(adjusted_prices, date),
+            current_prices_dict=_up_to(current_prices, date),
+            carry_prices_dict=_up_to(carry_prices, date),
+            stage_cache=stage_cache,
+            idm_estimator_filename=filename,
+        )
+
+    ## the second run is all cache hits, but still has to write the estimator out
+    dates = adjusted_prices[instrument_list[0]].index
+    _run(dates[-1])
+    os.remove(filename)
+    _run(dates[-1])
+
+    expected = Carry.estimate_idm_series(instrument_list, adjusted_prices, current_prices, weights)
+    np.testing.assert_allclose(
+        load_idm_estimator(filename).idm_series.to_numpy(), expected.to_numpy(), rtol=0, atol=1e-12
+    )
+
+
+def test_calc_idm_is_the_lookup_table():
+    assert Carry.calc_idm(["A"]) == 1.0
+    assert Carry.calc_idm(["A", "B", "C", "D"]) == 1.56
+    assert Carry.calc_idm(["X%d" % idx for idx in range(40)]) == 2.50
@@ -0,0 +1,133 @@
+import numpy as np
+
+import Carry
+from benchmark_functions import make_synthetic_data
+from fdm_functions import fdmEstimator
+from fx_functions import create_fx_series_given_adjusted_prices_dict
+from incremental_functions import create_incremental_state_dict_from_history
+from incremental_functions import update_incremental_state_dict_from_history
+
+CARRY_SPANS = [5, 20, 60, 120]
+CAPITAL = 5000000
+RISK_TARGET_TAU = 0.2
+
+
+def _data_with_different_calendars(seed: int = 0):
+    adjusted_prices, current_prices, carry_prices = make_synthetic_data(
+        instrument_count=4, days=1500, seed=seed, ragged_starts=True
+    )
+
+    ## each side misses some of the other's dates, so there are price only and carry only rows
+    rng = np.random.default_rng(seed)
+    for instrument_code in adjusted_prices.keys():
+        keep_price = rng.random(len(adjusted_prices[instrument_code])) > 0.05
+        adjusted_prices[instrument_code] = adjusted_prices[instrument_code][keep_price]
+        current_prices[instrument_code] = current_prices[instrument_code][keep_price]
+        carry_price = carry_prices[instrument_code]
+        carry_prices[instrument_code] = carry_price[rng.random(len(carry_price)) > 0.1]
+
+    return adjusted_prices, current_prices, carry_prices
+
+
+def _full_and_incremental(adjusted_prices, current_prices, carry_prices):
+    instrument_list = list(adjusted_prices.keys())
+    weights = dict([(instrument_code, 1 / len(instrument_list)) for instrument_code in instrument_list])
+    multipliers = dict([(instrument_code, 20.0) for instrument_code in instrument_list])
+
+    buffered_position_dict, position_dict, capped_forecast_dict = Carry.carry_forecast(
+        instrument_list,
+        weights,
+        CAPITAL,
+        RISK_TARGET_TAU,
+        multipliers,
+        CARRY_SPANS,
+        adjusted_prices,
+        current_prices,
+        carry_prices,
+    )
+    full_dict = dict(
+        capped_forecast=capped_forecast_dict,
+        position=position_dict,
+        buffered_position=buffered_position_dict,
+    )
+
+    incremental_arguments = dict(
+        capital=CAPITAL,
+        risk_target_tau=RISK_TARGET_TAU,
+        idm=Carry.estimate_idm_series(instrument_list, adjusted_prices, current_prices, weights),
+        weights=weights,
+        multipliers=multipliers,
+        carry_spans=CARRY_SPANS,
+    )
+
+    return full_dict, incremental_arguments
+
+
+def _assert_matches(full_dict: dict, output_dict: dict):
+    for output_name, series_dict in full_dict.items():
+        for instrument_code, expected in series_dict.items():
+            got = output_dict[instrument_code][output_name]
+
+            assert got.index.equals(expected.index)
+            np.testing.assert_allclose(got.to_numpy(), expected.to_numpy(), rtol=1e-9, atol=1e-9)
+
+
+def test_incremental_matches_full_path_when_calendars_differ():
+    adjusted_prices, current_prices, carry_prices = _data_with_different_calendars()
+    full_dict, incremental_arguments = _full_and_incremental(
+        adjusted_prices, current_prices, carry_prices
+    )
+
+    _, output_dict = create_incremental_state_dict_from_history(
+        adjusted_prices_dict=adjusted_prices,
+        current_prices_dict=current_prices,
+        carry_prices_dict=carry_prices,
+        fx_series_dict=create_fx_series_given_adjusted_prices_dict(adjusted_prices),
+        **incremental_arguments,
+    )
+
+    _assert_matches(full_dict, output_dict)
+
+
+def test_incremental_update_after_a_split_matches_full_path():
+    adjusted_prices, current_prices, carry_prices = _data_with_different_calendars(seed=1)
+    full_dict, incremental_arguments = _full_and_incremental(
+        adjusted_prices, current_prices, carry_prices
+    )
+    fx_series_dict = create_fx_series_given_adjusted_prices_dict(adjusted_prices)
+
+    ## build the state on the first part of the history, then feed it the rest
+    split_date = adjusted_prices[next(iter(adjusted_prices))].index[1000]
+    fdm_estimator = fdmEstimator(CARRY_SPANS)
+    state_dict, first_output_dict = create_incremental_state_dict_from_history(
+        adjusted_prices_dict=dict(
+            [(code, series[:split_date]) for code, series in adjusted_prices.items()]
+        ),
+        current_prices_dict=dict(
+            [(code, series[:split_date]) for code, series in current_prices.items()]
+        ),
+        carry_prices_dict=dict(
+            [(code, carry_price[:split_date]) for code, carry_price in carry_prices.items()]
+        ),
+        fx_series_dict=fx_series_dict,
+        fdm=fdm_estimator,
+        **incremental_arguments,
+    )
+    later_output_dict = update_incremental_state_dict_from_history(
+        state_dict,
+        adjusted_prices,
+        current_prices,
+        carry_prices,
+        fx_series_dict,
+        after_date_dict=dict([(code, split_date) for code in state_dict.keys()]),
+        idm=incremental_arguments["idm"],
+        fdm=fdm_estimator,
+    )
+
+    output_dict = dict(
+        [
+            (code, first_output_dict[code].combine_first(later_output_dict[code]))
+            for code in state_dict.keys()
+        ]
+    )
+    _assert_matches(full_dict, output_dict)
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from panel_functions import panel_from_dict, presence_from_index_dict, union_of_indices
+
+
+def _series_dict() -> dict:
+    index = pd.bdate_range("2020-01-01", periods=60, name="Date")
+    rng = np.random.default_rng(0)
+
+    ## one on the full calendar, one starting late, one with holes in it
+    return dict(
+        A=pd.Series(rng.normal(size=60), index=index),
+        B=pd.Series(rng.normal(size=40), index=index[20:]),
+        C=pd.Series(rng.normal(size=30), index=index[::2]),
+    )
+
+
+def test_panel_from_dict_puts_each_value_on_its_own_date():
+    series_dict = _series_dict()
+    index = union_of_indices([series.index for series in series_dict.values()])
+
+    panel = panel_from_dict(series_dict, list(series_dict.keys()), index)
+    present = presence_from_index_dict(
+        dict([(code, series.index) for code, series in series_dict.items()]), list(series_dict.keys()), index
+    )
+
+    expected = pd.concat(series_dict, axis=1, sort=True).reindex(index)
+    pd.testing.assert_frame_equal(panel, expected, check_names=False)
+    for code, series in series_dict.items():
+        assert present[code].sum() == len(series)
+        own_rows = panel[code][present[code]]
+        assert own_rows.index.equals(series.index)
+        np.testing.assert_array_equal(own_rows.to_numpy(), series.to_numpy())
+
+
+def test_panel_from_dict_refuses_dates_the_index_doesnt_have():
+    series_dict = _series_dict()
+    index = series_dict["A"].index
+
+    ## a date in the middle of the index's range, and one past its end
+    off_calendar = series_dict["C"].copy()
+    off_calendar.index = off_calendar.index + pd.Timedelta(hours=1)
+    late = pd.Series([1.0], index=[index[-1] + pd.offsets.BDay(1)])
+
+    for series in [off_calendar, late]:
+        with pytest.raises(KeyError):
+            panel_from_dict(dict(X=series), ["X"], index)
+        with pytest.raises(KeyError):
+            presence_from_index_dict(dict(X=series.index), ["X"], index)
@@ -0,0 +1,219 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import risk_functions
+from benchmark_functions import make_synthetic_data
+from risk_functions import BUSINESS_DAYS_IN_YEAR, standardDeviation, calculate_rolling_mean, calculate_ewm_std
+from risk_functions import initialise_rolling_mean_state, rolling_mean_add, rolling_mean_remove, rolling_mean_value
+from risk_functions import calculate_variable_standard_deviation_for_risk_targeting_from_dict
+## the numba kernel when it's installed, and both python paths whether it is or not
+ROLLING_MEAN_KERNELS = [
+    risk_functions.rolling_mean_kernel,
+    risk_functions._rolling_mean_loop,
+    risk_functions._rolling_mean_pandas,
+]
+EWM_STD_KERNELS = [
+    risk_functions.ewm_std_kernel,
+    risk_functions._ewm_std_loop,
+    risk_functions._ewm_std_pandas,
+]
+
+
+def _prices(seed: int = 0) -> tuple:
+    adjusted_prices, current_prices, _ = make_synthetic_data(
+        instrument_count=3, days=3000, seed=seed, ragged_starts=True
+    )
+
+    return adjusted_prices, current_prices
+
+
+def _stdev_the_original_way(
+    adjusted_price: pd.Series,
+    current_price: pd.Series,
+    use_perc_returns: bool = True,
+    annualise_stdev: bool = True,
+) -> pd.Series:
+
+    ## the pandas calculation the class was first written around
+    daily_returns = adjusted_price.diff()
+    if use_perc_returns:
+        daily_returns = daily_returns / current_price.shift(1)
+    annualised_std_dev = daily_returns.ewm(span=32).std()
+    if annualise_stdev:
+        annualised_std_dev = annualised_std_dev * (BUSINESS_DAYS_IN_YEAR ** 0.5)
+    ten_year_vol = annualised_std_dev.rolling(BUSINESS_DAYS_IN_YEAR * 10, min_periods=1).mean()
+
+    return 0.3 * ten_year_vol + 0.7 * annualised_std_dev
+
+
+@pytest.mark.parametrize("use_perc_returns", [True, False])
+@pytest.mark.parametrize("annualise_stdev", [True, False])
+def test_standard_deviation_matches_the_original_formula(use_perc_returns, annualise_stdev):
+    adjusted_prices, current_prices = _prices()
+    adjusted_price, current_price = adjusted_prices["SYN1"], current_prices["SYN1"]
+
+    std_dev = standardDeviation(
+        adjusted_price,
+        current_price,
+        use_perc_returns=use_perc_returns,
+        annualise_stdev=annualise_stdev,
+    )
+    expected = _stdev_the_original_way(adjusted_price, current_price, use_perc_returns, annualise_stdev)
+
+    assert std_dev.index.equals(expected.index)
+    assert len(std_dev) == len(expected)
+    assert std_dev.annualised == annualise_stdev
+    assert std_dev.use_perc_returns == use_perc_returns
+    np.testing.assert_allclose(std_dev.as_series().to_numpy(), expected.to_numpy(), rtol=1e-12)
+    np.testing.assert_allclose(np.asarray(std_dev), expected.to_numpy(), rtol=1e-12)
+    assert std_dev.as_series().index.equals(expected.index)
+
+    ## the price terms, as the pd.Series subclass worked them out
+    daily = expected / (BUSINESS_DAYS_IN_YEAR ** 0.5) if annualise_stdev else expected
+    annual = expected if annualise_stdev else expected * (BUSINESS_DAYS_IN_YEAR ** 0.5)
+    if use_perc_returns:
+        daily = daily * current_price
+        annual = annual * current_price
+
+    for got, expected_terms in [
+        (std_dev.daily_risk_price_terms(), daily),
+        (std_dev.annual_risk_price_terms(), annual),
+    ]:
+        assert got.index.equals(expected_terms.index)
+        np.testing.assert_allclose(got.to_numpy(), expected_terms.to_numpy(), rtol=1e-12)
+
+    ## built once, then handed back
+    assert std_dev.daily_risk_price_terms() is std_dev.daily_risk_price_terms()
+    assert std_dev.annual_risk_price_terms() is std_dev.annual_risk_price_terms()
+
+
+def test_from_arrays_and_the_dict_calculation_match_the_class():
+    adjusted_prices, current_prices = _prices(seed=1)
+    std_dev_dict = calculate_variable_standard_deviation_for_risk_targeting_from_dict(
+        adjusted_prices=adjusted_prices, current_prices=current_prices
+    )
+
+    for instrument_code, adjusted_price in adjusted_prices.items():
+        current_price = current_prices[instrument_code]
+        expected = standardDeviation(adjusted_price, current_price)
+        wrapped = standardDeviation.from_arrays(
+            index=expected.index,
+            stdev=np.asarray(expected),
+            current_price=current_price.reindex(expected.index).to_numpy(),
+        )
+
+        for std_dev in [std_dev_dict[instrument_code], wrapped]:
+            assert isinstance(std_dev, standardDeviation)
+            assert std_dev.index.equals(expected.index)
+            np.testing.assert_allclose(std_dev.values, expected.values, rtol=1e-12)
+            np.testing.assert_allclose(
+                std_dev.current_price.to_numpy(), expected.current_price.to_numpy(), rtol=0
+            )
+            np.testing.assert_allclose(
+                std_dev.daily_risk_price_terms().to_numpy(),
+                expected.daily_risk_price_terms().to_numpy(),
+                rtol=1e-12,
+            )
+            np.testing.assert_allclose(
+                std_dev.annual_risk_price_terms().to_numpy(),
+                expected.annual_risk_price_terms().to_numpy(),
+                rtol=1e-12,
+            )
+
+
+def _values_with_gaps(row_count: int, column_count: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    values = np.cumsum(rng.normal(0, 1, (row_count, column_count)), axis=0)
+    values[rng.random(values.shape) < 0.05] = np.nan
+    values[:7] = np.nan
+    ## a run of the same value, which pandas hands back exactly
+    values[40:60] = 3.25
+
+    return values
+
+
+@pytest.mark.parametrize("kernel", ROLLING_MEAN_KERNELS)
+@pytest.mark.parametrize("window", [20, 500])
+def test_rolling_mean_matches_pandas_with_gaps(kernel, window, monkeypatch):
+    monkeypatch.setattr(risk_functions, "rolling_mean_kernel", kernel)
+    ## 500 is longer than the series
+    values = _values_with_gaps(300, 1)[:, 0]
+
+    expected = pd.Series(values).rolling(window, min_periods=1).mean().to_numpy()
+
+    np.testing.assert_allclose(calculate_rolling_mean(values, window=window), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("kernel", ROLLING_MEAN_KERNELS)
+def test_rolling_mean_panel_matches_pandas_per_column(kernel, monkeypatch):
+    monkeypatch.setattr(risk_functions, "rolling_mean_kernel", kernel)
+    values = _values_with_gaps(400, 4, seed=1)
+
+    got = calculate_rolling_mean(values, window=30, min_periods=5)
+
+    assert got.shape == values.shape
+    for column in range(values.shape[1]):
+        expected = pd.Series(values[:, column]).rolling(30, min_periods=5).mean().to_numpy()
+        np.testing.assert_allclose(got[:, column], expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("kernel", ROLLING_MEAN_KERNELS)
+def test_rolling_mean_panel_with_present_rolls_each_instruments_own_rows(kernel, monkeypatch):
+    monkeypatch.setattr(risk_functions, "rolling_mean_kernel", kernel)
+    values = _values_with_gaps(400, 3, seed=2)
+    present = np.random.default_rng(2).random(values.shape) > 0.2
+    present[:50, 1] = False
+
+    got = calculate_rolling_mean(np.where(present, values, np.nan), window=30, present=present)
+
+    for column in range(values.shape[1]):
+        own_rows = present[:, column]
+        expected = pd.Series(values[own_rows, column]).rolling(30, min_periods=1).mean().to_numpy()
+        np.testing.assert_allclose(got[own_rows, column], expected, rtol=1e-12)
+        assert np.isnan(got[~own_rows, column]).all()
+
+
+def test_rolling_mean_state_one_value_at_a_time_matches_pandas():
+
+    ## as the incremental update drives it
+    values = _values_with_gaps(300, 1, seed=3)[:, 0]
+    window = 25
+    rolling_state = initialise_rolling_mean_state()
+    got = []
+    for idx, value in enumerate(values):
+        if idx >= window:
+            rolling_mean_remove(rolling_state, values[idx - window])
+        rolling_mean_add(rolling_state, value)
+        got.append(rolling_mean_value(rolling_state, 1))
+
+    expected = pd.Series(values).rolling(window, min_periods=1).mean().to_numpy()
+    np.testing.assert_allclose(np.array(got), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("kernel", EWM_STD_KERNELS)
+def test_ewm_std_panel_matches_pandas_per_column(kernel, monkeypatch):
+    monkeypatch.setattr(risk_functions, "ewm_std_kernel", kernel)
+    values = _values_with_gaps(400, 4, seed=4)
+
+    got = calculate_ewm_std(values, span=32)
+
+    assert got.shape == values.shape
+    for column in range(values.shape[1]):
+        expected = pd.Series(values[:, column]).ewm(span=32).std().to_numpy()
+        np.testing.assert_allclose(got[:, column], expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("kernel", EWM_STD_KERNELS)
+def test_ewm_std_panel_with_present_runs_on_each_instruments_own_rows(kernel, monkeypatch):
+    monkeypatch.setattr(risk_functions, "ewm_std_kernel", kernel)
+    values = _values_with_gaps(400, 3, seed=5)
+    present = np.random.default_rng(5).random(values.shape) > 0.2
+    present[:80, 2] = False
+
+    got = calculate_ewm_std(np.where(present, values, np.nan), span=32, present=present)
+
+    for column in range(values.shape[1]):
+        own_rows = present[:, column]
+        expected = pd.Series(values[own_rows, column]).ewm(span=32).std().to_numpy()
+        np.testing.assert_allclose(got[own_rows, column], expected, rtol=1e-12)
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+from carry_functions import calculate_annualised_carry
+from roll_calendar_functions import rollCalendar, contract_year_frac_difference, roll_dates
+
+CONTRACTS = [20230300, 20230600, 20230900, 20231200, 20240300]
+
+
+def _carry_price(row_count: int = 200, seed: int = 0) -> pd.DataFrame:
+
+    ## a quarterly roll every 50 rows, carry one contract further out, a couple of
+    ## rows with no contracts in the middle of a segment
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range("2023-01-02", periods=row_count, name="Date")
+    quarter = np.arange(row_count) // 50
+    carry_price = pd.DataFrame(
+        dict(
+            PRICE=100 + np.cumsum(rng.normal(0, 1, row_count)),
+            PRICE_CONTRACT=np.array(CONTRACTS)[quarter].astype(float),
+            CARRY_CONTRACT=np.array(CONTRACTS)[quarter + 1].astype(float),
+        ),
+        index=index,
+    )
+    carry_price["CARRY"] = carry_price["PRICE"] + rng.normal(0, 0.5, row_count)
+    carry_price.iloc[[70, 71], [1, 2]] = np.nan
+
+    return carry_price
+
+
+def _year_frac_row_by_row(contract: pd.Series) -> pd.Series:
+
+    ## the per row arithmetic calculate_annualised_carry used to do
+    contract = contract.astype(float)
+    return contract.floordiv(10000) + (contract.mod(10000) / 100.0) / 12.0
+
+
+def test_annualised_carry_matches_row_by_row_over_several_rolls():
+    carry_price = _carry_price()
+    expected = (carry_price["PRICE"] - carry_price["CARRY"]) / (
+        _year_frac_row_by_row(carry_price["CARRY_CONTRACT"])
+        - _year_frac_row_by_row(carry_price["PRICE_CONTRACT"])
+    )
+
+    got = calculate_annualised_carry(carry_price)
+
+    assert got.index.equals(expected.index)
+    np.testing.assert_array_equal(got.to_numpy(), expected.to_numpy())
+    assert np.isnan(got.iloc[[70, 71]]).all()
+
+
+def test_roll_calendar_segments_and_rolls():
+    carry_price = _carry_price()
+    calendar = rollCalendar(carry_price["PRICE_CONTRACT"], carry_price["CARRY_CONTRACT"])
+
+    ## the missing rows split the second quarter in three
+    segments = calendar.segments()
+    assert segments.start_row.tolist() == [0, 50, 70, 72, 100, 150]
+    assert segments.length.tolist() == [50, 20, 2, 28, 50, 50]
+    np.testing.assert_array_equal(
+        segments.price_contract.to_numpy(),
+        [CONTRACTS[0], CONTRACTS[1], np.nan, CONTRACTS[1], CONTRACTS[2], CONTRACTS[3]],
+    )
+    np.testing.assert_array_equal(
+        segments.carry_contract.to_numpy(),
+        [CONTRACTS[1], CONTRACTS[2], np.nan, CONTRACTS[2], CONTRACTS[3], CONTRACTS[4]],
+    )
+    assert calendar.segment_count == 6
+
+    ## a gap in the codes isn't a roll, the same contract carries on after it
+    assert calendar.roll_rows().tolist() == [50, 100, 150]
+    assert roll_dates(carry_price).equals(carry_price.index[[50, 100, 150]])
+
+    expected_diff = _year_frac_row_by_row(carry_price["CARRY_CONTRACT"]) - _year_frac_row_by_row(
+        carry_price["PRICE_CONTRACT"]
+    )
+    np.testing.assert_array_equal(calendar.contract_diff(), expected_diff.to_numpy())
+
+
+def test_contract_year_frac_difference_on_a_panel():
+    carry_price_list = [_carry_price(seed=0), _carry_price(seed=1).shift(30)]
+    price_contract = pd.concat([carry_price["PRICE_CONTRACT"] for carry_price in carry_price_list], axis=1, keys=["A", "B"])
+    carry_contract = pd.concat([carry_price["CARRY_CONTRACT"] for carry_price in carry_price_list], axis=1, keys=["A", "B"])
+
+    got = contract_year_frac_difference(price_contract, carry_contract)
+
+    assert isinstance(got, pd.DataFrame)
+    assert got.index.equals(price_contract.index)
+    assert got.columns.equals(price_contract.columns)
+    for code in ["A", "B"]:
+        expected = _year_frac_row_by_row(carry_contract[code]) - _year_frac_row_by_row(price_contract[code])
+        np.testing.assert_array_equal(got[code].to_numpy(), expected.to_numpy())
+
+    ## each instrument starts its own segments
+    calendar = rollCalendar(price_contract, carry_contract)
+    assert calendar.segments(column=1).start_row.iloc[0] == 0
+    assert calendar.roll_rows(column=1).tolist() == [80, 130, 180]
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import series_store_functions
+from series_store_functions import seriesStore
+
+
+def _series_dict(codes: list) -> dict:
+    index = pd.date_range("2020-01-01", periods=5, freq="B", name="Date")
+    return dict(
+        position=dict([(code, pd.Series(np.arange(5.0), index=index)) for code in codes])
+    )
+
+
+def test_write_refuses_a_directory_that_isnt_a_store(tmp_path):
+    other_filename = tmp_path / "notes.txt"
+    other_filename.write_text("not the store's")
+
+    with pytest.raises(ValueError):
+        seriesStore(str(tmp_path)).write(_series_dict(["ES"]))
+    assert other_filename.read_text() == "not the store's"
+
+
+def test_write_over_a_store_only_removes_its_own_files(tmp_path):
+    store = seriesStore(str(tmp_path))
+    store.write(_series_dict(["ES", "NQ"]))
+    other_filename = tmp_path / "position" / "notes.txt"
+    other_filename.write_text("not the store's")
+
+    store.write(_series_dict(["ES"]))
+
+    assert other_filename.read_text() == "not the store's"
+    assert store.instruments("position") == ["ES"]
+    assert not os.path.exists(tmp_path / "position" / "NQ.f8")
+    np.testing.assert_array_equal(store.read("position", "ES").to_numpy(), np.arange(5.0))
+
+
+def test_default_store_directory_does_not_depend_on_the_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert os.path.isabs(series_store_functions.DEFAULT_SERIES_STORE_DIRECTORY)
+    assert os.path.dirname(series_store_functions.DEFAULT_SERIES_STORE_DIRECTORY) == os.path.dirname(
+        os.path.abspath(series_store_functions.__file__)
+    )